@@ -0,0 +1,245 @@
+# agent/classifier.py
+
+"""
+CPU-only pre-classifier that spots emails the agent would answer with
+no_action (newsletters, notifications, receipts) so they can skip the LLM.
+
+It combines header heuristics (List-Unsubscribe, Precedence: bulk,
+Auto-Submitted, no-reply senders) with a logistic regression over hashed
+word and bigram features. The model is trained on the agent's own past
+decisions and stored in the models table. Until enough decisions exist,
+only the heuristics are used, and conservatively.
+
+    python -m agent.classifier train
+"""
+
+import re
+import sys
+import json
+import math
+import time
+import zlib
+import random
+import threading
+
+from agent import storage
+
+PRECLASSIFY_THRESHOLD = 0.9   # P(no_action) needed to skip the LLM
+HEURISTIC_THRESHOLD = 1.0     # summed signal weight needed while no model is trained
+HASH_DIM = 2 ** 18
+BODY_CHARS = 2000             # only the start of the body is featurized
+MIN_TRAINING_EXAMPLES = 50
+MAX_TRAINING_EXAMPLES = 5000  # most recent decisions used per training run
+RETRAIN_EVERY = 50            # new decisions before maybe_retrain() retrains
+EPOCHS = 8
+LEARNING_RATE = 0.5
+L2 = 1e-6
+MODEL_NAME = "no_action_v1"
+
+# Header signals and their weight in the heuristic score
+SIGNAL_WEIGHTS = {
+    "precedence_bulk": 1.0,
+    "auto_submitted": 1.0,
+    "noreply_sender": 0.6,
+    "list_unsubscribe": 0.5,  # alone (or with list_id) not enough: discussion lists carry it too
+    "list_id": 0.3,
+}
+NOREPLY_RE = re.compile(r"(no-?reply|do-?not-?reply|notifications?|mailer-daemon|bounce)", re.I)
+TOKEN_RE = re.compile(r"[a-z0-9']+")
+
+_lock = threading.Lock()
+_model = None
+_model_loaded = False
+_stats = {"checked": 0, "skipped": 0}
+
+
+def header_signals(email):
+    headers = email.get("headers") or {}
+    signals = []
+    if headers.get("precedence", "").strip().lower() in ("bulk", "list", "junk"):
+        signals.append("precedence_bulk")
+    if headers.get("auto-submitted", "no").strip().lower() != "no":
+        signals.append("auto_submitted")
+    if "list-unsubscribe" in headers:
+        signals.append("list_unsubscribe")
+    if "list-id" in headers:
+        signals.append("list_id")
+    address = (email.get("from") or "").rsplit("<", 1)[-1]
+    if NOREPLY_RE.search(address.split("@")[0]):
+        signals.append("noreply_sender")
+    return signals
+
+
+def _sender_domain(email):
+    address = (email.get("from") or "").rsplit("<", 1)[-1].rstrip(">").strip().lower()
+    return address.split("@")[-1] if "@" in address else ""
+
+
+def features(email):
+    """Sparse {hash index: value} vector, L2-normalised"""
+    names = {f"sig:{s}" for s in header_signals(email)}
+    names.add(f"domain:{_sender_domain(email)}")
+    for prefix, text in (("s", email.get("subject") or ""), ("w", (email.get("body") or "")[:BODY_CHARS])):
+        tokens = TOKEN_RE.findall(text.lower())
+        names.update(f"{prefix}:{t}" for t in tokens)
+        names.update(f"{prefix}:{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    value = 1.0 / math.sqrt(len(names))
+    vector = {}
+    for name in names:
+        index = zlib.crc32(name.encode("utf-8")) % HASH_DIM
+        vector[index] = vector.get(index, 0.0) + value
+    return vector
+
+
+def _sigmoid(z):
+    if z < -35:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-z))
+
+
+class HashedLogisticRegression:
+    """Binary logistic regression on hashed sparse features, trained by SGD"""
+
+    def __init__(self, weights=None, bias=0.0):
+        self.weights = weights or {}
+        self.bias = bias
+
+    def predict(self, vector):
+        z = self.bias + sum(self.weights.get(i, 0.0) * v for i, v in vector.items())
+        return _sigmoid(z)
+
+    def fit(self, vectors, labels, epochs=EPOCHS, learning_rate=LEARNING_RATE, l2=L2, seed=0):
+        order = list(range(len(vectors)))
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            rate = learning_rate / (1 + epoch)
+            for n in order:
+                vector, label = vectors[n], labels[n]
+                gradient = self.predict(vector) - label
+                self.bias -= rate * gradient
+                for i, v in vector.items():
+                    w = self.weights.get(i, 0.0)
+                    self.weights[i] = w - rate * (gradient * v + l2 * w)
+        return self
+
+    def to_json(self):
+        weights = {str(i): round(w, 6) for i, w in self.weights.items() if abs(w) > 1e-5}
+        return json.dumps({"bias": self.bias, "weights": weights, "dim": HASH_DIM})
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        if data.get("dim") != HASH_DIM:
+            return None
+        return cls({int(i): w for i, w in data["weights"].items()}, data["bias"])
+
+
+def training_examples(limit=MAX_TRAINING_EXAMPLES):
+    """
+    (email, is_no_action) pairs from past LLM decisions, as the work queue
+    records them per message. The threads table is no use here: it only
+    keeps actions other than no_action, against the thread's latest message.
+    Emails the pre-classifier itself skipped are left out.
+    """
+    rows = storage.query_all("""
+        SELECT m.sender, m.subject, m.body, m.headers, q.action
+        FROM work_queue q JOIN messages m ON m.message_id = q.message_id
+        WHERE q.state = 'done' AND q.action IS NOT NULL AND q.action != 'prefiltered'
+        ORDER BY q.updated_at DESC LIMIT ?
+    """, (limit,))
+    return [
+        ({"from": sender, "subject": subject, "body": body, "headers": json.loads(headers or "{}")},
+         action == "no_action")
+        for sender, subject, body, headers, action in rows
+    ]
+
+
+def _decision_count():
+    """Cheap count of the decisions training_examples() draws on"""
+    return storage.query_one(
+        "SELECT COUNT(*) FROM work_queue WHERE state = 'done' AND action IS NOT NULL AND action != 'prefiltered'"
+    )[0]
+
+
+def load_model():
+    """The trained model, or None while there is not enough history"""
+    global _model, _model_loaded
+    with _lock:
+        if not _model_loaded:
+            row = storage.query_one("SELECT data FROM models WHERE name=?", (MODEL_NAME,))
+            _model = HashedLogisticRegression.from_json(row[0]) if row else None
+            _model_loaded = True
+        return _model
+
+
+def train(examples=None, min_examples=MIN_TRAINING_EXAMPLES):
+    """Fit on past decisions and store the model; returns the example count"""
+    global _model, _model_loaded
+    decisions = _decision_count()
+    examples = training_examples() if examples is None else examples
+    labels = [1.0 if no_action else 0.0 for _, no_action in examples]
+    if len(examples) < min_examples or len(set(labels)) < 2:
+        return 0
+
+    model = HashedLogisticRegression().fit([features(email) for email, _ in examples], labels)
+    with storage.transaction() as conn:
+        conn.execute("""
+            INSERT INTO models (name, data, n_examples, trained_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                data=excluded.data, n_examples=excluded.n_examples, trained_at=excluded.trained_at
+        """, (MODEL_NAME, model.to_json(), decisions, time.time()))
+    with _lock:
+        _model, _model_loaded = model, True
+    return len(examples)
+
+
+def maybe_retrain():
+    """Retrain once RETRAIN_EVERY decisions have accumulated since the last fit"""
+    row = storage.query_one("SELECT n_examples FROM models WHERE name=?", (MODEL_NAME,))
+    decisions = _decision_count()
+    trained_on = row[0] if row else 0
+    # A model counted by the old rule (thread actions included) is refit once
+    if trained_on > decisions or decisions - trained_on >= RETRAIN_EVERY:
+        return train()
+    return 0
+
+
+def preclassify(email, record=True):
+    """
+    (skip, reason): skip is True when the email is confidently no-action.
+    record=False leaves the stats alone (a look-ahead, not a decision).
+    """
+    model = load_model()
+    if model is not None:
+        p = model.predict(features(email))
+        skip, reason = p >= PRECLASSIFY_THRESHOLD, f"model p={p:.2f}"
+    else:
+        signals = header_signals(email)
+        skip = sum(SIGNAL_WEIGHTS[s] for s in signals) >= HEURISTIC_THRESHOLD
+        reason = "headers: " + (", ".join(signals) or "none")
+    if record:
+        with _lock:
+            _stats["checked"] += 1
+            _stats["skipped"] += skip
+    return skip, reason
+
+
+def stats():
+    with _lock:
+        out = dict(_stats)
+    out["skip_rate"] = round(out["skipped"] / out["checked"], 4) if out["checked"] else 0.0
+    out["model_trained"] = load_model() is not None
+    return out
+
+
+def main():
+    if sys.argv[1:] != ["train"]:
+        print("usage: python -m agent.classifier train")
+        return
+    n = train()
+    print(f"Trained on {n} decisions" if n else "Not enough decisions to train yet")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# agent/drafts.py
+
+"""
+Speculative reply drafts for the human-in-the-loop flow.
+
+New unread mail is queued in the drafts table, and a low-priority background
+thread runs generate_reply on it ahead of time, so a draft is usually waiting
+by the time the user opens the email. Spend is bounded by rolling hourly caps
+on drafts and tokens. Drafts made with an older model or prompt are redone.
+"""
+
+import time
+import uuid
+import threading
+
+from agent import storage
+from agent.functions import generate_reply_usage
+from agent.gmail import fetch_messages
+from agent.ratelimit import TokenBucket
+
+DRAFT_MODEL = "gpt-4o-mini"
+DRAFT_PROMPT_VERSION = 2   # bump when the reply prompt changes to redo old drafts
+DRAFTS_PER_HOUR = 100      # drafts generated per rolling hour (cache hits are free)
+DRAFT_TOKENS_PER_HOUR = 100_000
+PREFETCH_RATE_PER_MIN = 20 # pacing, so prefetch never bursts ahead of interactive use
+PREFETCH_BATCH = 10        # drafts claimed per pass, newest mail first
+PREFETCH_POLL_INTERVAL = 30
+DRAFT_MAX_ATTEMPTS = 3
+
+STATUS_NEW = "NEW"
+STATUS_READY = "DRAFT READY"
+STATUS_SENT = "SENT"
+
+
+def model_version():
+    return f"{DRAFT_MODEL}/v{DRAFT_PROMPT_VERSION}"
+
+
+def enqueue_drafts(emails):
+    """Queue drafts for emails that have none, or only one from an old model"""
+    if not emails:
+        return
+    now = time.time()
+    with storage.transaction() as conn:
+        conn.executemany("""
+            INSERT INTO drafts (message_id, thread_id, state, model_version, created_at)
+            VALUES (?, ?, 'pending', ?, ?)
+            ON CONFLICT(message_id) DO UPDATE SET state='pending', attempts=0
+            WHERE drafts.state IN ('ready', 'failed') AND drafts.model_version != excluded.model_version
+        """, [(e["id"], e["threadId"], model_version(), now) for e in emails])
+
+
+def draft_status(message_ids):
+    """{message_id: (status, draft or None)} for the EmailCard badge"""
+    found = {}
+    for i in range(0, len(message_ids), 500):
+        chunk = message_ids[i:i + 500]
+        found.update((row[0], row[1:]) for row in storage.query_all(
+            "SELECT message_id, state, model_version, draft FROM drafts "
+            f"WHERE message_id IN ({','.join('?' * len(chunk))})",
+            chunk,
+        ))
+
+    out = {}
+    for msg_id in message_ids:
+        state, version, draft = found.get(msg_id, (None, None, None))
+        if state == "sent":
+            out[msg_id] = (STATUS_SENT, None)
+        elif state == "ready" and version == model_version():
+            out[msg_id] = (STATUS_READY, draft)
+        else:
+            out[msg_id] = (STATUS_NEW, None)
+    return out
+
+
+def mark_sent(message_id):
+    with storage.transaction() as conn:
+        conn.execute("""
+            INSERT INTO drafts (message_id, state, created_at) VALUES (?, 'sent', ?)
+            ON CONFLICT(message_id) DO UPDATE SET state='sent'
+        """, (message_id, time.time()))
+
+
+def budget_wait(now=None):
+    """Seconds until the hourly budget allows another draft (0 = go ahead)"""
+    now = now or time.time()
+    count, tokens, oldest = storage.query_one("""
+        SELECT COUNT(*), COALESCE(SUM(total_tokens), 0), MIN(generated_at)
+        FROM drafts WHERE generated_at > ? AND total_tokens > 0
+    """, (now - 3600,))
+    if count < DRAFTS_PER_HOUR and tokens < DRAFT_TOKENS_PER_HOUR:
+        return 0
+    return max(oldest + 3600 - now, 1)
+
+
+def claim_drafts(limit=PREFETCH_BATCH):
+    token = uuid.uuid4().hex
+    with storage.transaction() as conn:
+        conn.execute("""
+            UPDATE drafts SET state='drafting', claim_token=? WHERE message_id IN (
+                SELECT message_id FROM drafts WHERE state='pending'
+                ORDER BY created_at DESC LIMIT ?
+            )
+        """, (token, limit))
+        rows = conn.execute("SELECT message_id FROM drafts WHERE claim_token=?", (token,)).fetchall()
+    return [row[0] for row in rows]
+
+
+def release_drafts(message_ids=None):
+    """Put claimed drafts back in the queue (all of them when ids is None)"""
+    with storage.transaction() as conn:
+        if message_ids is None:
+            conn.execute("UPDATE drafts SET state='pending', claim_token=NULL WHERE state='drafting'")
+        else:
+            conn.executemany(
+                "UPDATE drafts SET state='pending', claim_token=NULL WHERE message_id=? AND state='drafting'",
+                [(m,) for m in message_ids],
+            )
+
+
+def _record_draft(message_id, draft, total_tokens):
+    with storage.transaction() as conn:
+        conn.execute("""
+            UPDATE drafts SET state='ready', claim_token=NULL, draft=?, model_version=?, total_tokens=?, generated_at=?
+            WHERE message_id=? AND state='drafting'
+        """, (draft, model_version(), total_tokens, time.time(), message_id))
+
+
+def _record_failure(message_id):
+    with storage.transaction() as conn:
+        conn.execute("""
+            UPDATE drafts SET attempts=attempts + 1, claim_token=NULL,
+                state=CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+            WHERE message_id=? AND state='drafting'
+        """, (DRAFT_MAX_ATTEMPTS, message_id))
+
+
+class DraftPrefetcher:
+    """
+    Drafts queued mail on one background thread, paced by
+    PREFETCH_RATE_PER_MIN and capped by the hourly budget.
+    """
+
+    def __init__(self, poll_interval=PREFETCH_POLL_INTERVAL, rate_per_min=PREFETCH_RATE_PER_MIN):
+        self.poll_interval = poll_interval
+        self.bucket = TokenBucket(rate_per_min) if rate_per_min else None
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.thread = None
+
+    def submit(self, emails):
+        """Queue drafts for these emails and wake the prefetcher"""
+        enqueue_drafts(emails)
+        self.wake_event.set()
+
+    def start(self):
+        release_drafts()  # claims left behind by a previous process
+        self.thread = threading.Thread(target=self.run, name="draft-prefetch", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def run_once(self):
+        """Draft one batch; returns seconds to wait before the next pass"""
+        wait = budget_wait()
+        if wait:
+            return wait
+        ids = claim_drafts()
+        if not ids:
+            return self.poll_interval
+
+        remaining = list(ids)
+        try:
+            emails = {e["id"]: e for e in fetch_messages(ids)}
+            while remaining and not self.stop_event.is_set():
+                if budget_wait():
+                    break
+                msg_id = remaining.pop(0)
+                email = emails.get(msg_id)
+                if email is None:  # deleted from Gmail meanwhile
+                    _record_failure(msg_id)
+                    continue
+                if self.bucket:
+                    self.bucket.acquire()
+                try:
+                    draft, tokens = generate_reply_usage(email["body"], email["from"], model=DRAFT_MODEL)
+                    _record_draft(msg_id, draft, tokens)
+                except Exception as e:
+                    print(f"[drafts] prefetch for {msg_id} failed:", e)
+                    _record_failure(msg_id)
+        finally:
+            release_drafts(remaining)
+        return 0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                wait = self.run_once()
+            except Exception as e:
+                print("[drafts] prefetch pass failed:", e)
+                wait = self.poll_interval
+            if wait:
+                self.wake_event.wait(wait)
+                self.wake_event.clear()
+        storage.close_connection()
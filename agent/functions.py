@@ -2,95 +2,231 @@
 
 # agent/functions.py
 
-import os
-import sqlite3
-from openai import OpenAI
-from dotenv import load_dotenv
+import json
+import time
+import asyncio
+import hashlib
+import threading
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from agent import llm, metrics, prompts, storage
 
-DB_PATH = "assistant.db"
+LLM_CACHE_TTL = 7 * 24 * 3600      # seconds a cached completion stays valid
+LLM_CACHE_MAX_ENTRIES = 5000       # least recently used entries are evicted past this
 
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "bypassed": 0, "tokens_saved": 0}
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
 
-    # Create todo table
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS todo (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            task TEXT,
-            due_date TEXT
-        );
-    """)
+def _cache_key(model, messages, tools=None):
+    payload = json.dumps({"model": model, "messages": messages, "tools": tools}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-    # Create meetings table
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS meetings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            topic TEXT,
-            datetime TEXT,
-            attendees TEXT
-        );
-    """)
 
-    conn.commit()
-    conn.close()
+def _cache_lookup(key, now):
+    """Cached text for key if still fresh, else None"""
+    row = storage.query_one("SELECT response, total_tokens, created_at FROM llm_cache WHERE key=?", (key,))
+    if not row or now - row[2] >= LLM_CACHE_TTL:
+        return None
+    with storage.transaction() as conn:
+        conn.execute("UPDATE llm_cache SET last_used=? WHERE key=?", (now, key))
+    with _cache_lock:
+        _cache_stats["hits"] += 1
+        _cache_stats["tokens_saved"] += row[1] or 0
+    return row[0]
 
 
-def generate_reply(email_text: str, sender: str) -> str:
+def _cache_result(key, completion, now, bypass_cache):
+    text = completion.choices[0].message.content.strip()
+    total_tokens = completion.usage.total_tokens if completion.usage else 0
+    return _cache_text(key, text, total_tokens, now, bypass_cache)
+
+
+def _cache_text(key, text, total_tokens, now, bypass_cache):
+    with storage.transaction() as conn:
+        _store_completion(conn, key, text, total_tokens, now)
+
+    with _cache_lock:
+        _cache_stats["bypassed" if bypass_cache else "misses"] += 1
+    return text
+
+
+def cached_completion(messages, model="gpt-4o-mini", bypass_cache=False):
     """
-    Draft a short, professional reply on **my behalf** (Saral),
-    **to the sender**. Always address the sender by their name
-    (extracted from email 'from' header), and write the reply
-    in a polite 2-5 sentence tone.
+    Text of a chat completion, served from the llm_cache table when the same
+    model + messages were answered within LLM_CACHE_TTL. bypass_cache forces
+    a fresh completion (which still refreshes the cache).
+    """
+    return cached_completion_usage(messages, model, bypass_cache)[0]
+
+
+def cached_completion_usage(messages, model="gpt-4o-mini", bypass_cache=False):
+    """cached_completion plus the tokens actually spent (0 on a cache hit)"""
+    key = _cache_key(model, messages)
+    now = time.time()
+
+    if not bypass_cache:
+        text = _cache_lookup(key, now)
+        if text is not None:
+            return text, 0
+
+    completion = llm.chat(
+        model=model,
+        messages=messages
+    )
+    total_tokens = completion.usage.total_tokens if completion.usage else 0
+    return _cache_result(key, completion, now, bypass_cache), total_tokens
+
+
+async def cached_completion_async(messages, model="gpt-4o-mini", bypass_cache=False):
+    """cached_completion for the async API routes; shares the same cache (read and written off the loop)"""
+    key = _cache_key(model, messages)
+    now = time.time()
+
+    if not bypass_cache:
+        text = await asyncio.to_thread(_cache_lookup, key, now)
+        if text is not None:
+            return text
+
+    completion = await llm.achat(
+        model=model,
+        messages=messages
+    )
+    return await asyncio.to_thread(_cache_result, key, completion, now, bypass_cache)
+
+
+async def stream_completion_async(messages, model="gpt-4o-mini", bypass_cache=False):
+    """
+    Yield the completion text as it is generated. A cache hit arrives as a
+    single chunk. The full text is cached only once the stream completes;
+    closing the generator early (client went away) aborts the upstream call.
     """
+    key = _cache_key(model, messages)
+    now = time.time()
+
+    if not bypass_cache:
+        text = await asyncio.to_thread(_cache_lookup, key, now)
+        if text is not None:
+            yield text
+            return
+
+    stream = await llm.achat_stream(
+        model=model,
+        messages=messages,
+        stream_options={"include_usage": True},
+    )
+    parts, total_tokens = [], 0
+    try:
+        async for chunk in stream:
+            if chunk.usage:
+                total_tokens = chunk.usage.total_tokens
+                metrics.llm_tokens.inc(chunk.usage.prompt_tokens, model=model, direction="in")
+                metrics.llm_tokens.inc(chunk.usage.completion_tokens, model=model, direction="out")
+            if chunk.choices and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                parts.append(delta)
+                yield delta
+    finally:
+        await stream.close()
+
+    await asyncio.to_thread(_cache_text, key, "".join(parts).strip(), total_tokens, now, bypass_cache)
+
+
+def _store_completion(conn, key, text, total_tokens, now):
+    conn.execute("""
+        INSERT INTO llm_cache (key, response, total_tokens, created_at, last_used)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET
+            response=excluded.response, total_tokens=excluded.total_tokens,
+            created_at=excluded.created_at, last_used=excluded.last_used
+    """, (key, text, total_tokens, now, now))
+    conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - LLM_CACHE_TTL,))
+    conn.execute("""
+        DELETE FROM llm_cache WHERE key IN (
+            SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+        )
+    """, (LLM_CACHE_MAX_ENTRIES,))
+
+
+def llm_cache_stats():
+    with _cache_lock:
+        stats = dict(_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats
+
+
+def _reply_messages(email_text: str, sender: str):
     sender_name = sender.split("<")[0].strip()
     system_prompt = (
         "You are an email assistant writing replies on behalf of Saral. Draft a short, professional and helpful reply to the sender below. Respond **as Saral**, addressing the **sender by name** and using an appropriate viewpoint (e.g., 'your contributions', not 'my'). Do not add subject while generating the response"
     )
+    _, email_text = prompts.fit("generate_reply", system_prompt, email_text)
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": email_text},
         # {"role": "user", "content": f"Sender: {sender_name}\n\nEmail:\n{email_text}"},
     ]
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages
-    )
-    reply = completion.choices[0].message.content.strip()
+    prompts.record("generate_reply", messages)
+    return messages
+
+
+def generate_reply(email_text: str, sender: str, bypass_cache: bool = False) -> str:
+    """
+    Draft a short, professional reply on **my behalf** (Saral),
+    **to the sender**. Always address the sender by their name
+    (extracted from email 'from' header), and write the reply
+    in a polite 2-5 sentence tone.
+    """
+    reply = cached_completion(_reply_messages(email_text, sender), bypass_cache=bypass_cache)
     return reply
 
 
+def generate_reply_usage(email_text: str, sender: str, model: str = "gpt-4o-mini"):
+    """generate_reply for background drafting: returns (reply, tokens spent)"""
+    return cached_completion_usage(_reply_messages(email_text, sender), model=model)
+
+
+async def generate_reply_async(email_text: str, sender: str, bypass_cache: bool = False) -> str:
+    # Prompt fitting tokenizes the body and records prompt stats: not on the loop
+    messages = await asyncio.to_thread(_reply_messages, email_text, sender)
+    return await cached_completion_async(messages, bypass_cache=bypass_cache)
+
+
+async def stream_reply_async(email_text: str, sender: str, bypass_cache: bool = False):
+    """generate_reply as an async iterator of text chunks"""
+    messages = await asyncio.to_thread(_reply_messages, email_text, sender)
+    chunks = stream_completion_async(messages, bypass_cache=bypass_cache)
+    try:
+        async for delta in chunks:
+            yield delta
+    finally:
+        await chunks.aclose()  # closes the upstream stream when the client goes away
+
+
 def schedule_meeting(datetime: str, topic: str, attendees: str):
     """
     Simulate adding a meeting by storing in SQLite.
     """
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute(
+    storage.write(
         "INSERT INTO meetings (topic, datetime, attendees) VALUES (?, ?, ?)",
         (topic, datetime, attendees),
     )
-    conn.commit()
-    conn.close()
     return {"status": "scheduled", "topic": topic, "datetime": datetime}
 
 
-def summarize_email(email_text: str) -> str:
+def _summarize_messages(email_text: str):
+    instruction = "Summarize the following email:\n\n"
+    _, email_text = prompts.fit("summarize_email", instruction, email_text)
+    messages = [{"role": "user", "content": instruction + email_text}]
+    prompts.record("summarize_email", messages)
+    return messages
+
+
+def summarize_email(email_text: str, bypass_cache: bool = False) -> str:
     """
     Summarize the email using GPT.
     """
-    prompt = f"Summarize the following email:\n\n{email_text}"
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}]
-    )
-    summary = completion.choices[0].message.content.strip()
+    summary = cached_completion(_summarize_messages(email_text), bypass_cache=bypass_cache)
     return summary
 
 
@@ -98,16 +234,10 @@ def add_to_todo(task: str, due_date: str):
     """
     Store tasks persistently in SQLite.
     """
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute(
+    storage.write(
         "INSERT INTO todo (task, due_date) VALUES (?, ?)",
         (task, due_date),
     )
-    conn.commit()
-    conn.close()
     return {"status": "added", "task": task, "due_date": due_date}
 
 
@@ -1,25 +1,73 @@
 # agent/gmail.py
 
 import os
+import json
+import errno
+import time
+import atexit
 import base64
+import threading
+from urllib.parse import urlparse
+from collections import OrderedDict
+from datetime import datetime, timezone
 from email import message_from_bytes
 
+import httplib2
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 
+from agent import metrics, mime, storage
+from agent.message_cache import message_cache
+
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly", "https://www.googleapis.com/auth/gmail.send", "https://www.googleapis.com/auth/gmail.modify"]
 
+TOKEN_PATH = "token.json"
+CREDENTIALS_PATH = "credentials.json"
+TOKEN_REFRESH_MARGIN = 300   # refresh the access token this many seconds before it expires
+TOKEN_RETRY_DELAY = 60       # wait before retrying a failed background refresh
+HTTP_TIMEOUT = 30
 
-def get_gmail_service():
-    """Authenticate and return Gmail API service"""
+BATCH_SIZE = 100             # Gmail caps batch requests at 100 calls
+BATCH_MAX_RETRIES = 3
+BATCH_RETRY_BACKOFF = 0.5    # seconds, doubled on each retry round
+BATCH_RETRY_STATUSES = {429, 500, 502, 503, 504}
+BATCH_MODIFY_SIZE = 1000     # ids per messages.batchModify call (the Gmail maximum)
+LABEL_FLUSH_INTERVAL = 2.0   # seconds a queued label change may wait before it is sent
+LIST_HEADERS = ["From", "Subject"]
+# Kept on parsed messages (lower-cased) for the no-action pre-classifier
+SIGNAL_HEADERS = ["List-Unsubscribe", "List-Id", "Precedence", "Auto-Submitted"]
+# Kept too, so replies carry In-Reply-To / References (see agent/outbox.py)
+THREADING_HEADERS = ["Message-ID", "References", "In-Reply-To"]
+
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
+# Process-wide session state. Credentials and the parsed discovery document are
+# shared; each thread gets its own service because httplib2 is not thread-safe.
+_session_lock = threading.RLock()
+_local = threading.local()
+_creds = None
+_discovery_doc = None
+_refresh_timer = None
+_generation = 0
+
+
+def _save_credentials(creds):
+    with open(TOKEN_PATH, "w") as token_file:
+        token_file.write(creds.to_json())
+
+
+def _load_credentials():
+    """Load token.json, refreshing it or running the OAuth flow if needed"""
     creds = None
-    token_path = "token.json"
 
     # If token exists, use it
-    if os.path.exists(token_path):
-        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
+    if os.path.exists(TOKEN_PATH):
+        creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
 
     # If no valid creds -> OAuth flow
     if not creds or not creds.valid:
@@ -27,101 +75,399 @@ def get_gmail_service():
             creds.refresh(Request())
         else:
             flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES
+                CREDENTIALS_PATH, SCOPES
             )
             creds = flow.run_local_server(port=0)
 
         # Save token for future
-        with open(token_path, "w") as token_file:
-            token_file.write(creds.to_json())
+        _save_credentials(creds)
+
+    return creds
+
+
+def _schedule_refresh(delay=None):
+    """Arm a daemon timer that refreshes the shared token before it expires"""
+    global _refresh_timer
+    if _refresh_timer is not None:
+        _refresh_timer.cancel()
+        _refresh_timer = None
+
+    if delay is None:
+        if not _creds or not _creds.expiry or not _creds.refresh_token:
+            return
+        now = datetime.now(timezone.utc).replace(tzinfo=None)  # google-auth uses naive UTC
+        delay = max((_creds.expiry - now).total_seconds() - TOKEN_REFRESH_MARGIN, 0)
+        delay = min(delay, threading.TIMEOUT_MAX)
+
+    _refresh_timer = threading.Timer(delay, _refresh_credentials)
+    _refresh_timer.daemon = True
+    _refresh_timer.start()
+
+
+def _refresh_credentials():
+    with _session_lock:
+        if _creds is None:
+            return
+        try:
+            _creds.refresh(Request())
+            _save_credentials(_creds)
+        except Exception as e:
+            print("Gmail token refresh failed:", e)
+            _schedule_refresh(TOKEN_RETRY_DELAY)
+            return
+        _schedule_refresh()
+
+
+def _get_discovery_doc():
+    """Parsed Gmail discovery document, loaded once per process.
+
+    GMAIL_DISCOVERY_DOC may point at a JSON file (e.g. one aimed at a local fake
+    server); otherwise the document bundled with googleapiclient is used.
+    """
+    global _discovery_doc
+    if _discovery_doc is None:
+        path = os.getenv("GMAIL_DISCOVERY_DOC")
+        if path:
+            with open(path) as f:
+                _discovery_doc = json.load(f)
+        else:
+            _discovery_doc = json.loads(discovery_cache.get_static_doc("gmail", "v1"))
+    return _discovery_doc
+
+
+def get_credentials():
+    """Shared OAuth credentials, loaded once and kept fresh in the background"""
+    global _creds
+    with _session_lock:
+        if _creds is None:
+            _creds = _load_credentials()
+            _schedule_refresh()
+        return _creds
+
+
+def refresh_credentials_now():
+    """Refresh the shared token immediately (e.g. after a 401)"""
+    creds = get_credentials()
+    with _session_lock:
+        creds.refresh(Request())
+        _save_credentials(creds)
+        _schedule_refresh()
+    return creds
+
+
+def operation_name(method, url):
+    """Metric label for a Gmail REST call, e.g. messages.get or threads.list"""
+    path = urlparse(url).path
+    if path.startswith("/batch"):
+        return "batch"
+    parts = path.split("/users/me/", 1)[-1].strip("/").split("/")
+    resource = parts[0]
+    if resource == "profile":
+        return "profile.get"
+    if len(parts) == 1:
+        return f"{resource}.{'list' if method == 'GET' else 'create'}"
+    if len(parts) == 2:
+        if parts[1] in ("send", "batchModify", "batchDelete", "import", "insert"):
+            return f"{resource}.{parts[1]}"
+        return f"{resource}.{'get' if method == 'GET' else method.lower()}"
+    if len(parts) == 3:
+        return f"{resource}.{parts[2]}"
+    return f"{parts[2]}.{'get' if method == 'GET' else method.lower()}"
+
+
+class _InstrumentedHttp(AuthorizedHttp):
+    """AuthorizedHttp that times every request (batches count as one) into metrics"""
+
+    def request(self, uri, method="GET", *args, **kwargs):
+        operation = operation_name(method, uri)
+        with metrics.span(f"gmail.{operation}", (metrics.gmail_seconds, {"operation": operation})) as span:
+            try:
+                resp, content = super().request(uri, method, *args, **kwargs)
+            except Exception as e:
+                metrics.gmail_errors.inc(operation=operation, status=type(e).__name__)
+                raise
+            span.set(status=resp.status)
+            if resp.status >= 400:
+                metrics.gmail_errors.inc(operation=operation, status=resp.status)
+        return resp, content
+
+
+class _SendOnceHttp(httplib2.Http):
+    """
+    httplib2.Http that never repeats messages.send. When a connection drops
+    before the answer, httplib2 reconnects and sends the request again,
+    which delivers a reply twice if Gmail had already accepted it. Here the
+    send fails instead, and the outbox checks the thread before retrying.
+    """
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        if method != "POST" or not request_uri.split("?")[0].endswith("/messages/send"):
+            return super()._conn_request(conn, request_uri, method, body, headers)
+        sent = []
+
+        def request_once(*args, **kwargs):
+            if sent:
+                raise ConnectionAbortedError(errno.ECONNABORTED, "connection dropped before Gmail answered the send")
+            sent.append(True)
+            return type(conn).request(conn, *args, **kwargs)
+
+        conn.request = request_once
+        try:
+            return super()._conn_request(conn, request_uri, method, body, headers)
+        finally:
+            del conn.request
+
+
+def api_root():
+    """Base URL of the Gmail REST API (follows GMAIL_DISCOVERY_DOC)"""
+    with _session_lock:
+        return _get_discovery_doc()["rootUrl"]
+
+
+def get_gmail_service():
+    """Return this thread's Gmail API service, built once on shared credentials"""
+    cached = getattr(_local, "service", None)
+    if cached is not None and cached[0] == _generation:
+        return cached[1]
+
+    creds = get_credentials()
+    with _session_lock:
+        doc = _get_discovery_doc()
+        generation = _generation
 
-    service = build("gmail", "v1", credentials=creds)
+    http = _InstrumentedHttp(creds, http=_SendOnceHttp(timeout=HTTP_TIMEOUT))
+    service = build_from_document(doc, http=http)
+    _local.service = (generation, service)
     return service
 
 
-def fetch_emails(n=5):
-    """Fetch last n unread emails"""
+def reset_gmail_service():
+    """Forget cached credentials and services, e.g. after token.json changed"""
+    global _creds, _discovery_doc, _generation
+    with _session_lock:
+        if _refresh_timer is not None:
+            _refresh_timer.cancel()
+        _creds = None
+        _discovery_doc = None
+        _generation += 1
+
+
+def _batch_execute(service, keys, make_request):
+    """
+    Run one request per key through Gmail batch calls of up to BATCH_SIZE.
+    Items failing with a retryable status are re-batched with backoff.
+    Returns {key: response}; items that still fail are logged and left out.
+    """
+    results = {}
+    pending = list(dict.fromkeys(keys))
+
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        failed = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status in BATCH_RETRY_STATUSES:
+                metrics.gmail_errors.inc(operation="batch_item", status=exception.resp.status)
+                failed.append(request_id)
+            else:
+                status = exception.resp.status if isinstance(exception, HttpError) else type(exception).__name__
+                metrics.gmail_errors.inc(operation="batch_item", status=status)
+                print(f"Gmail batch item {request_id} failed:", exception)
+
+        for i in range(0, len(pending), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for key in pending[i:i + BATCH_SIZE]:
+                batch.add(make_request(key), request_id=key)
+            batch.execute()
+
+        if not failed:
+            break
+        pending = failed
+        if attempt < BATCH_MAX_RETRIES:
+            time.sleep(BATCH_RETRY_BACKOFF * 2 ** attempt)
+    else:
+        print(f"Gmail batch gave up on {len(pending)} item(s):", pending)
+
+    return results
+
+
+def _header(headers, name, default=None):
+    return next((h["value"] for h in headers if h["name"] == name), default)
+
+
+def _kept_headers(headers):
+    wanted = {name.lower() for name in SIGNAL_HEADERS + THREADING_HEADERS}
+    return {h["name"].lower(): h["value"] for h in headers if h["name"].lower() in wanted}
+
+
+def _fetch_attachment(message_id, attachment_id):
+    """Base64url data of a part Gmail left out of the payload for its size"""
     service = get_gmail_service()
-    results = (
-        service.users()
-        .messages()
-        .list(userId="me", labelIds=["UNREAD"], maxResults=n)
+    attachment = (
+        service.users().messages().attachments()
+        .get(userId="me", messageId=message_id, id=attachment_id)
         .execute()
     )
+    return attachment.get("data", "")
 
-    messages = results.get("messages", [])
-    emails = []
 
-    for msg in messages:
-        msg_data = (
-            service.users()
-            .messages()
-            .get(userId="me", id=msg["id"], format="full")
-            .execute()
-        )
-        payload = msg_data["payload"]
-        headers = payload["headers"]
+def _parse_message(msg_data, fetch_attachment=None):
+    """
+    Gmail message resource -> {id, threadId, from, subject, body, headers}.
+    fetch_attachment(message_id, attachment_id) resolves text bodies Gmail
+    moved out of the payload; without it they come back empty.
+    """
+    payload = msg_data["payload"]
+    headers = payload["headers"]
 
-        email_from = next(
-            (h["value"] for h in headers if h["name"] == "From"), None
-        )
-        subject = next(
-            (h["value"] for h in headers if h["name"] == "Subject"), None
-        )
+    fetch = None
+    if fetch_attachment is not None:
+        def fetch(attachment_id):
+            return fetch_attachment(msg_data["id"], attachment_id)
+    body = mime.extract_body(payload, fetch)
 
-        parts = payload.get("parts", [])
-        body = ""
-        for part in parts:
-            if part["mimeType"] == "text/plain":
-                data = part["body"]["data"]
-                body = base64.urlsafe_b64decode(data).decode("utf-8")
-                break
+    # metadata fetches carry no body; the snippet is the best preview we have
+    if not body and not payload.get("parts") and "snippet" in msg_data:
+        body = msg_data["snippet"]
 
-        emails.append({"id": msg["id"], "threadId": msg_data["threadId"], "from": email_from, "subject": subject, "body": body})
+    return {
+        "id": msg_data["id"],
+        "threadId": msg_data["threadId"],
+        "from": _header(headers, "From"),
+        "subject": _header(headers, "Subject"),
+        "body": body,
+        "headers": _kept_headers(headers),
+    }
 
-    return emails
 
-def fetch_thread(thread_id: str):
+def _parse_and_cache(raw_messages, fetch_attachment=_fetch_attachment):
+    """Parse full-format message resources and store them in the message cache"""
+    parsed = [_parse_message(m, fetch_attachment) for m in raw_messages]
+    message_cache.put_many([
+        dict(msg, labelIds=raw.get("labelIds", [])) for msg, raw in zip(parsed, raw_messages)
+    ])
+    return parsed
+
+
+def fetch_messages(message_ids, metadata_only=False):
     """
-    Returns a list of all messages in a Gmail thread, each with {from, subject, body}
+    Parsed messages for the given ids, in order. Cached messages are served
+    locally; the rest come from one batched fetch and are cached (full
+    format only).
+    """
+    found = message_cache.get_many(message_ids)
+    missing = [msg_id for msg_id in message_ids if msg_id not in found]
+
+    if missing:
+        service = get_gmail_service()
+        messages = service.users().messages()
+        if metadata_only:
+            def make_request(msg_id):
+                return messages.get(userId="me", id=msg_id, format="metadata", metadataHeaders=LIST_HEADERS)
+        else:
+            def make_request(msg_id):
+                return messages.get(userId="me", id=msg_id, format="full")
+
+        fetched = _batch_execute(service, missing, make_request)
+        if metadata_only:
+            parsed = [_parse_message(raw) for raw in fetched.values()]
+        else:
+            parsed = _parse_and_cache(list(fetched.values()))
+        found.update((msg["id"], msg) for msg in parsed)
+
+    return [found[msg_id] for msg_id in message_ids if msg_id in found]
+
+
+def fetch_emails(n=5, metadata_only=False):
+    """
+    Fetch last n unread emails.
+    metadata_only skips bodies (format=metadata) for list views; body then
+    holds Gmail's snippet.
     """
     service = get_gmail_service()
-    thread = (
+    results = (
         service.users()
-        .threads()
-        .get(userId="me", id=thread_id, format="full")
+        .messages()
+        .list(userId="me", labelIds=["UNREAD"], maxResults=n)
         .execute()
     )
 
-    messages_out = []
-    for m in thread["messages"]:
-        headers = m["payload"]["headers"]
-        email_from = next((h["value"] for h in headers if h["name"] == "From"), "")
-        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
-        body = ""
+    ids = [msg["id"] for msg in results.get("messages", [])]
+    return fetch_messages(ids, metadata_only=metadata_only)
 
-        parts = m["payload"].get("parts", [])
-        for part in parts:
-            if part["mimeType"] == "text/plain":
-                data = part["body"].get("data", "")
-                if data:
-                    body = base64.urlsafe_b64decode(data).decode("utf-8")
-                    break
 
-        messages_out.append({"from": email_from, "subject": subject, "body": body})
+def _thread_entry(msg):
+    return {
+        "id": msg["id"],
+        "from": msg["from"] or "",
+        "subject": msg["subject"] or "",
+        "body": msg["body"],
+    }
 
-    return messages_out
 
-def send_email(to: str, subject: str, body: str):
+def fetch_thread(thread_id: str):
     """
-    Send an email using Gmail API
+    Returns a list of all messages in a Gmail thread, each with {id, from, subject, body}
     """
     service = get_gmail_service()
+    threads = service.users().threads()
+
+    # Unknown thread: one full fetch. Otherwise list the ids cheaply and
+    # only download the messages the cache hasn't seen yet.
+    if not message_cache.has_thread(thread_id):
+        thread = threads.get(userId="me", id=thread_id, format="full").execute()
+        return [_thread_entry(m) for m in _parse_and_cache(thread["messages"])]
+
+    return [_thread_entry(m) for m in fetch_messages(fetch_thread_ids(thread_id))]
+
+
+def fetch_thread_ids(thread_id: str):
+    """Message ids of a thread, oldest first (format=minimal, no bodies)"""
+    service = get_gmail_service()
+    thread = service.users().threads().get(userId="me", id=thread_id, format="minimal").execute()
+    return [m["id"] for m in thread["messages"]]
+
+
+def fetch_threads(thread_ids):
+    """
+    Batched fetch_thread for many threads at once.
+    Returns {thread_id: [messages]} for the threads that could be fetched.
+    """
+    service = get_gmail_service()
+    threads = service.users().threads()
+    fetched = _batch_execute(
+        service, thread_ids,
+        lambda thread_id: threads.get(userId="me", id=thread_id, format="full"),
+    )
+    return {
+        thread_id: [_thread_entry(m) for m in _parse_and_cache(thread["messages"])]
+        for thread_id, thread in fetched.items()
+    }
+
+
+def build_raw_message(to: str, subject: str, body: str, thread_id=None, in_reply_to=None, references=None):
+    """messages.send body; a reply names the thread and the message it answers"""
+    headers = f"To:{to}\r\nSubject:{subject}\r\n"
+    if in_reply_to:
+        headers += f"In-Reply-To:{in_reply_to}\r\nReferences:{references or in_reply_to}\r\n"
     message = {
         "raw": base64.urlsafe_b64encode(
-            f"To:{to}\r\nSubject:{subject}\r\n\r\n{body}".encode("utf-8")
+            f"{headers}\r\n{body}".encode("utf-8")
         ).decode("utf-8")
     }
+    if thread_id:
+        message["threadId"] = thread_id
+    return message
+
+
+def send_email(to: str, subject: str, body: str, thread_id=None, in_reply_to=None, references=None):
+    """
+    Send an email using Gmail API. Agent replies go through agent/outbox.py,
+    which retries and deduplicates; this is the single attempt it makes.
+    """
+    service = get_gmail_service()
+    message = build_raw_message(to, subject, body, thread_id, in_reply_to, references)
     sent = (
         service.users()
         .messages()
@@ -131,10 +477,311 @@ def send_email(to: str, subject: str, body: str):
     return sent
 
 
+def find_sent_reply(thread_id, in_reply_to, body):
+    """
+    Id of a message we sent in the thread that answers in_reply_to with
+    this body, or None. The outbox asks before re-sending a reply whose
+    earlier attempt may have gone through.
+    """
+    service = get_gmail_service()
+    thread = service.users().threads().get(userId="me", id=thread_id, format="full").execute()
+    for raw in thread.get("messages", []):
+        if "SENT" not in raw.get("labelIds", []):
+            continue
+        msg = _parse_message(raw, _fetch_attachment)
+        if msg["headers"].get("in-reply-to") == in_reply_to and msg["body"].strip() == body.strip():
+            return msg["id"]
+    return None
+
+
+def _batch_modify(service, ids, add, remove):
+    """
+    One messages.batchModify call for up to BATCH_MODIFY_SIZE ids, retried
+    on retryable statuses. A bad id fails the whole call, so after that the
+    ids are modified one by one (in batch requests) to isolate it. Returns
+    the ids that were modified.
+    """
+    body = {"ids": ids, "addLabelIds": list(add), "removeLabelIds": list(remove)}
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        try:
+            service.users().messages().batchModify(userId="me", body=body).execute()
+            return ids
+        except HttpError as e:
+            if e.resp.status not in BATCH_RETRY_STATUSES:
+                print(f"Gmail batchModify of {len(ids)} message(s) failed, retrying one by one:", e)
+                break
+            if attempt < BATCH_MAX_RETRIES:
+                time.sleep(BATCH_RETRY_BACKOFF * 2 ** attempt)
+    else:
+        print(f"Gmail batchModify of {len(ids)} message(s) kept failing, retrying one by one")
+
+    def make_request(msg_id):
+        return service.users().messages().modify(
+            userId="me", id=msg_id, body={"addLabelIds": list(add), "removeLabelIds": list(remove)},
+        )
+
+    done = _batch_execute(service, ids, make_request)
+    return [msg_id for msg_id in ids if msg_id in done]
+
+
+class LabelBuffer:
+    """
+    Pending label changes, sent with messages.batchModify. queue() records
+    the change per message and label, so opposing changes coalesce (the
+    last one wins) and messages with the same net change share calls of up
+    to BATCH_MODIFY_SIZE ids. A background thread flushes once a change
+    has waited LABEL_FLUSH_INTERVAL, or at once when BATCH_MODIFY_SIZE
+    messages are pending; queue() itself never waits on Gmail. flush()
+    sends everything now (process_emails, shutdown); apply() sends one
+    caller's changes now and returns that caller's failures.
+    """
+
+    def __init__(self, max_ids=None, max_delay=None):
+        self.max_ids = max_ids
+        self.max_delay = max_delay
+        self.lock = threading.Condition()
+        self.flush_lock = threading.Lock()  # sends run one at a time, in queue order
+        self.pending = OrderedDict()        # message id -> {label: True to add, False to remove}
+        self.oldest = None
+        self.thread = None
+        self.counts = {"queued": 0, "coalesced": 0, "applied": 0, "failed": 0, "batches": 0}
+
+    @staticmethod
+    def _record(changes, add, remove):
+        changes.update(dict.fromkeys(remove, False))
+        changes.update(dict.fromkeys(add, True))
+
+    def queue(self, message_ids, add=(), remove=()):
+        with self.lock:
+            for msg_id in message_ids:
+                changes = self.pending.setdefault(msg_id, {})
+                if changes:
+                    self.counts["coalesced"] += 1
+                self._record(changes, add, remove)
+                self.counts["queued"] += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            self._start()
+            self.lock.notify()
+
+    def _start(self):
+        """Start the flusher thread; caller holds the lock"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="gmail-labels", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                max_delay = self.max_delay if self.max_delay is not None else LABEL_FLUSH_INTERVAL
+                delay = self.oldest + max_delay - time.monotonic()
+                full = len(self.pending) >= (self.max_ids or BATCH_MODIFY_SIZE)
+                if delay > 0 and not full:
+                    self.lock.wait(delay)
+                    continue
+            self.flush()
+
+    def _requeue(self, pending):
+        """Put unsent changes back, under any that were queued since"""
+        with self.lock:
+            for msg_id, changes in pending.items():
+                self.pending[msg_id] = {**changes, **self.pending.get(msg_id, {})}
+            self.oldest = time.monotonic()
+
+    def flush(self):
+        """
+        Send every pending change. Returns the ids that were not modified;
+        changes that failed on a connection error are queued again.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, OrderedDict()
+                self.oldest = None
+            return self._send(pending, requeue=True)
+
+    def apply(self, message_ids, add=(), remove=()):
+        """
+        Make this change now, after any queued for the same messages, and
+        return the ids among message_ids that Gmail did not modify.
+        """
+        with self.flush_lock:
+            with self.lock:
+                own = OrderedDict((msg_id, self.pending.pop(msg_id, {})) for msg_id in message_ids)
+                if not self.pending:
+                    self.oldest = None
+                self.counts["queued"] += len(own)
+            for changes in own.values():
+                self._record(changes, add, remove)
+            order = list(own)
+            failed = set(self._send(own, requeue=False))
+        return [msg_id for msg_id in order if msg_id in failed]
+
+    def _send(self, pending, requeue):
+        """batchModify calls for `pending`; caller holds flush_lock. Returns the ids not modified."""
+        if not pending:
+            return []
+        groups = OrderedDict()
+        for msg_id, changes in pending.items():
+            add = tuple(sorted(label for label, on in changes.items() if on))
+            remove = tuple(sorted(label for label, on in changes.items() if not on))
+            groups.setdefault((add, remove), []).append(msg_id)
+
+        failed = []
+        try:
+            service = get_gmail_service()
+            for (add, remove), ids in groups.items():
+                for i in range(0, len(ids), BATCH_MODIFY_SIZE):
+                    chunk = ids[i:i + BATCH_MODIFY_SIZE]
+                    done = _batch_modify(service, chunk, add, remove)
+                    message_cache.update_labels_many(done, add=add, remove=remove)
+                    done = set(done)
+                    for msg_id in chunk:
+                        del pending[msg_id]
+                        if msg_id not in done:
+                            failed.append(msg_id)
+                    with self.lock:
+                        self.counts["batches"] += 1
+                        self.counts["applied"] += len(done)
+                        self.counts["failed"] += len(chunk) - len(done)
+        except Exception as e:
+            if requeue:
+                print(f"Gmail label flush failed, {len(pending)} message(s) queued again:", e)
+                self._requeue(pending)
+            else:
+                print(f"Gmail label change failed for {len(pending)} message(s):", e)
+                with self.lock:
+                    self.counts["failed"] += len(pending)
+            failed += list(pending)
+        return failed
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, pending=len(self.pending))
+
+
+label_buffer = LabelBuffer()
+atexit.register(label_buffer.flush)
+
+
+def modify_labels(message_ids, add=(), remove=()):
+    """Queue a label change for messages; see LabelBuffer"""
+    label_buffer.queue(message_ids, add=add, remove=remove)
+
+
 def mark_as_read(message_id: str):
+    modify_labels([message_id], remove=["UNREAD"])
+
+
+def archive(message_ids):
+    """Archive now, in as few batchModify calls as possible; returns the ids that failed"""
+    return label_buffer.apply(list(dict.fromkeys(message_ids)), remove=["INBOX"])
+
+
+def get_history_id():
+    row = storage.query_one("SELECT value FROM sync_state WHERE key='history_id'")
+    return row[0] if row else None
+
+
+def set_history_id(history_id, conn=None):
+    """Advance the sync cursor, inside the caller's transaction when conn is given"""
+    if conn is None:
+        with storage.transaction() as conn:
+            return set_history_id(history_id, conn)
+    conn.execute("""
+        INSERT INTO sync_state (key, value) VALUES ('history_id', ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value
+    """, (str(history_id),))
+
+
+def _full_resync(service, n):
+    """Snapshot the mailbox: current historyId plus the top n unread ids"""
+    # Read the historyId first so nothing arriving during the listing is missed
+    history_id = service.users().getProfile(userId="me").execute()["historyId"]
+    results = (
+        service.users()
+        .messages()
+        .list(userId="me", labelIds=["UNREAD"], maxResults=n)
+        .execute()
+    )
+    added = [{"id": msg["id"], "threadId": msg["threadId"]} for msg in results.get("messages", [])]
+    return {"added": added, "removed": [], "labels_changed": [], "history_id": history_id, "full": True}
+
+
+def sync_history(n=5):
+    """
+    Incremental mailbox sync against the historyId stored in SQLite.
+
+    Returns {added, removed, labels_changed, history_id, full}. "added" only
+    holds unread inbox arrivals, as {id, threadId}. Without a stored
+    historyId, or once Gmail has expired it (404), this falls back to a full
+    resync over the top n unread.
+
+    The stored cursor is not advanced here: the caller records the arrivals
+    first and then calls set_history_id(delta["history_id"]), ideally in the
+    same transaction, so an arrival that can't be fetched yet is not lost.
+    """
     service = get_gmail_service()
-    service.users().messages().modify(
-        userId="me",
-        id=message_id,
-        body={"removeLabelIds": ["UNREAD"]},
-    ).execute()
\ No newline at end of file
+    start = get_history_id()
+    if start is None:
+        return _full_resync(service, n)
+
+    added, removed, changed = {}, set(), set()
+    history_id = start
+    page_token = None
+    try:
+        while True:
+            page = (
+                service.users()
+                .history()
+                .list(userId="me", startHistoryId=start, historyTypes=HISTORY_TYPES, pageToken=page_token)
+                .execute()
+            )
+            for record in page.get("history", []):
+                for item in record.get("messagesAdded", []):
+                    msg = item["message"]
+                    labels = msg.get("labelIds", [])
+                    if "UNREAD" in labels and "INBOX" in labels:
+                        added[msg["id"]] = msg["threadId"]
+                for item in record.get("messagesDeleted", []):
+                    removed.add(item["message"]["id"])
+                for item in record.get("labelsAdded", []):
+                    changed.add(item["message"]["id"])
+                    message_cache.update_labels(item["message"]["id"], add=item.get("labelIds", []))
+                for item in record.get("labelsRemoved", []):
+                    changed.add(item["message"]["id"])
+                    message_cache.update_labels(item["message"]["id"], remove=item.get("labelIds", []))
+            history_id = page.get("historyId", history_id)
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                break
+    except HttpError as e:
+        if e.resp.status != 404:
+            raise
+        print("Gmail history expired; running a full resync.")
+        return _full_resync(service, n)
+
+    message_cache.delete(sorted(removed))
+    return {
+        "added": [{"id": msg_id, "threadId": thread_id} for msg_id, thread_id in added.items()
+                  if msg_id not in removed],
+        "removed": sorted(removed),
+        "labels_changed": sorted(changed - removed),
+        "history_id": history_id,
+        "full": False,
+    }
+
+
+def fetch_new_emails(n=5):
+    """
+    Unread emails that arrived since the last sync. n only bounds a full
+    resync; every incremental arrival is returned so none is skipped. The
+    cursor only moves once all of them were fetched; the worker records
+    arrivals in its queue instead (see worker.run_cycle).
+    """
+    delta = sync_history(n)
+    emails = fetch_messages([m["id"] for m in delta["added"]])
+    if len(emails) == len(delta["added"]):
+        set_history_id(delta["history_id"])
+    return emails
@@ -0,0 +1,178 @@
+# agent/gmail_async.py
+
+"""
+Non-blocking Gmail calls for the FastAPI routes, made with httpx against the
+REST API directly. They share credentials, parsing and the message cache
+with agent/gmail.py; only the transport differs.
+"""
+
+import asyncio
+
+import httpx
+
+from agent import gmail, metrics, mime
+from agent.message_cache import message_cache
+
+ASYNC_CONCURRENCY = 10     # concurrent per-message gets per request
+ASYNC_MAX_RETRIES = 3
+ASYNC_RETRY_BACKOFF = 0.5  # seconds, doubled on each retry
+
+_client = None
+_client_loop = None
+_inflight = {}             # (loop, message id, metadata_only) -> Future of the parsed message
+
+
+def _get_client():
+    """One pooled AsyncClient per event loop"""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            timeout=gmail.HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+        _client_loop = loop
+    return _client
+
+
+async def aclose():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _session():
+    """Credentials and API root. The first call reads token.json (or runs the OAuth flow), so not on the loop."""
+    if gmail._creds is None or gmail._discovery_doc is None:
+        return await asyncio.to_thread(lambda: (gmail.get_credentials(), gmail.api_root()))
+    return gmail.get_credentials(), gmail.api_root()
+
+
+async def _request(method, path, **kwargs):
+    """Authorized call to users/me/<path>; refreshes once on 401, retries 429/5xx"""
+    creds, root = await _session()
+    url = f"{root}gmail/v1/users/me/{path}"
+    client = _get_client()
+    refreshed = False
+
+    operation = gmail.operation_name(method, url)
+    for attempt in range(ASYNC_MAX_RETRIES + 1):
+        with metrics.span(f"gmail.{operation}", (metrics.gmail_seconds, {"operation": operation})) as span:
+            try:
+                resp = await client.request(method, url, headers={"Authorization": f"Bearer {creds.token}"}, **kwargs)
+            except httpx.HTTPError as e:
+                metrics.gmail_errors.inc(operation=operation, status=type(e).__name__)
+                raise
+            span.set(status=resp.status_code)
+        if resp.status_code >= 400:
+            metrics.gmail_errors.inc(operation=operation, status=resp.status_code)
+        if resp.status_code == 401 and not refreshed:
+            creds = await asyncio.to_thread(gmail.refresh_credentials_now)
+            refreshed = True
+            continue
+        if resp.status_code in gmail.BATCH_RETRY_STATUSES and attempt < ASYNC_MAX_RETRIES:
+            await asyncio.sleep(ASYNC_RETRY_BACKOFF * 2 ** attempt)
+            continue
+        resp.raise_for_status()
+        return resp.json()
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def _inline_attachments(raw_messages):
+    """
+    Fetch the text parts Gmail left out of the payloads (body.attachmentId)
+    and put their data in place, so parsing never blocks on the network.
+    """
+    async def inline(raw):
+        part = mime.select_text_part(raw["payload"])
+        body = (part or {}).get("body") or {}
+        if body.get("attachmentId") and not body.get("data"):
+            try:
+                attachment = await _request("GET", f"messages/{raw['id']}/attachments/{body['attachmentId']}")
+                body["data"] = attachment.get("data", "")
+            except httpx.HTTPError as e:
+                print(f"Gmail attachment for {raw['id']} failed:", e)
+
+    await asyncio.gather(*(inline(raw) for raw in raw_messages))
+    return raw_messages
+
+
+async def _fetch_missing(message_ids, metadata_only):
+    """{id: parsed message} for ids that are not cached, from concurrent gets"""
+    params = {"format": "metadata", "metadataHeaders": gmail.LIST_HEADERS} if metadata_only else {"format": "full"}
+    semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+
+    async def get(msg_id):
+        async with semaphore:
+            try:
+                return await _request("GET", f"messages/{msg_id}", params=params)
+            except httpx.HTTPError as e:
+                print(f"Gmail get {msg_id} failed:", e)
+                return None
+
+    fetched = [raw for raw in await asyncio.gather(*(get(m) for m in message_ids)) if raw]
+    if metadata_only:
+        parsed = [gmail._parse_message(raw) for raw in fetched]
+    else:
+        raw_messages = await _inline_attachments(fetched)
+        parsed = await asyncio.to_thread(gmail._parse_and_cache, raw_messages, fetch_attachment=None)
+    return {msg["id"]: msg for msg in parsed}
+
+
+async def fetch_messages(message_ids, metadata_only=False):
+    """
+    Async twin of gmail.fetch_messages: cache first, then concurrent gets.
+    Cache reads and writes are SQLite calls, so they run in a worker thread.
+    Requests that want the same uncached message at once share one get.
+    """
+    found = await asyncio.to_thread(message_cache.get_many, message_ids)
+    missing = [msg_id for msg_id in dict.fromkeys(message_ids) if msg_id not in found]
+
+    if missing:
+        loop = asyncio.get_running_loop()
+        owned, shared = [], {}
+        for msg_id in missing:
+            key = (loop, msg_id, metadata_only)
+            if key in _inflight:
+                shared[msg_id] = _inflight[key]
+            else:
+                _inflight[key] = loop.create_future()
+                owned.append(msg_id)
+        fetched = {}
+        try:
+            if owned:
+                fetched = await _fetch_missing(owned, metadata_only)
+        finally:
+            for msg_id in owned:
+                future = _inflight.pop((loop, msg_id, metadata_only))
+                future.set_result(fetched.get(msg_id))  # None: failed, or this request gave up
+        found.update(fetched)
+        for msg_id, future in shared.items():
+            msg = await asyncio.shield(future)
+            if msg is not None:
+                found[msg_id] = msg
+
+    return [found[msg_id] for msg_id in message_ids if msg_id in found]
+
+
+async def fetch_emails(n=5, metadata_only=False):
+    """Async twin of gmail.fetch_emails"""
+    results = await _request("GET", "messages", params={"labelIds": ["UNREAD"], "maxResults": n})
+    ids = [msg["id"] for msg in results.get("messages", [])]
+    return await fetch_messages(ids, metadata_only=metadata_only)
+
+
+async def fetch_thread(thread_id: str):
+    """Async twin of gmail.fetch_thread"""
+    if not await asyncio.to_thread(message_cache.has_thread, thread_id):
+        thread = await _request("GET", f"threads/{thread_id}", params={"format": "full"})
+        raw_messages = await _inline_attachments(thread["messages"])
+        parsed = await asyncio.to_thread(gmail._parse_and_cache, raw_messages, fetch_attachment=None)
+        return [gmail._thread_entry(m) for m in parsed]
+
+    thread = await _request("GET", f"threads/{thread_id}", params={"format": "minimal"})
+    ids = [m["id"] for m in thread["messages"]]
+    return [gmail._thread_entry(m) for m in await fetch_messages(ids)]
+
@@ -0,0 +1,298 @@
+# agent/llm.py
+
+"""
+The one way the agent talks to OpenAI. Every chat completion goes through
+chat() / achat() / achat_stream(), and every embedding through embed();
+they share one pooled client and add:
+
+- RPM and TPM token buckets, so a backlog is paced instead of hitting 429s
+- retries with exponential backoff on 429, 5xx, timeouts and dropped
+  connections, honouring Retry-After; a 429 pauses every caller, not just
+  the one that got it
+- single-flight coalescing: identical requests already in flight share one
+  upstream call
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+from dotenv import load_dotenv
+
+from agent import metrics
+from agent.ratelimit import TokenBucket
+
+LLM_TIMEOUT = 60.0           # seconds per attempt
+LLM_MAX_RETRIES = 5
+LLM_BACKOFF_BASE = 1.0       # seconds; doubled per retry, with jitter
+LLM_BACKOFF_MAX = 60.0
+LLM_RPM = 500                # requests per minute (match the account's tier)
+LLM_TPM = 200_000            # tokens per minute
+LLM_BURST_SECONDS = 1.0      # bucket depth; providers enforce limits over short slices
+LLM_MAX_CONNECTIONS = 50
+COMPLETION_TOKEN_ESTIMATE = 300  # reserved per request until usage is known
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,  # includes APITimeoutError
+)
+
+load_dotenv()
+
+_lock = threading.Lock()
+_pause_until = 0.0           # monotonic time before which nobody calls upstream
+
+
+def _bucket(per_minute):
+    return TokenBucket(per_minute, per=60.0, capacity=max(1.0, per_minute * LLM_BURST_SECONDS / 60))
+
+
+_rpm = _bucket(LLM_RPM)
+_tpm = _bucket(LLM_TPM)
+_inflight = {}               # request key -> Future, for sync callers
+_ainflight = {}              # (loop, request key) -> Task, for async callers
+_async_clients = {}          # event loop -> AsyncOpenAI
+_stats = {"calls": 0, "coalesced": 0, "retries": 0, "rate_limited": 0, "failed": 0, "throttled_s": 0.0}
+
+
+def _http_limits():
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS)
+
+
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    timeout=LLM_TIMEOUT,
+    max_retries=0,  # retries happen here, where they can see the rate limits
+    http_client=openai.DefaultHttpxClient(limits=_http_limits()),
+)
+
+
+def _async_client():
+    """One AsyncOpenAI per event loop: its connection pool is bound to the loop"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        async_client = _async_clients.get(loop)
+        if async_client is None:
+            for old_loop in [l for l in _async_clients if l.is_closed()]:
+                del _async_clients[old_loop]
+            async_client = _async_clients[loop] = AsyncOpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                timeout=LLM_TIMEOUT,
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(limits=_http_limits()),
+            )
+    return async_client
+
+
+def configure(rpm=None, tpm=None):
+    """Replace the RPM/TPM buckets (e.g. after changing LLM_RPM / LLM_TPM)"""
+    global _rpm, _tpm
+    with _lock:
+        _rpm = _bucket(rpm or LLM_RPM)
+        _tpm = _bucket(tpm or LLM_TPM)
+
+
+def stats():
+    with _lock:
+        out = dict(_stats)
+    out["throttled_s"] = round(out["throttled_s"], 3)
+    return out
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def _request_key(kwargs):
+    payload = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _estimate_tokens(kwargs):
+    if "input" in kwargs:  # embeddings: no completion
+        return len(json.dumps(kwargs["input"])) // 4
+    prompt = json.dumps(kwargs.get("messages", [])) + json.dumps(kwargs.get("tools") or [])
+    return len(prompt) // 4 + (kwargs.get("max_tokens") or COMPLETION_TOKEN_ESTIMATE)
+
+
+def _settle_usage(estimate, response, model):
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        _tpm.adjust(usage.total_tokens - estimate)
+        metrics.llm_tokens.inc(usage.prompt_tokens, model=model, direction="in")
+        metrics.llm_tokens.inc(getattr(usage, "completion_tokens", 0) or 0, model=model, direction="out")
+
+
+@contextmanager
+def _instrumented(kwargs, kind):
+    """One upstream attempt as a span, with its latency and errors in metrics"""
+    model = kwargs.get("model", "")
+    try:
+        with metrics.span(f"llm.{kind}", (metrics.llm_seconds, {"model": model, "kind": kind}), model=model) as span:
+            yield span
+    except Exception as e:
+        metrics.llm_errors.inc(model=model, error=type(e).__name__)
+        raise
+
+
+def _retry_after(error):
+    """Seconds the server asked us to wait, if it said"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+def _backoff(attempt, error):
+    """Delay before retry `attempt`; a 429 also pauses every other caller"""
+    global _pause_until
+    delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        delay = max(retry_after, min(delay, LLM_BACKOFF_BASE))
+    _count("retries")
+    if isinstance(error, openai.RateLimitError):
+        _count("rate_limited")
+        with _lock:
+            _pause_until = max(_pause_until, time.monotonic() + delay)
+    return delay
+
+
+def _pause_remaining():
+    with _lock:
+        return _pause_until - time.monotonic()
+
+
+def _throttle(estimate):
+    start = time.monotonic()
+    while (wait := _pause_remaining()) > 0:
+        time.sleep(wait)
+    _rpm.acquire()
+    _tpm.acquire(estimate)
+    _count("throttled_s", time.monotonic() - start)
+
+
+async def _athrottle(estimate):
+    start = time.monotonic()
+    while (wait := _pause_remaining()) > 0:
+        await asyncio.sleep(wait)
+    await _rpm.acquire_async()
+    await _tpm.acquire_async(estimate)
+    _count("throttled_s", time.monotonic() - start)
+
+
+def _call(kwargs, kind="chat"):
+    estimate = _estimate_tokens(kwargs)
+    create = client.embeddings.create if kind == "embed" else client.chat.completions.create
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        _throttle(estimate)
+        _count("calls")
+        try:
+            with _instrumented(kwargs, kind):
+                response = create(**kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == LLM_MAX_RETRIES:
+                _count("failed")
+                raise
+            time.sleep(_backoff(attempt, e))
+            continue
+        _settle_usage(estimate, response, kwargs.get("model", ""))
+        return response
+
+
+async def _acall(kwargs):
+    estimate = _estimate_tokens(kwargs)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await _athrottle(estimate)
+        _count("calls")
+        try:
+            with _instrumented(kwargs, "stream" if kwargs.get("stream") else "chat"):
+                response = await _async_client().chat.completions.create(**kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == LLM_MAX_RETRIES:
+                _count("failed")
+                raise
+            await asyncio.sleep(_backoff(attempt, e))
+            continue
+        if not kwargs.get("stream"):
+            _settle_usage(estimate, response, kwargs.get("model", ""))
+        return response
+
+
+def chat(**kwargs):
+    """client.chat.completions.create(**kwargs), paced, retried and coalesced"""
+    key = _request_key(kwargs)
+    with _lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        _count("coalesced")
+        return future.result()
+
+    try:
+        response = _call(kwargs)
+        future.set_result(response)
+        return response
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+
+
+async def achat(**kwargs):
+    """Async chat(); waiters that give up do not cancel the shared call"""
+    key = (asyncio.get_running_loop(), _request_key(kwargs))
+    with _lock:
+        task = _ainflight.get(key)
+        leader = task is None
+        if leader:
+            task = _ainflight[key] = asyncio.ensure_future(_acall(kwargs))
+            task.add_done_callback(lambda _: _ainflight.pop(key, None))
+    if not leader:
+        _count("coalesced")
+    return await asyncio.shield(task)
+
+
+async def achat_stream(**kwargs):
+    """Open a streamed completion; retries cover opening it, not mid-stream drops"""
+    return await _acall(dict(kwargs, stream=True))
+
+
+def embed(texts, model, dimensions=None):
+    """Embedding vectors for texts from one request, paced and retried like chat()"""
+    kwargs = {"model": model, "input": list(texts)}
+    if dimensions:
+        kwargs["dimensions"] = dimensions
+    response = _call(kwargs, kind="embed")
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
@@ -1,10 +1,9 @@
 # agent/llm_agent.py
 
-import os
 import json
-import sqlite3
-from dotenv import load_dotenv
-from openai import OpenAI
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from agent.functions import (
     generate_reply,
@@ -13,55 +12,61 @@ from agent.functions import (
     add_to_todo,
 )
 
-from agent.gmail import fetch_thread, send_email, mark_as_read
+from agent.gmail import fetch_messages, fetch_thread_ids, mark_as_read, label_buffer
+from agent.ratelimit import TokenBucket
+from agent import llm, metrics, outbox, prompts, storage, vectors
+from agent.classifier import preclassify
 
 # Settings
 AUTO_SEND = True          # flip to True to actually send emails
+SINGLE_PASS = False       # one structured call decides, drafts and updates the summary
 SUMMARY_SENTENCE_MAX = 4   # max sentences in thread summary
-
-
-# Init
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-DB_PATH = "assistant.db"
-
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS threads (
-            thread_id TEXT PRIMARY KEY,
-            summary TEXT,
-            last_action TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
+SUMMARY_COMPACT_EVERY = 20 # re-summarize the whole thread after this many folded messages
+PROCESS_CONCURRENCY = 4    # threads processed in parallel by process_emails
+PROCESS_RATE_PER_MIN = 60  # emails started per minute across workers (None = unlimited)
+PRECLASSIFY = True         # skip the LLM for emails the local classifier is sure need no action
 
 
 def get_thread_memory(thread_id: str):
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT summary, last_action FROM threads WHERE thread_id=?", (thread_id,))
-    row = cur.fetchone()
-    conn.close()
+    storage.write_buffer.flush_key(("threads", thread_id))
+    row = storage.query_one("SELECT summary, last_action FROM threads WHERE thread_id=?", (thread_id,))
     return row if row else (None, None)
 
 
-def update_thread_memory(thread_id: str, summary: str, last_action: str):
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO threads (thread_id, summary, last_action)
-        VALUES (?, ?, ?)
-        ON CONFLICT(thread_id) DO UPDATE SET summary=?, last_action=?
-    """, (thread_id, summary, last_action, summary, last_action))
-    conn.commit()
-    conn.close()
+def get_thread_memories(thread_ids):
+    """{thread_id: (summary, last_action)} for many threads, one query per 500 ids"""
+    thread_ids = list(dict.fromkeys(thread_ids))
+    storage.write_buffer.flush_keys(("threads", t) for t in thread_ids)
+    found = {}
+    for i in range(0, len(thread_ids), 500):
+        chunk = thread_ids[i:i + 500]
+        found.update((row[0], row[1:]) for row in storage.query_all(
+            f"SELECT thread_id, summary, last_action FROM threads WHERE thread_id IN ({','.join('?' * len(chunk))})",
+            chunk,
+        ))
+    return {t: found.get(t, (None, None)) for t in thread_ids}
+
+
+def get_thread_state(thread_id: str):
+    """(summary, last_action, last_message_id, folded_count) for a thread"""
+    storage.write_buffer.flush_key(("threads", thread_id))
+    row = storage.query_one(
+        "SELECT summary, last_action, last_message_id, folded_count FROM threads WHERE thread_id=?",
+        (thread_id,),
+    )
+    return (row[0], row[1], row[2], row[3] or 0) if row else (None, None, None, 0)
+
+
+def update_thread_memory(thread_id: str, summary: str, last_action: str, last_message_id=None, folded_count=0):
+    storage.write("""
+        INSERT INTO threads (thread_id, summary, last_action, last_message_id, folded_count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(thread_id) DO UPDATE SET
+            summary=excluded.summary,
+            last_action=excluded.last_action,
+            last_message_id=excluded.last_message_id,
+            folded_count=excluded.folded_count
+    """, (thread_id, summary, last_action, last_message_id, folded_count), key=("threads", thread_id))
 
 #  Tools Schema
 
@@ -129,36 +134,52 @@ FUNCTIONS = [
     },
 ]
 
-def decide_action(email):
-    """
-    Decides the next function call (if any) using GPT-4 function calling.
-    Includes past thread memory if present.
-    """
-    thread_id = email["threadId"]
-    previous_summary, previous_action = get_thread_memory(thread_id)
+RELATED_PROMPT = "Related past conversations (context only; they may not apply):\n{}\n"
+
+
+def _related_prompt(call, fixed, related):
+    lines = prompts.fit_lines(call, fixed, related)
+    return RELATED_PROMPT.format(lines) if lines else ""
+
 
+def _decide_messages(email, previous_summary, previous_action, related=()):
     system_prompt = (
         "You are an autonomous email assistant. Based on the user's email you should "
         "decide which function to call. Only respond with a function call in JSON. "
     )
+    memory_prompt = (
+        "Here is the previous conversation summary: {}. "
+        f"Last action taken was: {previous_action}. "
+        "Only act if new email requires a new action."
+    )
+    user_prompt = f"Email from: {email['from']}\nBody: "
+    system_prompt += _related_prompt("decide_action", system_prompt + user_prompt, related)
 
+    fixed = system_prompt + user_prompt + (memory_prompt.format("") if previous_summary else "")
+    previous_summary, body = prompts.fit("decide_action", fixed, email["body"], previous_summary)
     if previous_summary:
-        system_prompt += (
-            f"Here is the previous conversation summary: {previous_summary}. "
-            f"Last action taken was: {previous_action}. "
-            "Only act if new email requires a new action."
-        )
+        system_prompt += memory_prompt.format(previous_summary)
 
     messages = [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": f"Email from: {email['from']}\n"
-                                    # f"Subject: {email['subject']}\n" # Only the latest incoming message body is passed to GPT for deciding next action
-                                    f"Body: {email['body']}"},
+        # Only the latest incoming message body is passed to GPT for deciding next action
+        {"role": "user", "content": user_prompt + body},
     ]
+    prompts.record("decide_action", messages)
+    return messages
+
+
+def decide_action(email):
+    """
+    Decides the next function call (if any) using GPT-4 function calling.
+    Includes past thread memory if present.
+    """
+    thread_id = email["threadId"]
+    previous_summary, previous_action = get_thread_memory(thread_id)
 
-    response = client.chat.completions.create(
+    response = llm.chat(
         model="gpt-4o-mini",
-        messages=messages,
+        messages=_decide_messages(email, previous_summary, previous_action, vectors.related_context(email)),
         tools=FUNCTIONS,
         tool_choice="auto",
     )
@@ -170,7 +191,15 @@ def decide_action(email):
     tool_call = message.tool_calls[0]
     fn_name = tool_call.function.name
     arguments = json.loads(tool_call.function.arguments)
+    return run_action(email, fn_name, arguments)
 
+
+def run_action(email, fn_name, arguments, precomputed=None):
+    """
+    Execute the chosen tool for an email and mark it read.
+    precomputed carries a reply/summary already produced by the model (single-pass
+    mode), in which case no second completion is made.
+    """
     # Fill in missing parameters
     if fn_name == "generate_reply":
         arguments.setdefault("email_text", email.get("body", ""))
@@ -186,13 +215,15 @@ def decide_action(email):
         arguments.setdefault("due_date", "")
 
     if fn_name == "generate_reply":
-        reply = generate_reply(**arguments)
+        reply = precomputed or generate_reply(**arguments)
         if AUTO_SEND:
-            send_email(to=email["from"], subject=f"Re: {email['subject']}", body=reply)
-            print("Sent email.")
+            # The outbox sender delivers it; the same reply to this email is only sent once
+            entry = outbox.enqueue_reply(email, reply)
+            print("Reply already queued." if entry["duplicate"] else "Reply queued.")
         print("[Draft reply]\n", reply)
         mark_as_read(email["id"])
-        return "reply_sent", reply
+        # Sent only once the outbox delivers it (outbox state "sent")
+        return ("reply_queued" if AUTO_SEND else "reply_drafted"), reply
 
     elif fn_name == "schedule_meeting":
         out = schedule_meeting(**arguments)
@@ -200,7 +231,7 @@ def decide_action(email):
         return "scheduled_meeting", str(out)
 
     elif fn_name == "summarize_email":
-        s = summarize_email(**arguments)
+        s = precomputed or summarize_email(**arguments)
         mark_as_read(email["id"])
         return "summarized", s
 
@@ -212,40 +243,324 @@ def decide_action(email):
     return "no_action", None
 
 
+SINGLE_PASS_ACTIONS = ["generate_reply", "schedule_meeting", "summarize_email", "add_to_todo", "no_action"]
+
+# Flat on purpose: strict structured outputs need every field present, so
+# fields that don't apply to the chosen action come back as "".
+SINGLE_PASS_SCHEMA = {
+    "name": "email_decision",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "action": {"type": "string", "enum": SINGLE_PASS_ACTIONS},
+            "reply": {"type": "string"},
+            "email_summary": {"type": "string"},
+            "meeting_datetime": {"type": "string"},
+            "meeting_topic": {"type": "string"},
+            "meeting_attendees": {"type": "string"},
+            "task": {"type": "string"},
+            "due_date": {"type": "string"},
+            "thread_summary": {"type": "string"},
+        },
+        "required": [
+            "action", "reply", "email_summary", "meeting_datetime", "meeting_topic",
+            "meeting_attendees", "task", "due_date", "thread_summary",
+        ],
+        "additionalProperties": False,
+    },
+}
+
+
+def decide_action_single_pass(email, max_sentences=SUMMARY_SENTENCE_MAX):
+    """
+    One structured-output call that picks the action, fills its arguments,
+    drafts the reply/summary, and folds the new email into the stored thread
+    summary. Returns (action_taken, agent_output, thread_summary).
+    """
+    previous_summary, previous_action = get_thread_memory(email["threadId"])
+
+    system_prompt = (
+        "You are an autonomous email assistant acting on behalf of Saral. Decide the single best "
+        "action for the new email and answer in JSON matching the schema. "
+        "For generate_reply, write `reply`: a short, professional 2-5 sentence reply as Saral, addressing "
+        "the sender by name, without a subject line. For summarize_email, write `email_summary`. "
+        "For schedule_meeting, fill the meeting_* fields; for add_to_todo, fill `task` and `due_date`. "
+        "Leave fields that don't apply empty. Choose no_action if the email needs nothing new. "
+        f"Always write `thread_summary`: the previous summary updated with the new email, in at most {max_sentences} sentences."
+    )
+    memory_prompt = (
+        "Previous conversation summary: {}\nLast action taken: " + f"{previous_action}\n\n"
+        if previous_summary else "No previous conversation.\n\n"
+    )
+    user_prompt = f"Email from: {email['from']}\nBody: "
+    fixed = system_prompt + memory_prompt.format("") + user_prompt
+    system_prompt += _related_prompt("decide_action_single_pass", fixed, vectors.related_context(email))
+    fixed = system_prompt + memory_prompt.format("") + user_prompt
+    memory, body = prompts.fit("decide_action_single_pass", fixed, email["body"], previous_summary)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": memory_prompt.format(memory) + user_prompt + body},
+    ]
+    prompts.record("decide_action_single_pass", messages)
+
+    response = llm.chat(
+        model="gpt-4o-mini",
+        messages=messages,
+        response_format={"type": "json_schema", "json_schema": SINGLE_PASS_SCHEMA},
+    )
+    decision = json.loads(response.choices[0].message.content)
+    fn_name = decision["action"]
+    thread_summary = decision["thread_summary"] or previous_summary
+
+    if fn_name == "generate_reply":
+        action_taken, output = run_action(email, fn_name, {}, precomputed=decision["reply"])
+    elif fn_name == "schedule_meeting":
+        action_taken, output = run_action(email, fn_name, {
+            "datetime": decision["meeting_datetime"],
+            "topic": decision["meeting_topic"],
+            "attendees": decision["meeting_attendees"],
+        })
+    elif fn_name == "summarize_email":
+        action_taken, output = run_action(email, fn_name, {}, precomputed=decision["email_summary"])
+    elif fn_name == "add_to_todo":
+        action_taken, output = run_action(email, fn_name, {"task": decision["task"], "due_date": decision["due_date"]})
+    else:
+        action_taken, output = "no_action", None
+
+    return action_taken, output, thread_summary
+
+
+def _thread_summary_messages(full_thread_messages, max_sentences):
+    system_prompt = f"Summarize this conversation in at most {max_sentences} sentences."
+    _, thread_text = prompts.fit_thread("thread_summary", system_prompt, full_thread_messages)
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": thread_text},
+    ]
+    prompts.record("thread_summary", messages)
+    return messages
+
+
 def get_new_thread_summary(full_thread_messages, max_sentences=4):
     """
     GPT call to compress entire conversation thread into N sentences.
     """
-    thread_text = "\n\n".join(
-        [f"From: {m['from']}\n{m['body']}" for m in full_thread_messages]
+    completion = llm.chat(
+        model="gpt-4o-mini",
+        messages=_thread_summary_messages(full_thread_messages, max_sentences)
+    )
+    return completion.choices[0].message.content.strip()
+
+
+def _fold_messages(previous_summary, new_messages, max_sentences):
+    system_prompt = (
+        "Update the conversation summary with the new messages. "
+        f"Keep it to at most {max_sentences} sentences."
+    )
+    user_prompt = "Current summary: {}\n\nNew messages:\n\n{}"
+    previous_summary, new_text = prompts.fit_thread(
+        "fold_summary", system_prompt + user_prompt, new_messages, previous_summary
     )
 
     messages = [
-        {"role": "system", "content": f"Summarize this conversation in at most {max_sentences} sentences."},
-        {"role": "user", "content": thread_text},
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt.format(previous_summary, new_text)},
     ]
-    completion = client.chat.completions.create(
+    prompts.record("fold_summary", messages)
+    return messages
+
+
+def fold_into_summary(previous_summary, new_messages, max_sentences=4):
+    """
+    GPT call to update an existing thread summary with only the new messages.
+    """
+    completion = llm.chat(
         model="gpt-4o-mini",
-        messages=messages
+        messages=_fold_messages(previous_summary, new_messages, max_sentences)
     )
     return completion.choices[0].message.content.strip()
 
 
-def process_emails(emails):
-    for email in emails:
-        thread_id = email["threadId"]
+def compact_thread_summary(thread_id, max_sentences=SUMMARY_SENTENCE_MAX, ids=None):
+    """Re-summarize the whole thread. Returns (summary, last_message_id, folded_count)"""
+    ids = ids if ids is not None else fetch_thread_ids(thread_id)
+    full_thread = fetch_messages(ids)
+    return get_new_thread_summary(full_thread, max_sentences), (ids[-1] if ids else None), 0
 
-        print("\n--- New Email ---")
-        print("From:", email["from"])
-        print("Subject:", email["subject"])
 
-        action_taken, agent_output = decide_action(email)
-        print("Action:", action_taken)
+def roll_thread_summary(thread_id, max_sentences=SUMMARY_SENTENCE_MAX):
+    """
+    Fold only the messages after the last summarized one into the stored
+    summary, fetching just that tail. Falls back to a full re-summary when
+    there is nothing to build on or SUMMARY_COMPACT_EVERY messages have been
+    folded since the last one. Returns (summary, last_message_id, folded_count).
+    """
+    summary, _, last_id, folded = get_thread_state(thread_id)
+    ids = fetch_thread_ids(thread_id)
+
+    if not summary or last_id not in ids or folded >= SUMMARY_COMPACT_EVERY:
+        return compact_thread_summary(thread_id, max_sentences, ids)
+
+    tail_ids = ids[ids.index(last_id) + 1:]
+    if tail_ids:
+        summary = fold_into_summary(summary, fetch_messages(tail_ids), max_sentences)
+    return summary, ids[-1], folded + len(tail_ids)
+
 
+def _step(name):
+    return metrics.span(name, (metrics.step_seconds, {"step": name}))
+
+
+def process_email(email, preclassified=None):
+    """
+    Run the agent on one email: decide, act, and refresh thread memory.
+    preclassified is preclassify()'s answer if the caller already asked.
+    """
+    action = "error"
+    span = None
+    try:
+        with metrics.span("process_email", email_id=email["id"], thread_id=email["threadId"]) as span:
+            action = _process_email(email, preclassified)
+            span.set(action=action)
+    finally:
+        metrics.email_seconds.observe(span.duration if span else 0.0, action=action)
+        metrics.actions.inc(action=action)
+    return action
+
+
+def _process_email(email, preclassified=None):
+    thread_id = email["threadId"]
+
+    print("\n--- New Email ---")
+    print("From:", email["from"])
+    print("Subject:", email["subject"])
+
+    # Only brand-new threads: a reply in a conversation the agent is part of is never bulk mail
+    if PRECLASSIFY and not get_thread_memory(thread_id)[0]:
+        if preclassified is None:
+            with _step("preclassify"):
+                preclassified = preclassify(email)
+        skip, reason = preclassified
+        if skip:
+            print(f"Pre-classified as no action ({reason}), LLM skipped")
+            return "prefiltered"
+
+    if SINGLE_PASS:
+        with _step("decide_and_act"):
+            action_taken, agent_output, summary = decide_action_single_pass(email)
+        print("Action:", action_taken)
         if action_taken != "no_action":
-            full_thread = fetch_thread(thread_id)
-            summary = get_new_thread_summary(full_thread, SUMMARY_SENTENCE_MAX)
-            update_thread_memory(thread_id, summary, action_taken)
+            # The model already folded this email into the summary
+            with _step("thread_memory"):
+                folded = get_thread_state(thread_id)[3] + 1
+                last_id = email["id"]
+                if folded >= SUMMARY_COMPACT_EVERY:
+                    summary, last_id, folded = compact_thread_summary(thread_id)
+                update_thread_memory(thread_id, summary, action_taken, last_id, folded)
             print("Memory updated:", summary)
         else:
             print("No action needed. (Possibly redundant message)")
+        return action_taken
+
+    with _step("decide_and_act"):
+        action_taken, agent_output = decide_action(email)
+    print("Action:", action_taken)
+
+    if action_taken != "no_action":
+        with _step("thread_memory"):
+            summary, last_id, folded = roll_thread_summary(thread_id, SUMMARY_SENTENCE_MAX)
+            update_thread_memory(thread_id, summary, action_taken, last_id, folded)
+        print("Memory updated:", summary)
+    else:
+        print("No action needed. (Possibly redundant message)")
+
+    return action_taken
+
+
+def draft_candidates(emails):
+    """
+    The emails worth drafting a reply for ahead of time: none while
+    AUTO_SEND answers mail itself, and none the pre-classifier would skip.
+    """
+    if AUTO_SEND:
+        return []
+    if not PRECLASSIFY:
+        return list(emails)
+    memories = get_thread_memories([e["threadId"] for e in emails])
+    return [e for e in emails if memories[e["threadId"]][0] or not preclassify(e, record=False)[0]]
+
+
+def process_emails(emails, concurrency=None, rate_per_min=None):
+    """
+    Process emails with up to `concurrency` threads in flight at once.
+    Emails of the same thread run in order on one worker, since each step
+    reads the memory the previous one wrote. Returns [{id, threadId, action}]
+    in input order; an email that raises is reported as "error".
+    """
+    concurrency = concurrency or PROCESS_CONCURRENCY
+    rate_per_min = rate_per_min if rate_per_min is not None else PROCESS_RATE_PER_MIN
+    limiter = TokenBucket(rate_per_min, per=60.0, capacity=concurrency) if rate_per_min else None
+
+    by_thread = OrderedDict()
+    for email in emails:
+        by_thread.setdefault(email["threadId"], []).append(email)
+
+    actions = {}
+    preclassified = {}
+
+    def run_thread(thread_emails):
+        for email in thread_emails:
+            if limiter:
+                limiter.acquire()
+            try:
+                actions[email["id"]] = process_email(email, preclassified.get(email["id"]))
+            except Exception as e:
+                print(f"Failed to process {email['id']}:", e)
+                actions[email["id"]] = "error"
+
+    # Pre-classify new threads up front, so bulk mail is never embedded or searched.
+    # Like _process_email: once one email goes to the LLM its thread has memory.
+    if PRECLASSIFY:
+        for thread_id, thread_emails in by_thread.items():
+            if get_thread_memory(thread_id)[0]:
+                continue
+            for email in thread_emails:
+                with _step("preclassify"):
+                    preclassified[email["id"]] = preclassify(email)
+                if not preclassified[email["id"]][0]:
+                    break
+    to_llm = [e for e in emails if not preclassified.get(e["id"], (False, ""))[0]]
+
+    try:
+        # One batched embedding pass and one batched search up front, for related_context()
+        vectors.index_emails(to_llm)
+        vectors.prefetch_related(to_llm)
+
+        # Memory, todo and meeting writes from the whole run go out in batches
+        with storage.batched_writes():
+            if concurrency == 1 or len(by_thread) <= 1:
+                for thread_emails in by_thread.values():
+                    run_thread(thread_emails)
+            else:
+                # Each task runs in a copy of this context, so its writes join the batch
+                contexts = [contextvars.copy_context() for _ in by_thread]
+                with ThreadPoolExecutor(max_workers=min(concurrency, len(by_thread))) as pool:
+                    list(pool.map(lambda ctx, thread_emails: ctx.run(run_thread, thread_emails),
+                                  contexts, by_thread.values()))
+
+        # Mark-as-read changes from the run go out in a few batchModify calls, before
+        # the next poll lists unread mail again
+        label_buffer.flush()
+
+        # The summaries written above become retrievable for later emails
+        vectors.index_threads(list(by_thread))
+    finally:
+        # Lookups left unused by emails that failed before deciding
+        vectors.discard_prefetched([e["id"] for e in emails])
+
+    return [
+        {"id": e["id"], "threadId": e["threadId"], "action": actions.get(e["id"], "error")}
+        for e in emails
+    ]
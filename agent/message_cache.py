@@ -0,0 +1,140 @@
+# agent/message_cache.py
+
+import json
+import threading
+from collections import OrderedDict
+
+from agent import storage
+
+MEMORY_CACHE_SIZE = 1000   # parsed messages kept in the in-memory LRU
+SQL_CHUNK = 500            # stay well under SQLite's bound-parameter limit
+
+
+class MessageCache:
+    """
+    Parsed Gmail messages keyed by message id: an in-memory LRU in front of
+    the `messages` table in assistant.db. Gmail messages never change apart
+    from their labels, so entries are never refreshed, only relabelled.
+    """
+
+    def __init__(self, capacity=MEMORY_CACHE_SIZE):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _remember(self, msg):
+        self.memory[msg["id"]] = msg
+        self.memory.move_to_end(msg["id"])
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get_many(self, message_ids):
+        """Return {id: message} for the ids that are cached"""
+        found, missing = {}, []
+        with self.lock:
+            for msg_id in message_ids:
+                msg = self.memory.get(msg_id)
+                if msg is None:
+                    missing.append(msg_id)
+                else:
+                    self.memory.move_to_end(msg_id)
+                    found[msg_id] = dict(msg)
+            self.hits += len(found)
+
+        if missing:
+            for i in range(0, len(missing), SQL_CHUNK):
+                chunk = missing[i:i + SQL_CHUNK]
+                rows = storage.query_all(
+                    "SELECT message_id, thread_id, sender, subject, body, headers FROM messages "
+                    f"WHERE message_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                for msg_id, thread_id, sender, subject, body, headers in rows:
+                    found[msg_id] = {
+                        "id": msg_id, "threadId": thread_id, "from": sender, "subject": subject, "body": body,
+                        "headers": json.loads(headers or "{}"),
+                    }
+
+            with self.lock:
+                disk = [msg_id for msg_id in missing if msg_id in found]
+                for msg_id in disk:
+                    self._remember(dict(found[msg_id]))
+                self.hits += len(disk)
+                self.disk_hits += len(disk)
+                self.misses += len(missing) - len(disk)
+
+        return found
+
+    def put_many(self, messages):
+        """Store parsed messages; each may carry its Gmail labelIds"""
+        if not messages:
+            return
+        with storage.transaction() as conn:
+            conn.executemany(
+                """
+                INSERT INTO messages (message_id, thread_id, sender, subject, body, label_ids, headers)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(message_id) DO UPDATE SET label_ids=excluded.label_ids, headers=excluded.headers
+                """,
+                [
+                    (m["id"], m["threadId"], m["from"], m["subject"], m["body"],
+                     json.dumps(m.get("labelIds", [])), json.dumps(m.get("headers", {})))
+                    for m in messages
+                ],
+            )
+        with self.lock:
+            for m in messages:
+                msg = {k: m[k] for k in ("id", "threadId", "from", "subject", "body")}
+                msg["headers"] = m.get("headers", {})
+                self._remember(msg)
+
+    def has_thread(self, thread_id):
+        return storage.query_one("SELECT 1 FROM messages WHERE thread_id=? LIMIT 1", (thread_id,)) is not None
+
+    def update_labels(self, message_id, add=(), remove=()):
+        self.update_labels_many([message_id], add=add, remove=remove)
+
+    def update_labels_many(self, message_ids, add=(), remove=()):
+        """Apply the same label change to many cached messages in one transaction"""
+        if not message_ids:
+            return
+        with storage.transaction() as conn:
+            for i in range(0, len(message_ids), SQL_CHUNK):
+                chunk = message_ids[i:i + SQL_CHUNK]
+                rows = conn.execute(
+                    f"SELECT message_id, label_ids FROM messages WHERE message_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                updates = []
+                for msg_id, label_ids in rows:
+                    labels = [l for l in json.loads(label_ids or "[]") if l not in remove]
+                    labels += [l for l in add if l not in labels]
+                    updates.append((json.dumps(labels), msg_id))
+                conn.executemany("UPDATE messages SET label_ids=? WHERE message_id=?", updates)
+
+    def delete(self, message_ids):
+        if not message_ids:
+            return
+        with storage.transaction() as conn:
+            conn.executemany("DELETE FROM messages WHERE message_id=?", [(m,) for m in message_ids])
+        with self.lock:
+            for msg_id in message_ids:
+                self.memory.pop(msg_id, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "memory_hits": self.hits - self.disk_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self.memory),
+            }
+
+
+message_cache = MessageCache()
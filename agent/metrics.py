@@ -0,0 +1,268 @@
+# agent/metrics.py
+
+"""
+Counters, latency histograms and trace spans for the agent pipeline.
+
+Metrics are rendered in the Prometheus text format by render() (served at
+/metrics). span() times a step, observes it in a histogram and nests it in
+the current trace; the last TRACE_HISTORY finished traces (one per
+processed email) are kept for /traces. When OTEL_EXPORTER_OTLP_ENDPOINT is
+set and the OpenTelemetry SDK is installed, spans are exported there too.
+"""
+
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+TRACE_HISTORY = 200          # finished traces kept in memory for /traces
+OTEL_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")  # set to export spans with OpenTelemetry
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "email-agent")
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+            lines += self._render_items(items)
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _render_items(self, items):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_number(v)}" for key, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_items(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _format_labels(self.labels, key, [f'le="{_format_number(float(bound))}"'])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _format_labels(self.labels, key, ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_number(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# Pipeline metrics
+
+gmail_seconds = Histogram("agent_gmail_request_seconds", "Gmail API call latency", ["operation"])
+gmail_errors = Counter("agent_gmail_errors_total", "Gmail API calls that failed", ["operation", "status"])
+llm_seconds = Histogram("agent_llm_request_seconds", "OpenAI completion latency per attempt", ["model", "kind"])
+llm_tokens = Counter("agent_llm_tokens_total", "OpenAI tokens by direction", ["model", "direction"])
+llm_errors = Counter("agent_llm_errors_total", "OpenAI attempts that failed", ["model", "error"])
+db_seconds = Histogram("agent_db_operation_seconds", "SQLite operation latency", ["operation"], buckets=DB_BUCKETS)
+db_errors = Counter("agent_db_errors_total", "SQLite operations that failed", ["operation"])
+email_seconds = Histogram("agent_email_seconds", "Time to process one email end to end", ["action"])
+actions = Counter("agent_actions_total", "Actions taken on processed emails", ["action"])
+http_seconds = Histogram("agent_http_request_seconds", "API request latency (streams: until headers)",
+                         ["route", "method", "status"])
+step_seconds = Histogram("agent_step_seconds", "Pipeline steps inside process_email", ["step"])
+outbox_sends = Counter("agent_outbox_sends_total", "Outbox send attempts by result", ["result"])
+
+
+# Tracing
+
+_current = contextvars.ContextVar("agent_span", default=None)
+_traces = deque(maxlen=TRACE_HISTORY)
+_traces_lock = threading.Lock()
+_otel_tracer = None
+_otel_loaded = False
+
+
+def _get_otel_tracer():
+    """OpenTelemetry tracer exporting over OTLP/HTTP, or None"""
+    global _otel_tracer, _otel_loaded
+    if _otel_loaded:
+        return _otel_tracer
+    with _traces_lock:
+        if _otel_loaded:
+            return _otel_tracer
+        _otel_tracer = _make_otel_tracer() if OTEL_ENDPOINT else None
+        _otel_loaded = True
+    return _otel_tracer
+
+
+def _make_otel_tracer():
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError as e:
+        print("OTEL_EXPORTER_OTLP_ENDPOINT is set but OpenTelemetry is not installed:", e)
+        return None
+    provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    return provider.get_tracer("agent")
+
+
+class Span:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.db_seconds = 0.0
+        self.children = []
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        out = {
+            "name": self.name,
+            "start": round(self.start, 3),
+            "duration_ms": round((self.duration or 0.0) * 1000, 2),
+            "attributes": self.attributes,
+        }
+        if self.db_seconds:
+            out["db_ms"] = round(self.db_seconds * 1000, 2)
+        if self.error:
+            out["error"] = self.error
+        if self.children:
+            out["children"] = [child.to_dict() for child in self.children]
+        return out
+
+
+@contextmanager
+def span(name, histogram=None, **attributes):
+    """
+    Time a step as a span in the current trace (a new trace if there is
+    none). histogram=(Histogram, labels) also observes the duration there.
+    """
+    parent = _current.get()
+    current = Span(name, attributes)
+    token = _current.set(current)
+    tracer = _get_otel_tracer()
+    otel = tracer.start_as_current_span(name, attributes=attributes) if tracer else None
+    otel_span = otel.__enter__() if otel else None
+    start = time.perf_counter()
+    exc_info = (None, None, None)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        exc_info = (type(e), e, e.__traceback__)
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _current.reset(token)
+        if histogram is not None:
+            histogram[0].observe(current.duration, **histogram[1])
+        if otel:
+            otel_span.set_attributes({k: str(v) for k, v in current.attributes.items()})
+            if current.db_seconds:
+                otel_span.set_attribute("db_ms", round(current.db_seconds * 1000, 2))
+            otel.__exit__(*exc_info)
+        if parent is not None:
+            parent.children.append(current)
+            parent.db_seconds += current.db_seconds
+        elif name == "process_email" or current.children:
+            with _traces_lock:
+                _traces.append(current)
+
+
+def current_span():
+    return _current.get()
+
+
+def observe_db(operation, seconds):
+    """DB operations are too many for spans: they add up on the current one"""
+    db_seconds.observe(seconds, operation=operation)
+    current = _current.get()
+    if current is not None:
+        current.db_seconds += seconds
+
+
+def recent_traces(limit=50):
+    with _traces_lock:
+        traces = list(_traces)[-limit:]
+    return [t.to_dict() for t in reversed(traces)]
@@ -0,0 +1,339 @@
+# agent/outbox.py
+
+"""
+Outgoing mail. Replies are queued in the outbox table and sent by a
+background thread, so neither the agent loop nor /send_reply waits on
+Gmail.
+
+An entry's id is its idempotency key: the email it answers plus a hash
+of the reply, so a double-click or a retried step queues the same reply
+once. Sends run SEND_CONCURRENCY at a time, paced to SENDS_PER_MIN and
+capped at SENDS_PER_DAY (Gmail allows a user roughly 2.5 sends a second
+and, on consumer accounts, 500 recipients a day). Failures with a
+retryable status are retried with exponential backoff up to
+SEND_MAX_ATTEMPTS; anything else is parked as "dead" with its error.
+
+A send that ends without an answer (a connection error or timeout, or a
+process that stopped mid-send) may still have reached Gmail, so the entry
+is marked maybe_sent. Before it is tried again the sender looks in the
+thread for the reply; an entry it cannot check that way is parked as
+"review" rather than risk sending it twice.
+"""
+
+import time
+import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+
+from agent import gmail, metrics, storage
+from agent.drafts import mark_sent
+from agent.message_cache import message_cache
+from agent.ratelimit import TokenBucket
+
+SEND_CONCURRENCY = 2          # messages.send calls in flight
+SENDS_PER_MIN = 60
+SENDS_PER_DAY = 500
+SEND_MAX_ATTEMPTS = 6         # tries before an entry is parked as "dead"
+SEND_RETRY_BASE_DELAY = 5     # seconds; doubled per failed attempt
+SEND_RETRY_MAX_DELAY = 15 * 60
+SEND_CLAIM_BATCH = 20         # entries claimed per pass
+SEND_CLAIM_TIMEOUT = 15 * 60  # seconds before a 'sending' claim counts as abandoned
+SEND_POLL_INTERVAL = 60       # re-check for due retries when nothing wakes the sender
+SEND_DRAIN_TIMEOUT = 120      # seconds drain() keeps retrying before giving up
+SEND_RETRY_STATUSES = gmail.BATCH_RETRY_STATUSES
+
+COLUMNS = ["outbox_id", "source_message_id", "thread_id", "to_addr", "subject", "body", "in_reply_to", "refs",
+           "state", "attempts", "next_attempt_at", "gmail_id", "last_error", "created_at", "sent_at", "maybe_sent"]
+
+
+def outbox_key(to, subject, body, source_message_id=None):
+    """Idempotency key: the answered email and the reply, or the whole message"""
+    digest = hashlib.sha256(body.encode("utf-8")).hexdigest()
+    if source_message_id:
+        key = f"{source_message_id}\0{digest}"
+    else:
+        key = f"{to}\0{subject}\0{digest}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def enqueue(to, subject, body, source_message_id=None, thread_id=None, headers=None):
+    """
+    Queue a message and wake the sender. headers are the answered email's
+    (lower-cased, as parsed); without them the cached copy is used. Returns
+    the entry, with "duplicate" set when the same reply was queued before.
+    """
+    if source_message_id and (thread_id is None or headers is None):
+        cached = message_cache.get_many([source_message_id]).get(source_message_id)
+        if cached:
+            thread_id = thread_id or cached["threadId"]
+            headers = headers if headers is not None else cached.get("headers")
+    headers = headers or {}
+    in_reply_to = headers.get("message-id")
+    refs = " ".join(r for r in (headers.get("references"), in_reply_to) if r) or None
+
+    outbox_id = outbox_key(to, subject, body, source_message_id)
+    with storage.transaction() as conn:
+        inserted = conn.execute("""
+            INSERT OR IGNORE INTO outbox (outbox_id, source_message_id, thread_id, to_addr, subject, body,
+                                          in_reply_to, refs, state, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?)
+        """, (outbox_id, source_message_id, thread_id, to, subject, body, in_reply_to, refs, time.time())).rowcount
+    if inserted:
+        sender.wake_event.set()
+    entry = get(outbox_id)
+    entry["duplicate"] = not inserted
+    return entry
+
+
+def enqueue_reply(email, body):
+    """Queue a reply to a parsed email, in its thread"""
+    subject = email.get("subject") or ""
+    if not subject.lower().startswith("re:"):
+        subject = f"Re: {subject}"
+    return enqueue(email["from"], subject, body, source_message_id=email["id"],
+                   thread_id=email.get("threadId"), headers=email.get("headers"))
+
+
+def get(outbox_id):
+    row = storage.query_one(f"SELECT {', '.join(COLUMNS)} FROM outbox WHERE outbox_id=?", (outbox_id,))
+    return dict(zip(COLUMNS, row)) if row else None
+
+
+def requeue(outbox_id):
+    """
+    Send a 'review' or 'dead' entry again, once a person has checked it did
+    not go out. Returns the entry, or None if it is not in one of those states.
+    """
+    with storage.transaction() as conn:
+        updated = conn.execute("""
+            UPDATE outbox SET state='queued', attempts=0, next_attempt_at=0, maybe_sent=0, last_error=NULL
+            WHERE outbox_id=? AND state IN ('review', 'dead')
+        """, (outbox_id,)).rowcount
+    if not updated:
+        return None
+    sender.wake_event.set()
+    return get(outbox_id)
+
+
+def stats():
+    return dict(storage.query_all("SELECT state, COUNT(*) FROM outbox GROUP BY state"))
+
+
+def _backoff(attempts):
+    return min(SEND_RETRY_MAX_DELAY, SEND_RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0))
+
+
+def daily_wait(now=None):
+    """Seconds until SENDS_PER_DAY allows another send (0 = go ahead), and how many may go"""
+    now = now or time.time()
+    count, oldest = storage.query_one("""
+        SELECT COUNT(*), MIN(sent_at) FROM outbox
+        WHERE (state='sent' AND sent_at > ?) OR state='sending'
+    """, (now - 86400,))
+    if count < SENDS_PER_DAY:
+        return 0, SENDS_PER_DAY - count
+    return max((oldest or now) + 86400 - now, 1), 0
+
+
+def claim(limit=SEND_CLAIM_BATCH):
+    """Atomically mark up to `limit` due entries as sending; returns them oldest first"""
+    token = uuid.uuid4().hex
+    now = time.time()
+    with storage.transaction() as conn:
+        conn.execute("""
+            UPDATE outbox SET state='sending', claim_token=?, claimed_at=? WHERE outbox_id IN (
+                SELECT outbox_id FROM outbox
+                WHERE state IN ('queued', 'retry') AND next_attempt_at <= ?
+                ORDER BY created_at LIMIT ?
+            )
+        """, (token, now, now, limit))
+        rows = conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM outbox WHERE claim_token=? ORDER BY created_at", (token,),
+        ).fetchall()
+    return [dict(zip(COLUMNS, row)) for row in rows]
+
+
+def release_claims(older_than=SEND_CLAIM_TIMEOUT):
+    """
+    Requeue entries left 'sending' by a process that stopped mid-send.
+    Only claims older than `older_than` seconds: the app and the worker
+    both run a sender, and neither may take over the other's live sends.
+    Whether Gmail got these is unknown, so they are checked before resending.
+    """
+    cutoff = time.time() - older_than
+    with storage.transaction() as conn:
+        conn.execute("""
+            UPDATE outbox SET state='retry', claim_token=NULL, maybe_sent=1
+            WHERE state='sending' AND (claimed_at IS NULL OR claimed_at < ?)
+        """, (cutoff,))
+
+
+def next_due(now=None):
+    """Seconds until the next queued or retrying entry is due, or None"""
+    now = now or time.time()
+    row = storage.query_one("SELECT MIN(next_attempt_at) FROM outbox WHERE state IN ('queued', 'retry')")
+    return None if row[0] is None else max(row[0] - now, 0)
+
+
+def _record_sent(outbox_id, gmail_id):
+    with storage.transaction() as conn:
+        conn.execute("""
+            UPDATE outbox SET state='sent', claim_token=NULL, attempts=attempts + 1, gmail_id=?, sent_at=?,
+                last_error=NULL, maybe_sent=0
+            WHERE outbox_id=?
+        """, (gmail_id, time.time(), outbox_id))
+
+
+def _record_failure(outbox_id, error, retryable, maybe_sent=False):
+    now = time.time()
+    with storage.transaction() as conn:
+        attempts = conn.execute("SELECT attempts FROM outbox WHERE outbox_id=?", (outbox_id,)).fetchone()[0] + 1
+        state = "retry" if retryable and attempts < SEND_MAX_ATTEMPTS else "dead"
+        conn.execute("""
+            UPDATE outbox SET state=?, attempts=?, next_attempt_at=?, claim_token=NULL, last_error=?,
+                maybe_sent=MAX(maybe_sent, ?)
+            WHERE outbox_id=?
+        """, (state, attempts, now + _backoff(attempts), error, int(maybe_sent), outbox_id))
+    return state
+
+
+def _record_review(outbox_id, error):
+    """Park an entry that may already have been sent; only a person can tell"""
+    with storage.transaction() as conn:
+        conn.execute("UPDATE outbox SET state='review', claim_token=NULL, last_error=? WHERE outbox_id=?",
+                     (error, outbox_id))
+
+
+class OutboxSender:
+    """
+    Sends due outbox entries on a background thread, SEND_CONCURRENCY at a
+    time through a small pool (each pool thread keeps its Gmail service),
+    paced by SENDS_PER_MIN.
+    """
+
+    def __init__(self, poll_interval=SEND_POLL_INTERVAL, rate_per_min=SENDS_PER_MIN, concurrency=SEND_CONCURRENCY):
+        self.poll_interval = poll_interval
+        self.concurrency = concurrency
+        # A small burst allowance, so a backlog is paced rather than sent all at once
+        self.bucket = TokenBucket(rate_per_min, capacity=concurrency) if rate_per_min else None
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.thread = None
+        self.pool = None
+
+    def start(self):
+        release_claims()
+        self.pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="outbox-send")
+        self.thread = threading.Thread(target=self.run, name="outbox", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Let the sends in flight finish, then exit"""
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+    def _already_sent(self, entry):
+        """
+        For a maybe_sent entry: the Gmail id of the earlier attempt if it
+        went through, None if it did not, or False after parking the entry
+        (it cannot be looked up, or the lookup failed for good).
+        """
+        if not (entry["thread_id"] and entry["in_reply_to"]):
+            _record_review(entry["outbox_id"], f"may have been sent; no thread to check ({entry['last_error']})")
+            metrics.outbox_sends.inc(result="review")
+            print(f"[outbox] {entry['outbox_id']} may have been sent; parked for review")
+            return False
+        try:
+            return gmail.find_sent_reply(entry["thread_id"], entry["in_reply_to"], entry["body"])
+        except Exception as e:
+            state = _record_failure(entry["outbox_id"], f"checking for an earlier send: {e}", True, maybe_sent=True)
+            if state == "dead":
+                _record_review(entry["outbox_id"], f"may have been sent; check failed: {e}")
+            print(f"[outbox] could not check {entry['outbox_id']} for an earlier send:", e)
+            return False
+
+    def _send(self, entry):
+        if entry["maybe_sent"]:
+            gmail_id = self._already_sent(entry)
+            if gmail_id is False:
+                return
+            if gmail_id:
+                self._sent(entry, gmail_id)
+                return
+        if self.bucket:
+            self.bucket.acquire()
+        try:
+            sent = gmail.send_email(entry["to_addr"], entry["subject"], entry["body"], thread_id=entry["thread_id"],
+                                    in_reply_to=entry["in_reply_to"], references=entry["refs"])
+        except Exception as e:
+            status = e.resp.status if isinstance(e, HttpError) else None
+            # 429/5xx are retried. Connection errors and timeouts are too, but
+            # Gmail may have sent those, so the next attempt checks first.
+            retryable = status is None or status in SEND_RETRY_STATUSES
+            state = _record_failure(entry["outbox_id"], f"{status or type(e).__name__}: {e}", retryable,
+                                    maybe_sent=status is None)
+            metrics.outbox_sends.inc(result=state)
+            print(f"[outbox] send {entry['outbox_id']} failed ({state}):", e)
+            return
+        self._sent(entry, sent.get("id"))
+
+    def _sent(self, entry, gmail_id):
+        _record_sent(entry["outbox_id"], gmail_id)
+        metrics.outbox_sends.inc(result="sent")
+        if entry["source_message_id"]:
+            mark_sent(entry["source_message_id"])
+
+    def run_once(self):
+        """Send one batch; returns seconds to wait before the next pass (None = until woken)"""
+        release_claims()  # a process that died while this one runs
+        wait, allowed = daily_wait()
+        if wait:
+            return wait
+        entries = claim(min(SEND_CLAIM_BATCH, allowed))
+        if not entries:
+            due = next_due()
+            if due is None:
+                return self.poll_interval
+            # Due now but claimed by another sender: don't spin
+            return max(min(due, self.poll_interval or due), 0.1)
+        list(self.pool.map(self._send, entries))
+        return 0
+
+    def drain(self, timeout=SEND_DRAIN_TIMEOUT):
+        """
+        Send what is queued from the calling thread, waiting out retries,
+        for scripts that exit when done (main.py). Returns the outbox stats.
+        """
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="outbox-send")
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self.run_once()
+            if wait == 0:
+                continue
+            if next_due() is None or time.monotonic() + wait > deadline:
+                return stats()
+            time.sleep(wait)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                wait = self.run_once()
+            except Exception as e:
+                print("[outbox] send pass failed:", e)
+                wait = self.poll_interval
+            if wait != 0:
+                self.wake_event.wait(wait)
+                self.wake_event.clear()
+        storage.close_connection()
+
+
+sender = OutboxSender()
@@ -0,0 +1,219 @@
+# agent/prompts.py
+
+"""
+Token budgets for the prompts the agent sends.
+
+Bodies are cleaned first (quoted reply history, "On ... wrote:" blocks,
+signatures and mobile footers are dropped), then the call's budget in
+PROMPT_BUDGETS is split: the fixed instructions cost what they cost, the
+thread memory gets at most MEMORY_SHARE of the rest, and the email or
+thread gets whatever is left. Related past conversations (fit_lines) are
+placed first and take at most RELATED_SHARE. Threads keep their newest messages whole and
+trim or drop the oldest.
+
+Tokens are counted with tiktoken when its encoding can be loaded, and
+estimated at 4 characters per token otherwise.
+"""
+
+import re
+import threading
+
+PROMPT_BUDGETING = True      # False sends bodies and threads as they are (still counted)
+ENCODING = "o200k_base"      # gpt-4o / gpt-4o-mini tokenizer
+CHARS_PER_TOKEN = 4          # estimate when tiktoken is unavailable
+PROMPT_BUDGETS = {           # tokens of prompt per call
+    "decide_action": 2000,
+    "decide_action_single_pass": 2500,
+    "generate_reply": 2000,
+    "summarize_email": 3000,
+    "thread_summary": 6000,
+    "fold_summary": 3000,
+}
+DEFAULT_BUDGET = 2000
+MEMORY_SHARE = 0.25          # most of the remaining budget the thread summary may take
+RELATED_SHARE = 0.15         # most of it related past conversations may take
+MIN_MESSAGE_TOKENS = 40      # older thread messages are dropped rather than cut below this
+TRUNCATED_MARKER = "\n[... truncated]"
+
+# Where quoted history starts; everything from the first match on is dropped
+QUOTE_START_RE = re.compile(
+    r"^(?:"
+    r"On\b[^\n]{0,200}(?:\n[^\n]{0,200})?\bwrote:[ \t]*$"       # Gmail / Apple Mail
+    r"|-{2,}\s*Original Message\s*-{2,}"                        # Outlook (plain)
+    r"|_{10,}[ \t]*\n+From:"                                    # Outlook (HTML)
+    r"|From:[^\n]+\n(?:[^\n]+\n)?(?:Sent|Date):[^\n]+\n(?:[^\n]+\n){0,3}Subject:"
+    r")",
+    re.M | re.I,
+)
+# A forwarded message is content, not history: only the text above it is cleaned
+FORWARD_RE = re.compile(r"^(?:-{2,}\s*Forwarded message\s*-{2,}|Begin forwarded message:)", re.M | re.I)
+SIGNATURE_RE = re.compile(r"^--[ \t]*$", re.M)
+FOOTER_RE = re.compile(r"^(?:Sent from my \w+|Get Outlook for \w+)[^\n]*$", re.M | re.I)
+
+_lock = threading.Lock()
+_encoding = None
+_encoding_loaded = False
+_stats = {}
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    with _lock:
+        if not _encoding_loaded:
+            _encoding_loaded = True
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(ENCODING)
+            except Exception as e:  # not installed, or the encoding file can't be fetched
+                print(f"tiktoken unavailable ({type(e).__name__}), estimating prompt tokens")
+        return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate(text, max_tokens):
+    """text cut to about max_tokens (marker included), on a word boundary"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    keep = max(0, max_tokens - count_tokens(TRUNCATED_MARKER))
+    encoding = _get_encoding()
+    if encoding is None:
+        head = text[:keep * CHARS_PER_TOKEN]
+    else:
+        head = encoding.decode(encoding.encode(text, disallowed_special=())[:keep])
+    cut = head.rstrip().rsplit(None, 1)[0] if " " in head.strip() else head
+    return cut.rstrip() + TRUNCATED_MARKER
+
+
+def clean_body(text):
+    """The new part of an email: quoted history, signature and footers removed"""
+    if not text:
+        return ""
+    forward = FORWARD_RE.search(text)
+    cleaned, forwarded = (text[:forward.start()], text[forward.start():]) if forward else (text, "")
+    match = QUOTE_START_RE.search(cleaned)
+    if match:
+        cleaned = cleaned[:match.start()]
+    cleaned = "\n".join(line for line in cleaned.splitlines() if not line.lstrip().startswith(">"))
+    match = SIGNATURE_RE.search(cleaned)
+    if match:
+        cleaned = cleaned[:match.start()]
+    cleaned = re.sub(r"\n{3,}", "\n\n", FOOTER_RE.sub("", cleaned)).strip()
+    if forwarded:
+        return (cleaned + "\n\n" + forwarded.strip()).strip()
+    # A message that is nothing but a quote keeps its text
+    return cleaned or text.strip()
+
+
+def _budget_left(call, fixed):
+    return PROMPT_BUDGETS.get(call, DEFAULT_BUDGET) - count_tokens(fixed)
+
+
+def fit(call, fixed, body, memory=""):
+    """
+    (memory, body) shrunk so that fixed + memory + body fit the call's
+    budget. fixed is the prompt text around them (instructions, labels).
+    """
+    body, memory = body or "", memory or ""
+    if not PROMPT_BUDGETING:
+        return memory, body
+    raw = count_tokens(memory) + count_tokens(body)
+    left = _budget_left(call, fixed)
+    if memory:
+        memory = truncate(memory, max(0, int(left * MEMORY_SHARE)))
+        left -= count_tokens(memory)
+    body = truncate(clean_body(body), max(0, left))
+    _record_fit(call, raw - count_tokens(memory) - count_tokens(body), body.endswith(TRUNCATED_MARKER))
+    return memory, body
+
+
+def fit_lines(call, fixed, lines, share=RELATED_SHARE):
+    """As many of lines (best first) as fit in share of the call's remaining budget"""
+    if not lines:
+        return ""
+    if not PROMPT_BUDGETING:
+        return "\n".join(lines)
+    left = int(max(0, _budget_left(call, fixed)) * share)
+    kept = []
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if cost > left:
+            if left >= MIN_MESSAGE_TOKENS:
+                kept.append(truncate(line, left - 1))
+            break
+        kept.append(line)
+        left -= cost
+    return "\n".join(kept)
+
+
+def _format_message(message, body):
+    return f"From: {message['from']}\n{body}"
+
+
+def fit_thread(call, fixed, messages, memory=""):
+    """
+    (memory, thread_text) for a list of {from, body} messages, oldest first.
+    The newest messages are kept whole; older ones are cut, then dropped.
+    """
+    memory = memory or ""
+    if not PROMPT_BUDGETING:
+        return memory, "\n\n".join(_format_message(m, m["body"] or "") for m in messages)
+    raw = count_tokens(memory) + sum(count_tokens(_format_message(m, m["body"] or "")) for m in messages)
+    left = _budget_left(call, fixed)
+    if memory:
+        memory = truncate(memory, max(0, int(left * MEMORY_SHARE)))
+        left -= count_tokens(memory)
+
+    kept, truncated = [], False
+    for n, message in enumerate(reversed(messages)):
+        text = _format_message(message, clean_body(message["body"]))
+        cost = count_tokens(text) + 1
+        if cost > left:
+            if left < MIN_MESSAGE_TOKENS and kept:
+                omitted = len(messages) - n
+                kept.append(f"[{omitted} earlier message{'s' if omitted > 1 else ''} omitted]")
+                truncated = True
+                break
+            text = truncate(text, max(0, left - 1))
+            cost = count_tokens(text) + 1
+            truncated = True
+        kept.append(text)
+        left -= cost
+    thread_text = "\n\n".join(reversed(kept))
+    _record_fit(call, raw - count_tokens(memory) - count_tokens(thread_text), truncated)
+    return memory, thread_text
+
+
+def _entry(call):
+    return _stats.setdefault(call, {"calls": 0, "tokens_in": 0, "max_tokens_in": 0, "tokens_saved": 0, "truncated": 0})
+
+
+def _record_fit(call, saved, truncated):
+    with _lock:
+        entry = _entry(call)
+        entry["tokens_saved"] += max(0, saved)
+        entry["truncated"] += truncated
+
+
+def record(call, messages):
+    """Count the prompt tokens of a finished messages list; returns the count"""
+    tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+    with _lock:
+        entry = _entry(call)
+        entry["calls"] += 1
+        entry["tokens_in"] += tokens
+        entry["max_tokens_in"] = max(entry["max_tokens_in"], tokens)
+    return tokens
+
+
+def stats():
+    with _lock:
+        out = {call: dict(entry) for call, entry in _stats.items()}
+    for entry in out.values():
+        entry["avg_tokens_in"] = round(entry["tokens_in"] / entry["calls"], 1) if entry["calls"] else 0.0
+    return {"tokenizer": ENCODING if _get_encoding() is not None else "estimate", "calls": out}
@@ -0,0 +1,59 @@
+# agent/ratelimit.py
+
+import time
+import asyncio
+import threading
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens per `per` seconds, bursting up to
+    `capacity` (defaults to rate). acquire() blocks until enough tokens are free.
+    """
+
+    def __init__(self, rate, per=60.0, capacity=None):
+        self.rate = float(rate)
+        self.per = float(per)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    def reserve(self, amount=1.0):
+        """Take `amount` if available and return 0, else return seconds to wait"""
+        # Requests larger than the bucket would wait forever; clamp them
+        amount = min(float(amount), self.capacity)
+        with self.lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) * self.per / self.rate
+
+    def acquire(self, amount=1.0):
+        while True:
+            wait = self.reserve(amount)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, amount=1.0):
+        while True:
+            wait = self.reserve(amount)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def adjust(self, amount):
+        """
+        Settle an estimate after the fact: positive takes more tokens (the
+        balance may go negative, delaying later callers), negative returns some.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
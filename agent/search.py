@@ -0,0 +1,144 @@
+# agent/search.py
+
+"""
+Local full-text search over everything the agent has seen: cached mail
+(subject, sender, body), thread summaries and todos.
+
+The FTS5 tables are external-content indexes over the messages, threads
+and todo tables (storage migration 7); triggers update them on every
+write, so the ingest path (fetch_emails, fetch_thread, update_thread_memory,
+add_to_todo) keeps them current without doing anything itself. Results
+are ranked with BM25 within each kind, interleaved across kinds, and carry
+a highlighted snippet.
+
+    python -m agent.search "launch plan"
+    python -m agent.search rebuild
+"""
+
+import re
+import sys
+from itertools import zip_longest
+
+from agent import storage
+
+KINDS = ("message", "thread", "todo")
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+SNIPPET_TOKENS = 12           # words of context around the match
+HIGHLIGHT = ("<mark>", "</mark>")
+ELLIPSIS = "…"
+MESSAGE_WEIGHTS = (5.0, 2.0, 1.0)  # BM25 weight of subject, sender, body
+MIN_PREFIX_CHARS = 2          # a shorter last word is not expanded while typing
+
+# A quoted phrase, or a word with an optional trailing * for prefix matching
+TERM_RE = re.compile(r'"([^"]*)"|(\w+)(\*?)')
+
+FTS_TABLES = ("messages_fts", "threads_fts", "todo_fts")
+
+
+def match_query(text, prefix_last=True):
+    """
+    FTS5 MATCH expression for free text: every term must match (AND), in
+    any column. Operators and punctuation are not passed through, so any
+    input is a valid query. word* is a prefix query, and so is the last
+    word when prefix_last is set (search as you type).
+    """
+    terms = []
+    matches = list(TERM_RE.finditer(text or ""))
+    for n, match in enumerate(matches):
+        phrase, word, star = match.groups()
+        if phrase is not None:
+            words = re.findall(r"\w+", phrase)
+            if words:
+                terms.append('"' + " ".join(words) + '"')
+        elif word:
+            typing = prefix_last and n == len(matches) - 1 and len(word) >= MIN_PREFIX_CHARS
+            terms.append(f'"{word}"' + ("*" if star or typing else ""))
+    return " ".join(terms)
+
+
+def _snippet(table, column=-1):
+    start, end = HIGHLIGHT
+    return f"snippet({table}, {column}, '{start}', '{end}', '{ELLIPSIS}', {SNIPPET_TOKENS})"
+
+
+def _search_messages(query, limit):
+    rows = storage.query_all(f"""
+        SELECT m.message_id, m.thread_id, m.subject, m.sender, {_snippet('messages_fts')},
+               bm25(messages_fts, {', '.join(map(str, MESSAGE_WEIGHTS))}) AS score
+        FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid
+        WHERE messages_fts MATCH ?
+        ORDER BY score LIMIT ?
+    """, (query, limit))
+    return [{"kind": "message", "id": r[0], "thread_id": r[1], "title": r[2], "from": r[3],
+             "snippet": r[4], "score": r[5]} for r in rows]
+
+
+def _search_threads(query, limit):
+    rows = storage.query_all(f"""
+        SELECT t.thread_id, t.last_action, {_snippet('threads_fts')}, bm25(threads_fts) AS score,
+               (SELECT subject FROM messages WHERE thread_id = t.thread_id LIMIT 1)
+        FROM threads_fts JOIN threads t ON t.rowid = threads_fts.rowid
+        WHERE threads_fts MATCH ?
+        ORDER BY score LIMIT ?
+    """, (query, limit))
+    return [{"kind": "thread", "id": r[0], "thread_id": r[0], "title": r[4], "last_action": r[1],
+             "snippet": r[2], "score": r[3]} for r in rows]
+
+
+def _search_todos(query, limit):
+    rows = storage.query_all(f"""
+        SELECT t.id, t.task, t.due_date, {_snippet('todo_fts')}, bm25(todo_fts) AS score
+        FROM todo_fts JOIN todo t ON t.id = todo_fts.rowid
+        WHERE todo_fts MATCH ?
+        ORDER BY score LIMIT ?
+    """, (query, limit))
+    return [{"kind": "todo", "id": r[0], "thread_id": None, "title": r[1], "due_date": r[2],
+             "snippet": r[3], "score": r[4]} for r in rows]
+
+
+_SEARCHERS = {"message": _search_messages, "thread": _search_threads, "todo": _search_todos}
+
+
+def search(text, kinds=KINDS, limit=DEFAULT_LIMIT):
+    """
+    The best `limit` hits for free text across `kinds`. Each kind is ranked
+    on its own, then the lists are interleaved: every kind's best hit (in
+    `kinds` order), then every kind's second best, and so on. BM25 scores
+    depend on each table's size and term statistics, so they are only
+    compared within a kind; lower is better.
+    """
+    query = match_query(text)
+    if not query:
+        return []
+    limit = max(1, min(limit, MAX_LIMIT))
+    storage.write_buffer.flush()  # buffered summaries and todos are searchable at once
+    ranked = [_SEARCHERS[kind](query, limit) for kind in kinds]
+    hits = [hit for rank in zip_longest(*ranked) for hit in rank if hit is not None][:limit]
+    for hit in hits:
+        hit["score"] = round(hit["score"], 4)
+    return hits
+
+
+def rebuild():
+    """Re-index everything from the content tables, then merge the index b-trees"""
+    with storage.transaction() as conn:
+        for table in FTS_TABLES:
+            conn.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+            conn.execute(f"INSERT INTO {table}({table}) VALUES ('optimize')")
+
+
+def main():
+    if sys.argv[1:] == ["rebuild"]:
+        rebuild()
+        print("Search index rebuilt")
+        return
+    if not sys.argv[1:]:
+        print('usage: python -m agent.search "query" | rebuild')
+        return
+    for hit in search(" ".join(sys.argv[1:])):
+        print(f"{hit['score']:8.3f}  {hit['kind']:<7} {hit['id']}  {hit['title']}\n          {hit['snippet']}")
+
+
+if __name__ == "__main__":
+    main()
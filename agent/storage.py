@@ -0,0 +1,477 @@
+# agent/storage.py
+
+"""
+One place that owns assistant.db: schema migrations run once per process,
+and each thread reuses its own WAL-mode connection instead of connecting,
+running DDL and closing on every call. Agent writes can also be buffered
+and flushed in batches (see batched_writes).
+"""
+
+import time
+import atexit
+import sqlite3
+import contextvars
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from agent import metrics
+
+DB_PATH = "assistant.db"
+BUSY_TIMEOUT = 10.0        # seconds a writer waits on a locked database
+STATEMENT_CACHE = 256      # prepared statements kept per connection
+WRITE_BATCH_SIZE = 500     # buffered rows that trigger a flush
+WRITE_BATCH_INTERVAL = 2.0 # seconds a buffered row may wait before a flush
+
+_local = threading.local()
+_migrate_lock = threading.Lock()
+_migrated = set()
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _migration_1(conn):
+    """Original schema: thread memory, todos and meetings"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS threads (
+            thread_id TEXT PRIMARY KEY,
+            summary TEXT,
+            last_action TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS todo (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task TEXT,
+            due_date TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS meetings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT,
+            datetime TEXT,
+            attendees TEXT
+        )
+    """)
+
+
+def _migration_2(conn):
+    """Rolling-summary bookkeeping on threads"""
+    columns = _columns(conn, "threads")
+    if "last_message_id" not in columns:
+        conn.execute("ALTER TABLE threads ADD COLUMN last_message_id TEXT")
+    if "folded_count" not in columns:
+        conn.execute("ALTER TABLE threads ADD COLUMN folded_count INTEGER DEFAULT 0")
+
+
+def _migration_3(conn):
+    """Gmail sync state, message cache and completion cache"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id TEXT PRIMARY KEY,
+            thread_id TEXT,
+            sender TEXT,
+            subject TEXT,
+            body TEXT,
+            label_ids TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages(thread_id)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            total_tokens INTEGER,
+            created_at REAL,
+            last_used REAL
+        )
+    """)
+
+
+def _migration_4(conn):
+    """Background worker: per-message work queue and /process jobs"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS work_queue (
+            message_id TEXT PRIMARY KEY,
+            thread_id TEXT,
+            state TEXT,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            claim_token TEXT,
+            job_id TEXT,
+            action TEXT,
+            last_error TEXT,
+            updated_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_work_queue_state ON work_queue(state, next_attempt_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            state TEXT,
+            claim_token TEXT,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL,
+            processed INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            error TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state, created_at)")
+
+
+def _migration_5(conn):
+    """Prefetched reply drafts, one per source message"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS drafts (
+            message_id TEXT PRIMARY KEY,
+            thread_id TEXT,
+            state TEXT,
+            claim_token TEXT,
+            model_version TEXT,
+            draft TEXT,
+            total_tokens INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            created_at REAL,
+            generated_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_drafts_state ON drafts(state, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_drafts_generated ON drafts(generated_at)")
+
+
+def _migration_6(conn):
+    """Pre-classifier: list/bulk headers on cached messages, trained models"""
+    if "headers" not in _columns(conn, "messages"):
+        conn.execute("ALTER TABLE messages ADD COLUMN headers TEXT")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS models (
+            name TEXT PRIMARY KEY,
+            data TEXT,
+            n_examples INTEGER,     -- decisions available when it was trained
+            trained_at REAL
+        )
+    """)
+
+
+def _migration_7(conn):
+    """Full-text search over cached mail, thread summaries and todos (see agent/search.py)"""
+    options = "tokenize='unicode61 remove_diacritics 2', prefix='2 3'"
+    for table, columns, key in (
+        ("messages", ("subject", "sender", "body"), "rowid"),
+        ("threads", ("summary",), "rowid"),
+        ("todo", ("task",), "id"),
+    ):
+        fts = f"{table}_fts"
+        names = ", ".join(columns)
+        new = ", ".join(f"new.{c}" for c in columns)
+        old = ", ".join(f"old.{c}" for c in columns)
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                     f"{names}, content='{table}', content_rowid='{key}', {options})")
+        # External-content tables: triggers keep the index in step with every write
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts}(rowid, {names}) VALUES (new.{key}, {new});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.{key}, {old});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {names} ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.{key}, {old});
+                INSERT INTO {fts}(rowid, {names}) VALUES (new.{key}, {new});
+            END
+        """)
+        conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def _migration_8(conn):
+    """Rows of the embedding matrix (see agent/vectors.py) and what they embed"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS vectors (
+            space TEXT,             -- embedding model and dimensions
+            kind TEXT,              -- message or thread
+            ref_id TEXT,
+            row INTEGER,            -- row in the memory-mapped matrix
+            content_hash TEXT,
+            thread_id TEXT,
+            sender TEXT,
+            snippet TEXT,
+            created_at REAL,
+            PRIMARY KEY (space, kind, ref_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vectors_row ON vectors(space, row)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vectors_hash ON vectors(space, content_hash)")
+
+
+def _migration_9(conn):
+    """Outgoing mail queue (see agent/outbox.py)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            outbox_id TEXT PRIMARY KEY,     -- idempotency key
+            source_message_id TEXT,         -- the email being answered, if any
+            thread_id TEXT,
+            to_addr TEXT,
+            subject TEXT,
+            body TEXT,
+            in_reply_to TEXT,
+            refs TEXT,
+            state TEXT,                     -- queued, sending, retry, sent, dead or review
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            claim_token TEXT,
+            gmail_id TEXT,
+            last_error TEXT,
+            created_at REAL,
+            sent_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_state ON outbox(state, next_attempt_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_sent ON outbox(sent_at)")
+
+
+def _migration_10(conn):
+    """Outbox entries whose last attempt may have reached Gmail; state may also be review"""
+    conn.execute("ALTER TABLE outbox ADD COLUMN maybe_sent INTEGER DEFAULT 0")
+
+
+def _migration_11(conn):
+    """When an outbox entry was claimed, so only stale claims are taken over"""
+    conn.execute("ALTER TABLE outbox ADD COLUMN claimed_at REAL")
+
+
+# Append-only: each entry upgrades the schema from the previous version.
+# Earlier releases created these tables ad hoc, hence the IF NOT EXISTS guards.
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+    _migration_10,
+    _migration_11,
+]
+
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with conn:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+
+
+def _open(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE)
+    conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")  # durable at checkpoints; safe with WAL
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def init_db(path=None):
+    """Create or upgrade the schema. Cheap after the first call per process."""
+    path = path or DB_PATH
+    if path in _migrated:
+        return
+    with _migrate_lock:
+        if path in _migrated:
+            return
+        conn = _open(path)
+        try:
+            _migrate(conn)
+        finally:
+            conn.close()
+        _migrated.add(path)
+
+
+def get_connection():
+    """This thread's connection to DB_PATH, opened (and migrated) on first use"""
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(DB_PATH)
+    if conn is None:
+        init_db(DB_PATH)
+        conn = conns[DB_PATH] = _open(DB_PATH)
+    return conn
+
+
+def close_connection():
+    """Close this thread's connections (e.g. when a worker thread exits)"""
+    for conn in getattr(_local, "conns", {}).values():
+        conn.close()
+    _local.conns = {}
+
+
+@contextmanager
+def _timed(operation):
+    start = time.perf_counter()
+    try:
+        yield
+    except sqlite3.Error:
+        metrics.db_errors.inc(operation=operation)
+        raise
+    finally:
+        metrics.observe_db(operation, time.perf_counter() - start)
+
+
+@contextmanager
+def transaction():
+    """Connection inside a transaction: commit on success, roll back on error"""
+    conn = get_connection()
+    with _timed("transaction"), conn:
+        yield conn
+
+
+def query_one(sql, params=()):
+    with _timed("query"):
+        return get_connection().execute(sql, params).fetchone()
+
+
+def query_all(sql, params=()):
+    with _timed("query"):
+        return get_connection().execute(sql, params).fetchall()
+
+
+class WriteBuffer:
+    """
+    Unit of work for agent writes. Inside batched_writes(), write() queues
+    rows per statement and flush() applies them with executemany in a
+    single transaction; other threads and tasks keep writing immediately.
+    A background thread flushes once a row has waited WRITE_BATCH_INTERVAL;
+    write() flushes at once past WRITE_BATCH_SIZE rows, and so does leaving
+    the outermost block and interpreter exit.
+    """
+
+    def __init__(self, max_rows=None, max_delay=None):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.lock = threading.Condition(threading.RLock())
+        self.pending = OrderedDict()    # sql -> [params, ...], in first-seen order
+        self.keys = set()               # keys with queued writes, for read-your-writes
+        self.rows = 0
+        self.oldest = None
+        self.thread = None
+
+    @property
+    def active(self):
+        """Whether the calling thread or task is inside batched_writes()"""
+        return _batching.get()
+
+    def write(self, sql, params, key=None):
+        """Queue a row, or run it immediately outside batched_writes()"""
+        if not self.active:
+            if key is not None:
+                self.flush_key(key)  # a queued older write must not land after this one
+            with transaction() as conn:
+                conn.execute(sql, params)
+            return
+        with self.lock:
+            self.pending.setdefault(sql, []).append(params)
+            if key is not None:
+                self.keys.add(key)
+            self.rows += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+                self._start()
+                self.lock.notify()
+            if self.rows >= (self.max_rows or WRITE_BATCH_SIZE):
+                self.flush()
+
+    def flush_key(self, key):
+        """Flush first if `key` has queued writes, so a read sees them"""
+        with self.lock:
+            if key in self.keys:
+                self.flush()
+
+    def flush_keys(self, keys):
+        """flush_key for many keys at once: one flush if any has queued writes"""
+        with self.lock:
+            if self.keys and not self.keys.isdisjoint(keys):
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.rows:
+                return 0
+            pending, self.pending = self.pending, OrderedDict()
+            flushed, self.rows = self.rows, 0
+            self.keys = set()
+            self.oldest = None
+            try:
+                with transaction() as conn:
+                    for sql, rows in pending.items():
+                        conn.executemany(sql, rows)
+            except sqlite3.Error as e:
+                # Isolate the bad rows instead of dropping the whole batch
+                print("Batched write failed, retrying row by row:", e)
+                for sql, rows in pending.items():
+                    for params in rows:
+                        try:
+                            with transaction() as conn:
+                                conn.execute(sql, params)
+                        except sqlite3.Error as row_error:
+                            print("Dropped write:", row_error, params)
+            return flushed
+
+    def _start(self):
+        """Start the flusher thread; caller holds the lock"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="sqlite-writes", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.rows:
+                    self.lock.wait()
+                max_delay = self.max_delay if self.max_delay is not None else WRITE_BATCH_INTERVAL
+                delay = self.oldest + max_delay - time.monotonic()
+                if delay > 0:
+                    self.lock.wait(delay)
+                    continue
+                self.flush()
+
+
+# Set by batched_writes() for the block's thread or task only. Worker threads
+# that should join the batch run in a copy of the caller's context.
+_batching = contextvars.ContextVar("batched_writes", default=False)
+
+write_buffer = WriteBuffer()
+atexit.register(write_buffer.flush)
+
+
+@contextmanager
+def batched_writes():
+    """Buffer this context's write() calls for the duration of the block; flushes on exit"""
+    token = _batching.set(True)
+    try:
+        yield write_buffer
+    finally:
+        _batching.reset(token)
+        if not _batching.get():
+            write_buffer.flush()
+
+
+def write(sql, params=(), key=None):
+    write_buffer.write(sql, params, key)
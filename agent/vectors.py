@@ -0,0 +1,345 @@
+# agent/vectors.py
+
+"""
+Related-conversation retrieval: embeddings of processed emails and thread
+summaries in a memory-mapped float32 matrix, searched by cosine similarity.
+
+Vectors are L2-normalised when stored, so cosine similarity is a dot
+product. top_k() multiplies a batch of queries against SEARCH_BLOCK rows
+of the matrix at a time and keeps a running top-k, so memory stays flat
+however large the index grows. What each row embeds is in the vectors
+table. Embeddings are requested EMBED_BATCH texts at a time through
+llm.embed() and cached by content hash: unchanged text is never embedded
+twice, and identical texts share a row.
+
+related_context() is what the agent uses: the closest other threads and
+emails for an email, as prompt lines, best first. process_emails() calls
+prefetch_related() first, so a whole batch shares one pass over the matrix.
+"""
+
+import os
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from agent import llm, prompts, storage
+
+RELATED_CONTEXT = True            # add related past conversations to the decide prompts
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 256               # shortened by the API; 1M vectors take 1 GB on disk
+EMBED_BATCH = 256                 # texts per embeddings request
+EMBED_MAX_TOKENS = 1000           # of each email that is embedded
+SNIPPET_CHARS = 300               # of each email or summary kept for the prompt
+RELATED_K = 3
+MIN_SIMILARITY = 0.3              # cosine similarity below which nothing is related
+OVERSAMPLE = 4                    # candidates fetched per hit, to survive filtering
+SEARCH_BLOCK = 65_536             # matrix rows multiplied at a time
+INITIAL_CAPACITY = 1024           # rows; the file doubles when it fills up
+SQL_CHUNK = 500
+
+_lock = threading.Lock()
+_indexes = {}
+_prefetched = {}                  # email id -> related lines, from prefetch_related()
+_stats = {"embedded": 0, "embed_requests": 0, "cache_hits": 0, "searches": 0, "search_s": 0.0}
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def content_hash(space, text):
+    return hashlib.sha256(f"{space}\n{text}".encode("utf-8")).hexdigest()
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(matrix, n_rows, queries, k, block=SEARCH_BLOCK):
+    """
+    (rows, scores), each [n_queries, <=k], best first: the k rows of
+    matrix[:n_rows] with the highest dot product with each query.
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, n_rows, block):
+        scores = queries @ matrix[start:min(n_rows, start + block)].T
+        kk = min(k, scores.shape[1])
+        idx = np.argpartition(scores, -kk, axis=1)[:, -kk:]
+        best_scores = np.concatenate([best_scores, np.take_along_axis(scores, idx, 1)], axis=1)
+        best_rows = np.concatenate([best_rows, idx + start], axis=1)
+        if best_scores.shape[1] > k:
+            keep = np.argpartition(best_scores, -k, axis=1)[:, -k:]
+            best_scores = np.take_along_axis(best_scores, keep, 1)
+            best_rows = np.take_along_axis(best_rows, keep, 1)
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_rows, order, 1), np.take_along_axis(best_scores, order, 1)
+
+
+class VectorIndex:
+    """
+    Append-only matrix file of normalised vectors next to assistant.db.
+    Rows are allocated inside a write transaction on the vectors table, so
+    several processes can append to the same file; a row whose text
+    changed is simply no longer referenced.
+    """
+
+    def __init__(self, path, space, dim):
+        self.path = path
+        self.space = space
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.matrix = None
+
+    def _n_rows(self, conn=None):
+        row = (conn or storage.get_connection()).execute(
+            "SELECT MAX(row) FROM vectors WHERE space=?", (self.space,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def _mapped(self, n_rows):
+        """The matrix, remapped first if it has fewer than n_rows rows"""
+        with self.lock:
+            if self.matrix is None or self.matrix.shape[0] < n_rows:
+                capacity = max(INITIAL_CAPACITY, self.matrix.shape[0] if self.matrix is not None else 0)
+                if os.path.exists(self.path):
+                    capacity = max(capacity, os.path.getsize(self.path) // (4 * self.dim))
+                while capacity < n_rows:
+                    capacity *= 2
+                with open(self.path, "ab") as f:
+                    if f.tell() < capacity * self.dim * 4:
+                        f.truncate(capacity * self.dim * 4)
+                self.matrix = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+            return self.matrix
+
+    def add(self, items):
+        """
+        Store items ({kind, ref_id, text, thread_id, sender, snippet}),
+        embedding only text not seen before. Returns {(kind, ref_id): row}.
+        """
+        if not items:
+            return {}
+        hashes = [content_hash(self.space, item["text"]) for item in items]
+        known = {}
+        unique = list(dict.fromkeys(hashes))
+        for i in range(0, len(unique), SQL_CHUNK):
+            chunk = unique[i:i + SQL_CHUNK]
+            known.update(storage.query_all(
+                f"SELECT content_hash, row FROM vectors WHERE space=? AND content_hash IN ({','.join('?' * len(chunk))})",
+                [self.space] + chunk,
+            ))
+        _count("cache_hits", sum(h in known for h in hashes))
+
+        texts = {h: item["text"] for h, item in zip(hashes, items) if h not in known}
+        new_hashes = list(texts)
+        for i in range(0, len(new_hashes), EMBED_BATCH):
+            batch = new_hashes[i:i + EMBED_BATCH]
+            in_batch = set(batch)
+            vectors = normalize(llm.embed([texts[h] for h in batch], EMBEDDING_MODEL, self.dim))
+            _count("embed_requests")
+            _count("embedded", len(batch))
+            with storage.transaction() as conn:
+                conn.execute("BEGIN IMMEDIATE")  # row allocation is serialised across processes
+                start = self._n_rows(conn)
+                matrix = self._mapped(start + len(batch))
+                matrix[start:start + len(batch)] = vectors
+                matrix.flush()
+                known.update((h, start + n) for n, h in enumerate(batch))
+                self._upsert(conn, [(item, h) for item, h in zip(items, hashes) if h in in_batch], known)
+
+        with storage.transaction() as conn:
+            self._upsert(conn, [(item, h) for item, h in zip(items, hashes) if h not in texts], known)
+        return {(item["kind"], item["ref_id"]): known[h] for item, h in zip(items, hashes)}
+
+    def _upsert(self, conn, pairs, rows):
+        if not pairs:
+            return
+        now = time.time()
+        conn.executemany("""
+            INSERT INTO vectors (space, kind, ref_id, row, content_hash, thread_id, sender, snippet, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(space, kind, ref_id) DO UPDATE SET
+                row=excluded.row, content_hash=excluded.content_hash, thread_id=excluded.thread_id,
+                sender=excluded.sender, snippet=excluded.snippet
+        """, [
+            (self.space, item["kind"], item["ref_id"], rows[h], h, item.get("thread_id"), item.get("sender"),
+             item.get("snippet", ""), now)
+            for item, h in pairs
+        ])
+
+    def vector(self, kind, ref_id):
+        row = storage.query_one("SELECT row FROM vectors WHERE space=? AND kind=? AND ref_id=?",
+                                (self.space, kind, ref_id))
+        if row is None:
+            return None
+        return np.array(self._mapped(row[0] + 1)[row[0]])
+
+    def search(self, queries, k):
+        """top_k() over every stored row"""
+        start = time.perf_counter()
+        n_rows = self._n_rows()
+        if not n_rows:
+            return np.empty((len(np.atleast_2d(queries)), 0), dtype=np.int64), None
+        result = top_k(self._mapped(n_rows), n_rows, normalize(queries), k)
+        _count("searches")
+        _count("search_s", time.perf_counter() - start)
+        return result
+
+    def nearest(self, vector, k=RELATED_K, exclude_thread=None):
+        """The k closest stored items from other threads, one per thread, best first"""
+        return self.nearest_many([vector], k, [exclude_thread])[0]
+
+    def nearest_many(self, vectors, k=RELATED_K, exclude_threads=None):
+        """nearest() for many vectors with one pass over the matrix"""
+        exclude_threads = exclude_threads or [None] * len(vectors)
+        rows, scores = self.search(np.asarray(vectors), k * OVERSAMPLE)
+        if scores is None:
+            return [[] for _ in vectors]
+        candidates = [[(int(r), float(s)) for r, s in zip(rs, ss) if s >= MIN_SIMILARITY]
+                      for rs, ss in zip(rows, scores)]
+        wanted = sorted({r for found in candidates for r, _ in found})
+        by_row = {}
+        for i in range(0, len(wanted), SQL_CHUNK):
+            chunk = wanted[i:i + SQL_CHUNK]
+            for meta in storage.query_all(f"""
+                SELECT v.row, v.kind, v.ref_id, v.thread_id, v.sender, v.snippet, t.last_action
+                FROM vectors v LEFT JOIN threads t ON v.kind = 'thread' AND t.thread_id = v.ref_id
+                WHERE v.space=? AND v.row IN ({','.join('?' * len(chunk))})
+            """, [self.space] + chunk):
+                by_row.setdefault(meta[0], []).append(meta)
+
+        results = []
+        for found, exclude_thread in zip(candidates, exclude_threads):
+            hits, seen = [], {exclude_thread}
+            for row, score in found:
+                for _, kind, ref_id, thread_id, sender, snippet, last_action in by_row.get(row, []):
+                    if thread_id in seen:
+                        continue
+                    seen.add(thread_id)
+                    hits.append({"kind": kind, "ref_id": ref_id, "thread_id": thread_id, "sender": sender,
+                                 "snippet": snippet, "last_action": last_action, "score": round(score, 4)})
+            results.append(hits[:k])
+        return results
+
+
+def get_index():
+    """The index for the current database and embedding model"""
+    space = f"{EMBEDDING_MODEL}:{EMBEDDING_DIM}"
+    key = (storage.DB_PATH, space)
+    with _lock:
+        index = _indexes.get(key)
+        if index is None:
+            path = f"{os.path.splitext(storage.DB_PATH)[0]}.{EMBEDDING_MODEL}.{EMBEDDING_DIM}.f32"
+            index = _indexes[key] = VectorIndex(path, space, EMBEDDING_DIM)
+    return index
+
+
+def _snippet(text):
+    return " ".join((text or "").split())[:SNIPPET_CHARS]
+
+
+def _email_item(email):
+    body = prompts.clean_body(email.get("body") or "")
+    return {
+        "kind": "message", "ref_id": email["id"], "thread_id": email["threadId"], "sender": email.get("from"),
+        "text": prompts.truncate(f"{email.get('subject') or ''}\n{body}", EMBED_MAX_TOKENS),
+        "snippet": _snippet(body),
+    }
+
+
+def index_emails(emails):
+    """Embed emails in batches (cached by content); failures are logged, not raised"""
+    if not RELATED_CONTEXT or not emails:
+        return
+    try:
+        get_index().add([_email_item(e) for e in emails])
+    except Exception as e:
+        print("Could not index emails for related context:", e)
+
+
+def index_threads(thread_ids):
+    """Embed the current summaries of these threads"""
+    if not RELATED_CONTEXT or not thread_ids:
+        return
+    thread_ids = list(dict.fromkeys(thread_ids))
+    try:
+        storage.write_buffer.flush_keys(("threads", t) for t in thread_ids)
+        items = []
+        for i in range(0, len(thread_ids), SQL_CHUNK):
+            chunk = thread_ids[i:i + SQL_CHUNK]
+            for thread_id, summary, sender in storage.query_all(f"""
+                SELECT t.thread_id, t.summary, (SELECT sender FROM messages WHERE thread_id = t.thread_id LIMIT 1)
+                FROM threads t WHERE t.thread_id IN ({','.join('?' * len(chunk))}) AND t.summary != ''
+            """, chunk):
+                items.append({"kind": "thread", "ref_id": thread_id, "thread_id": thread_id, "sender": sender,
+                              "text": summary, "snippet": _snippet(summary)})
+        get_index().add(items)
+    except Exception as e:
+        print("Could not index thread summaries:", e)
+
+
+def _format(hit):
+    if hit["kind"] == "thread":
+        return f"- Earlier thread with {hit['sender']} (last action: {hit['last_action']}): {hit['snippet']}"
+    return f"- Email from {hit['sender']}: {hit['snippet']}"
+
+
+def prefetch_related(emails, k=RELATED_K):
+    """
+    Look up related context for a batch of (already indexed) emails in one
+    pass over the matrix; related_context() then answers from memory.
+    """
+    if not RELATED_CONTEXT or not emails:
+        return
+    try:
+        index = get_index()
+        found = [(e, index.vector("message", e["id"])) for e in emails]
+        found = [(e, v) for e, v in found if v is not None]
+        if not found:
+            return
+        hits = index.nearest_many([v for _, v in found], k, [e["threadId"] for e, _ in found])
+        with _lock:
+            for (email, _), email_hits in zip(found, hits):
+                _prefetched[email["id"]] = [_format(hit) for hit in email_hits]
+    except Exception as e:
+        print("Could not prefetch related context:", e)
+
+
+def discard_prefetched(email_ids):
+    """Drop prefetched lookups related_context() did not use"""
+    with _lock:
+        for email_id in email_ids:
+            _prefetched.pop(email_id, None)
+
+
+def related_context(email, k=RELATED_K):
+    """Prompt lines about the closest other threads and emails, best first"""
+    if not RELATED_CONTEXT:
+        return []
+    with _lock:
+        lines = _prefetched.pop(email["id"], None)
+    if lines is not None:
+        return lines
+    try:
+        index = get_index()
+        vector = index.vector("message", email["id"])
+        if vector is None:
+            index.add([_email_item(email)])
+            vector = index.vector("message", email["id"])
+        return [_format(hit) for hit in index.nearest(vector, k, exclude_thread=email["threadId"])]
+    except Exception as e:
+        print("Related context unavailable:", e)
+        return []
+
+
+def stats():
+    with _lock:
+        out = dict(_stats)
+    out["avg_search_ms"] = round(out.pop("search_s") / out["searches"] * 1000, 3) if out["searches"] else 0.0
+    out["model"] = f"{EMBEDDING_MODEL}:{EMBEDDING_DIM}"
+    return out
@@ -0,0 +1,283 @@
+# agent/worker.py
+
+"""
+Long-running inbox worker.
+
+Each cycle syncs Gmail for new unread mail, records every message in the
+persistent work_queue table, and runs the agent on whatever is due.
+Messages that fail are retried with exponential backoff, up to MAX_ATTEMPTS.
+Cycles run on a jittered poll interval, or early when a /process job is
+submitted.
+
+    python -m agent.worker
+"""
+
+import time
+import uuid
+import random
+import signal
+import threading
+
+from agent import storage
+from agent.gmail import fetch_messages, label_buffer, set_history_id, sync_history
+from agent import classifier, llm_agent, outbox
+from agent.drafts import enqueue_drafts
+from agent.llm_agent import process_emails
+
+POLL_INTERVAL = 60         # seconds between inbox polls
+POLL_JITTER = 0.2          # +/- fraction of POLL_INTERVAL, so workers don't poll in lockstep
+POLL_BATCH = 25            # unread emails pulled on a full resync
+CLAIM_BATCH = 25           # queued emails processed per cycle
+MAX_ATTEMPTS = 5           # tries per message before it is parked as "dead"
+RETRY_BASE_DELAY = 30      # seconds; doubled per failed attempt
+BACKOFF_MAX = 15 * 60      # cap for both message retries and failed-poll backoff
+
+
+def _backoff(failures):
+    return min(BACKOFF_MAX, RETRY_BASE_DELAY * 2 ** max(failures - 1, 0))
+
+
+# Work queue
+
+def enqueue_messages(emails, history_id=None):
+    """
+    Queue emails ({id, threadId} is enough) for processing; ids already in
+    the queue are left alone. history_id advances the sync cursor in the
+    same transaction, so no arrival is skipped if the process dies between.
+    """
+    now = time.time()
+    with storage.transaction() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO work_queue (message_id, thread_id, state, updated_at) VALUES (?, ?, 'queued', ?)",
+            [(e["id"], e["threadId"], now) for e in emails],
+        )
+        if history_id is not None:
+            set_history_id(history_id, conn)
+
+
+def claim_messages(limit=CLAIM_BATCH, job_id=None):
+    """Atomically mark up to `limit` due messages as running; returns their ids"""
+    token = uuid.uuid4().hex
+    now = time.time()
+    with storage.transaction() as conn:
+        conn.execute("""
+            UPDATE work_queue SET state='running', claim_token=?, job_id=?, updated_at=?
+            WHERE message_id IN (
+                SELECT message_id FROM work_queue
+                WHERE state IN ('queued', 'retry') AND next_attempt_at <= ?
+                ORDER BY updated_at LIMIT ?
+            )
+        """, (token, job_id, now, now, limit))
+        rows = conn.execute("SELECT message_id FROM work_queue WHERE claim_token=?", (token,)).fetchall()
+    return [row[0] for row in rows]
+
+
+def finish_messages(results):
+    """Record process_emails results: done, or retry/dead with backoff"""
+    now = time.time()
+    with storage.transaction() as conn:
+        for r in results:
+            if r["action"] != "error":
+                conn.execute(
+                    "UPDATE work_queue SET state='done', action=?, claim_token=NULL, updated_at=? WHERE message_id=?",
+                    (r["action"], now, r["id"]),
+                )
+                continue
+            attempts = conn.execute(
+                "SELECT attempts FROM work_queue WHERE message_id=?", (r["id"],)
+            ).fetchone()[0] + 1
+            state = "dead" if attempts >= MAX_ATTEMPTS else "retry"
+            conn.execute("""
+                UPDATE work_queue SET state=?, attempts=?, next_attempt_at=?, claim_token=NULL,
+                    last_error='processing failed', updated_at=?
+                WHERE message_id=?
+            """, (state, attempts, now + _backoff(attempts), now, r["id"]))
+
+
+def release_stale_claims(older_than=3600):
+    """Requeue messages left 'running' by a worker that died mid-cycle"""
+    cutoff = time.time() - older_than
+    with storage.transaction() as conn:
+        conn.execute(
+            "UPDATE work_queue SET state='retry', claim_token=NULL WHERE state='running' AND updated_at < ?",
+            (cutoff,),
+        )
+
+
+def queue_stats():
+    rows = storage.query_all("SELECT state, COUNT(*) FROM work_queue GROUP BY state")
+    return dict(rows)
+
+
+# Jobs
+
+def create_job():
+    job_id = uuid.uuid4().hex
+    with storage.transaction() as conn:
+        conn.execute(
+            "INSERT INTO jobs (job_id, state, created_at) VALUES (?, 'pending', ?)",
+            (job_id, time.time()),
+        )
+    return job_id
+
+
+def get_job(job_id):
+    row = storage.query_one("""
+        SELECT job_id, state, created_at, started_at, finished_at, processed, failed, error
+        FROM jobs WHERE job_id=?
+    """, (job_id,))
+    if not row:
+        return None
+    keys = ["job_id", "state", "created_at", "started_at", "finished_at", "processed", "failed", "error"]
+    return dict(zip(keys, row))
+
+
+def _claim_jobs():
+    """All pending jobs are served by the next cycle, so double-clicks coalesce"""
+    token = uuid.uuid4().hex
+    with storage.transaction() as conn:
+        conn.execute(
+            "UPDATE jobs SET state='running', claim_token=?, started_at=? WHERE state='pending'",
+            (token, time.time()),
+        )
+        rows = conn.execute("SELECT job_id FROM jobs WHERE claim_token=?", (token,)).fetchall()
+    return [row[0] for row in rows]
+
+
+def _finish_jobs(job_ids, state, processed=0, failed=0, error=None):
+    if not job_ids:
+        return
+    with storage.transaction() as conn:
+        conn.executemany("""
+            UPDATE jobs SET state=?, finished_at=?, processed=?, failed=?, error=?
+            WHERE job_id=?
+        """, [(state, time.time(), processed, failed, error, job_id) for job_id in job_ids])
+
+
+def run_cycle(job_id=None):
+    """Sync, enqueue and process one batch. Returns (processed, failed)."""
+    # Only ids are recorded here; bodies are fetched when the messages are claimed
+    delta = sync_history(n=POLL_BATCH)
+    enqueue_messages(delta["added"], history_id=delta["history_id"])
+    if not llm_agent.AUTO_SEND:
+        enqueue_drafts(delta["added"])  # a person reviews replies: have drafts waiting
+    ids = claim_messages(CLAIM_BATCH, job_id)
+    if not ids:
+        return 0, 0
+
+    try:
+        emails = fetch_messages(ids)
+        fetched = {e["id"] for e in emails}
+        results = process_emails(emails) if emails else []
+    except Exception:
+        # Don't leave the claim 'running': the batch counts as a failed attempt
+        finish_messages([{"id": msg_id, "action": "error"} for msg_id in ids])
+        raise
+    # Ids Gmail no longer returns (deleted meanwhile) count as failed attempts
+    results += [{"id": msg_id, "action": "error"} for msg_id in ids if msg_id not in fetched]
+    finish_messages(results)
+    classifier.maybe_retrain()
+
+    failed = sum(r["action"] == "error" for r in results)
+    return len(results) - failed, failed
+
+
+class Worker:
+    """
+    Runs cycles on a background thread until stop(). poll_interval=None
+    means no scheduled polling: cycles run only when submit() asks.
+    """
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.thread = None
+
+    def submit(self):
+        """Queue a /process job and wake the worker; returns the job id"""
+        job_id = create_job()
+        self.wake_event.set()
+        return job_id
+
+    def start(self):
+        release_stale_claims()
+        self.thread = threading.Thread(target=self.run, name="inbox-worker", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Let the current cycle finish, then exit"""
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _next_delay(self, failures):
+        if failures:
+            return _backoff(failures)
+        if self.poll_interval is None:
+            return None
+        return self.poll_interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+    def run(self):
+        failures = 0
+        due = self.poll_interval is not None   # daemon mode polls straight away
+        while not self.stop_event.is_set():
+            job_ids = _claim_jobs()
+            if job_ids or due:
+                try:
+                    processed, failed = run_cycle(job_ids[0] if job_ids else None)
+                    _finish_jobs(job_ids, "done", processed, failed)
+                    if processed or failed:
+                        print(f"[worker] processed {processed}, failed {failed}")
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    print(f"[worker] cycle failed ({failures} in a row):", e)
+                    _finish_jobs(job_ids, "failed", error=str(e))
+
+            # A backlog bigger than one claim: go again without sleeping
+            if not failures and queue_has_due_work():
+                due = True
+                continue
+
+            woken = self.wake_event.wait(self._next_delay(failures))
+            self.wake_event.clear()
+            due = not woken  # the timer ran out: scheduled poll or backoff retry
+
+        storage.write_buffer.flush()
+        label_buffer.flush()
+        storage.close_connection()
+
+
+def queue_has_due_work():
+    row = storage.query_one(
+        "SELECT 1 FROM work_queue WHERE state IN ('queued', 'retry') AND next_attempt_at <= ? LIMIT 1",
+        (time.time(),),
+    )
+    return row is not None
+
+
+def main():
+    worker = Worker()
+
+    def shutdown(signum, frame):
+        print("[worker] shutting down after the current cycle...")
+        worker.stop_event.set()
+        worker.wake_event.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    storage.init_db()
+    print(f"[worker] polling every ~{POLL_INTERVAL}s")
+    outbox.sender.start()  # delivers the replies AUTO_SEND queues
+    worker.start()
+    while worker.thread.is_alive():
+        worker.thread.join(1.0)
+    outbox.sender.stop(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
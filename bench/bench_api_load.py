@@ -0,0 +1,144 @@
+# bench/bench_api_load.py
+
+"""
+Load test for the FastAPI backend: many concurrent clients hitting /emails
+and /generate_draft, with Gmail and OpenAI replaced by fake servers that
+add realistic latency. Compares the previous blocking routes (sync handlers
+on FastAPI's thread pool) with the async routes in run_app.py, reporting
+throughput and p50/p99 latency per endpoint and client count. With the
+blocking routes, slow completions occupy the thread pool and quick /emails
+calls queue behind them.
+
+    python -m bench.bench_api_load [requests_per_client] [clients ...]
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+from bench.fake_gmail import FakeGmailServer, make_mailbox, point_agent_at
+from bench.fake_openai import FakeOpenAIServer
+
+LLM_LATENCY = 1.0   # a few sentences from a chat model
+GMAIL_LATENCY = 0.02
+SYNC_PORT = 8611
+ASYNC_PORT = 8612
+
+
+def blocking_app():
+    """The routes as they were before they went async"""
+    from fastapi import FastAPI
+    from agent.functions import generate_reply
+    from agent.gmail import fetch_emails
+    from run_app import DraftRequest
+
+    app = FastAPI()
+
+    @app.post("/generate_draft")
+    def api_generate_draft(req: DraftRequest):
+        return {"draft": generate_reply(email_text=req.email_text, sender=req.sender, bypass_cache=req.bypass_cache)}
+
+    @app.get("/emails")
+    def get_emails(n: int = 10, metadata_only: bool = False):
+        return fetch_emails(n=n, metadata_only=metadata_only)
+
+    return app
+
+
+def serve(app, port):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def client_loop(base_url, index, n_requests, latencies, errors):
+    # One connection per simulated user; a single shared pool would make
+    # httpcore's connection bookkeeping the bottleneck at high client counts.
+    async with httpx.AsyncClient(timeout=120) as http:
+        for i in range(n_requests):
+            route = "/emails" if (index + i) % 2 else "/generate_draft"
+            start = time.perf_counter()
+            try:
+                if route == "/emails":
+                    resp = await http.get(f"{base_url}/emails", params={"n": 10})
+                else:
+                    resp = await http.post(f"{base_url}/generate_draft", json={
+                        "email_text": f"Hello from client {index}, request {i}",
+                        "sender": f"Client {index} <c{index}@example.com>",
+                        "bypass_cache": True,
+                    })
+                resp.raise_for_status()
+                latencies[route].append(time.perf_counter() - start)
+            except httpx.HTTPError:
+                errors.append(1)
+
+
+async def load(base_url, clients, n_requests):
+    latencies, errors = {"/emails": [], "/generate_draft": []}, []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client_loop(base_url, i, n_requests, latencies, errors) for i in range(clients)
+    ))
+    elapsed = time.perf_counter() - start
+    return {route: sorted(values) for route, values in latencies.items()}, len(errors), elapsed
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main(n_requests=4, *client_counts):
+    client_counts = client_counts or (50, 100, 200)
+    with FakeGmailServer(make_mailbox(50), latency=GMAIL_LATENCY) as gmail_server, \
+            FakeOpenAIServer(latency=LLM_LATENCY) as llm_server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+        os.environ["OPENAI_BASE_URL"] = llm_server.base_url
+        point_agent_at(gmail_server.root_url, tmp)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            import run_app
+            from agent import llm, storage
+            storage.init_db()
+        # The fake server has no quota: with the account's RPM/TPM pacing both
+        # apps would run at the gateway's rate, whatever the routes do
+        llm.configure(rpm=1_000_000, tpm=100_000_000)
+
+        servers = [
+            ("blocking", serve(blocking_app(), SYNC_PORT), f"http://127.0.0.1:{SYNC_PORT}"),
+            ("async", serve(run_app.app, ASYNC_PORT), f"http://127.0.0.1:{ASYNC_PORT}"),
+        ]
+        print(f"{n_requests} requests per client, half /emails and half /generate_draft; "
+              f"LLM latency {LLM_LATENCY * 1000:.0f} ms, Gmail latency {GMAIL_LATENCY * 1000:.0f} ms")
+
+        try:
+            for clients in client_counts:
+                for name, _, base_url in servers:
+                    latencies, errors, elapsed = asyncio.run(load(base_url, clients, n_requests))
+                    done = sum(len(values) for values in latencies.values())
+                    print(f"{name:<8} {clients:>4} clients: {done / elapsed:6.1f} req/s  {errors} errors")
+                    for route, values in latencies.items():
+                        print(f"    {route:<16} p50 {percentile(values, 0.50) * 1000:6.0f} ms  "
+                              f"p99 {percentile(values, 0.99) * 1000:6.0f} ms")
+        finally:
+            for _, server, _ in servers:
+                server.should_exit = True
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(*args)
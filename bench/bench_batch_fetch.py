@@ -0,0 +1,67 @@
+# bench/bench_batch_fetch.py
+
+"""
+Round trips and wall time for fetch_emails/fetch_threads against a local stub
+Gmail server: one get per message versus the batched path.
+
+    python -m bench.bench_batch_fetch [n_messages]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from agent import gmail
+from agent.message_cache import message_cache
+from bench.fake_gmail import FakeGmailServer, make_mailbox, point_agent_at
+
+
+def serial_fetch(n):
+    """The pre-batching fetch_emails: list, then one messages.get per id"""
+    service = gmail.get_gmail_service()
+    listed = service.users().messages().list(userId="me", labelIds=["UNREAD"], maxResults=n).execute()
+    return [
+        service.users().messages().get(userId="me", id=m["id"], format="full").execute()
+        for m in listed.get("messages", [])
+    ]
+
+
+def measure(server, label, fn):
+    """Time fn against an empty message cache, so every run goes to Gmail"""
+    message_cache.delete(list(server.messages))
+    server.reset_counters()
+    start = time.perf_counter()
+    out = fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {len(out):>5} items  {server.round_trips:>4} round trips  {elapsed * 1000:8.1f} ms")
+    return out, server.round_trips
+
+
+def main(n=250, latency=0.005):
+    with FakeGmailServer(make_mailbox(n, thread_depth=5), latency=latency) as server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # assistant.db (the message cache) goes here
+        point_agent_at(server.root_url, tmp)
+        gmail.BATCH_RETRY_BACKOFF = 0
+
+        _, serial = measure(server, "serial full", lambda: serial_fetch(n))
+        emails, batched = measure(server, "batched full", lambda: gmail.fetch_emails(n))
+        measure(server, "batched metadata", lambda: gmail.fetch_emails(n, metadata_only=True))
+
+        server.fail_once.update(e["id"] for e in emails[:3])
+        retried, with_retry = measure(server, "batched full, 3x 429", lambda: gmail.fetch_emails(n))
+
+        thread_ids = sorted({e["threadId"] for e in emails})
+        threads, _ = measure(server, "fetch_threads", lambda: list(gmail.fetch_threads(thread_ids).values()))
+
+        batches = -(-n // gmail.BATCH_SIZE)
+        assert serial == n + 1, serial
+        assert batched == 1 + batches, batched
+        assert with_retry == 2 + batches and len(retried) == n, (with_retry, len(retried))
+        assert len(threads) == len(thread_ids)
+        print("round-trip counts OK")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 250)
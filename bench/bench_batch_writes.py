@@ -0,0 +1,64 @@
+# bench/bench_batch_writes.py
+
+"""
+Ingest synthetic agent actions (thread memory updates, todos, meetings)
+one transaction per row versus through storage.batched_writes().
+
+    python -m bench.bench_batch_writes [n_actions]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from agent import storage
+
+
+def ingest(n):
+    from agent.functions import add_to_todo, schedule_meeting
+    from agent.llm_agent import update_thread_memory
+
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            update_thread_memory(f"t{i % 1000}", f"summary {i}", "reply_sent", f"m{i}", 1)
+        elif kind == 1:
+            add_to_todo(f"task {i}", "2026-01-01")
+        else:
+            schedule_meeting("2026-01-01T10:00", f"topic {i}", "a@example.com")
+
+
+def count_rows():
+    return sum(
+        storage.query_one(f"SELECT COUNT(*) FROM {table}")[0]
+        for table in ("threads", "todo", "meetings")
+    )
+
+
+def main(n=10000):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+        storage.DB_PATH = os.path.join(tmp, "per_row.db")
+        start = time.perf_counter()
+        ingest(n)
+        per_row = time.perf_counter() - start
+        per_row_rows = count_rows()
+
+        storage.DB_PATH = os.path.join(tmp, "batched.db")
+        start = time.perf_counter()
+        with storage.batched_writes():
+            ingest(n)
+        batched = time.perf_counter() - start
+        batched_rows = count_rows()
+
+    assert per_row_rows == batched_rows, (per_row_rows, batched_rows)
+    print(f"{n} actions, {batched_rows} rows stored")
+    print(f"per-row: {per_row:7.3f} s  {n / per_row:9.0f} actions/s")
+    print(f"batched: {batched:7.3f} s  {n / batched:9.0f} actions/s  ({per_row / batched:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
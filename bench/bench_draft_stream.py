@@ -0,0 +1,98 @@
+# bench/bench_draft_stream.py
+
+"""
+User-visible draft latency: /generate_draft returns only once the whole
+completion exists, while /generate_draft/stream shows the first words after
+the model's time to first token. Also checks that a client disconnecting
+mid-stream stops generation upstream.
+
+    python -m bench.bench_draft_stream [drafts]
+"""
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench.bench_api_load import percentile, serve
+from bench.fake_gmail import FakeGmailServer, point_agent_at
+from bench.fake_openai import FakeOpenAIServer
+
+TTFT = 0.4            # seconds before the model emits its first token
+TOKEN_DELAY = 0.03    # seconds per word after that
+REPLY_WORDS = 80
+PORT = 8613
+
+
+def draft_payload(i):
+    return {"email_text": f"Draft request {i}", "sender": "Bench <bench@example.com>", "bypass_cache": True}
+
+
+def blocking_draft(http, base_url, i):
+    start = time.perf_counter()
+    http.post(f"{base_url}/generate_draft", json=draft_payload(i)).raise_for_status()
+    return time.perf_counter() - start
+
+
+def streamed_draft(http, base_url, i):
+    """(time to first delta, time to done event)"""
+    start = time.perf_counter()
+    first = None
+    with http.stream("POST", f"{base_url}/generate_draft/stream", json=draft_payload(i)) as resp:
+        for line in resp.iter_lines():
+            if first is None and line.startswith("data: ") and "delta" in json.loads(line[6:]):
+                first = time.perf_counter() - start
+            if line == "event: done":
+                break
+    return first, time.perf_counter() - start
+
+
+def main(drafts=10):
+    reply = " ".join(f"word{i}" for i in range(REPLY_WORDS))
+    with FakeGmailServer() as gmail_server, \
+            FakeOpenAIServer(latency=TTFT, token_delay=TOKEN_DELAY, reply_text=reply) as llm_server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+        os.environ["OPENAI_BASE_URL"] = llm_server.base_url
+        point_agent_at(gmail_server.root_url, tmp)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            import run_app
+        server = serve(run_app.app, PORT)
+        base_url = f"http://127.0.0.1:{PORT}"
+        print(f"{drafts} drafts of {REPLY_WORDS} words; TTFT {TTFT * 1000:.0f} ms, "
+              f"{TOKEN_DELAY * 1000:.0f} ms per word")
+
+        try:
+            with httpx.Client(timeout=60) as http:
+                blocking = sorted(blocking_draft(http, base_url, i) for i in range(drafts))
+                streamed = [streamed_draft(http, base_url, drafts + i) for i in range(drafts)]
+                first = sorted(s[0] for s in streamed)
+                done = sorted(s[1] for s in streamed)
+                print(f"/generate_draft         until draft: p50 {percentile(blocking, 0.5) * 1000:6.0f} ms  "
+                      f"p99 {percentile(blocking, 0.99) * 1000:6.0f} ms")
+                print(f"/generate_draft/stream  first words: p50 {percentile(first, 0.5) * 1000:6.0f} ms  "
+                      f"p99 {percentile(first, 0.99) * 1000:6.0f} ms")
+                print(f"/generate_draft/stream  until draft: p50 {percentile(done, 0.5) * 1000:6.0f} ms  "
+                      f"p99 {percentile(done, 0.99) * 1000:6.0f} ms")
+
+                # Walk away after the first chunk
+                llm_server.reset_counters()
+                with http.stream("POST", f"{base_url}/generate_draft/stream", json=draft_payload(-1)) as resp:
+                    next(resp.iter_lines())
+                time.sleep(TTFT + 10 * TOKEN_DELAY)
+                print(f"cancelled mid-stream: upstream stream aborted = {llm_server.cancelled_streams == 1}, "
+                      f"in flight after = {llm_server.in_flight}")
+        finally:
+            server.should_exit = True
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(*args)
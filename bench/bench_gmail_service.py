@@ -0,0 +1,48 @@
+# bench/bench_gmail_service.py
+
+"""
+Per-call latency of getting a Gmail service, with and without the session cache.
+
+    python -m bench.bench_gmail_service [calls]
+"""
+
+import sys
+import tempfile
+import time
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build_from_document
+
+from agent import gmail
+from bench.fake_gmail import point_agent_at
+
+
+def uncached_service(doc_path):
+    """What get_gmail_service() used to do: read token, parse discovery, build"""
+    creds = Credentials.from_authorized_user_file(gmail.TOKEN_PATH, gmail.SCOPES)
+    with open(doc_path) as f:
+        doc = f.read()
+    return build_from_document(doc, credentials=creds)
+
+
+def timed(fn, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main(calls=200):
+    with tempfile.TemporaryDirectory() as tmp:
+        doc_path = point_agent_at("http://127.0.0.1:8765/", tmp)
+
+        uncached = timed(lambda: uncached_service(doc_path), calls)
+        cached = timed(gmail.get_gmail_service, calls)
+
+    print(f"calls per variant: {calls}")
+    print(f"uncached: {uncached:10.1f} us/call")
+    print(f"cached:   {cached:10.1f} us/call  ({uncached / cached:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
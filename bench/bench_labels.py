@@ -0,0 +1,130 @@
+# bench/bench_labels.py
+
+"""
+Label changes against the fake Gmail server: one messages.modify per
+message (how mark_as_read and /delete_email worked) versus the label
+buffer's batchModify calls, for marking 500 emails read and for archiving
+them through /bulk_archive. Reports Gmail requests and wall time, and
+checks that opposing changes coalesce, that one bad id does not fail the
+rest, that concurrent archives each get their own failures, and that
+changes still queued at exit are flushed.
+
+    python -m bench.bench_labels [n_emails]
+"""
+
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from bench.bench_api_load import serve
+from bench.mailbox import generate_mailbox
+from bench.run import fake_environment
+
+GMAIL_LATENCY = 0.03
+PORT = 8632
+
+EXIT_CHILD = """
+import sys
+from bench.fake_gmail import point_agent_at
+from agent import gmail
+point_agent_at(sys.argv[1], sys.argv[2])
+gmail.modify_labels(sys.argv[3:], remove=["INBOX"])
+"""
+
+
+def timed(gmail_server, fn):
+    gmail_server.reset_counters()
+    start = time.perf_counter()
+    out = fn()
+    return out, gmail_server.round_trips, time.perf_counter() - start
+
+
+def labels(gmail_server, ids):
+    return [gmail_server.messages[m]["labelIds"] for m in ids]
+
+
+def main(n=500):
+    messages, attachments = generate_mailbox(n, seed=5)
+    ids = [m["id"] for m in messages]
+    with fake_environment(messages, attachments, gmail_latency=GMAIL_LATENCY) as (gmail_server, _):
+        with contextlib.redirect_stdout(io.StringIO()):
+            import run_app
+            from agent import gmail, storage
+            storage.init_db()
+        gmail.fetch_messages(ids)
+        run_app.prefetcher.submit = lambda emails: None
+        print(f"{n} emails, Gmail latency {GMAIL_LATENCY * 1000:.0f} ms")
+
+        def modify_each(add, remove):
+            service = gmail.get_gmail_service()
+            for msg_id in ids:
+                service.users().messages().modify(
+                    userId="me", id=msg_id, body={"addLabelIds": add, "removeLabelIds": remove},
+                ).execute()
+
+        def mark_read_buffered():
+            for msg_id in ids:
+                gmail.mark_as_read(msg_id)
+            return gmail.label_buffer.flush()
+
+        _, before_calls, before_s = timed(gmail_server, lambda: modify_each([], ["UNREAD"]))
+        modify_each(["UNREAD"], [])
+        failed, after_calls, after_s = timed(gmail_server, mark_read_buffered)
+        print(f"mark as read   one modify each: {before_calls:>4} requests {before_s:6.2f} s   "
+              f"label buffer: {after_calls:>3} requests {after_s:6.2f} s   all read: "
+              f"{not failed and all('UNREAD' not in l for l in labels(gmail_server, ids))}")
+
+        server = serve(run_app.app, PORT)
+        base_url = f"http://127.0.0.1:{PORT}"
+        try:
+            with httpx.Client(timeout=120) as http:
+                _, before_calls, before_s = timed(gmail_server, lambda: [
+                    http.post(f"{base_url}/delete_email", json={"message_id": m}) for m in ids])
+                modify_each(["INBOX"], [])
+                out, after_calls, after_s = timed(gmail_server, lambda: http.post(
+                    f"{base_url}/bulk_archive", json={"message_ids": ids}).json())
+                print(f"archive        /delete_email each: {before_calls:>3} requests {before_s:6.2f} s   "
+                      f"/bulk_archive: {after_calls:>3} requests {after_s:6.2f} s   archived {out['archived']}")
+
+                modify_each(["INBOX"], [])
+                out = http.post(f"{base_url}/bulk_archive", json={"message_ids": ids[:10] + ["missing"]}).json()
+                print("one bad id isolated:", out["failed"] == ["missing"] and out["archived"] == 10
+                      and all("INBOX" not in l for l in labels(gmail_server, ids[:10])))
+
+                # Changes queued meanwhile must not swallow, or be handed, another call's failures
+                modify_each(["INBOX"], [])
+                gmail.modify_labels(ids, add=["STARRED"])
+                halves = [ids[:n // 2] + ["bogus-a"], ids[n // 2:] + ["bogus-b"]]
+                with ThreadPoolExecutor(2) as pool:
+                    outs = list(pool.map(lambda half: http.post(
+                        f"{base_url}/bulk_archive", json={"message_ids": half}).json(), halves))
+                assert [o["failed"] for o in outs] == [["bogus-a"], ["bogus-b"]], outs
+                assert all("INBOX" not in l for l in labels(gmail_server, ids)), "not archived"
+                gmail.label_buffer.flush()
+                gmail.modify_labels(ids, remove=["STARRED"])
+                print("concurrent archives report their own failures:", [o["failed"] for o in outs])
+        finally:
+            server.should_exit = True
+
+        gmail.modify_labels(ids, add=["STARRED"])
+        gmail.modify_labels(ids, remove=["STARRED"])
+        gmail.modify_labels(ids[:5], add=["STARRED"])
+        _, calls, _ = timed(gmail_server, gmail.label_buffer.flush)
+        starred = [m for m in ids if "STARRED" in gmail_server.messages[m]["labelIds"]]
+        print(f"opposing changes coalesce: {starred == ids[:5]} ({calls} requests)")
+
+        modify_each(["INBOX"], [])
+        subprocess.run([sys.executable, "-c", EXIT_CHILD, gmail_server.root_url, os.getcwd()] + ids[:20],
+                       check=True, env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__))))
+        print("queued changes flushed at exit:", all("INBOX" not in l for l in labels(gmail_server, ids[:20])))
+        print("buffer:", gmail.label_buffer.stats())
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
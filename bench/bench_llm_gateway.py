@@ -0,0 +1,159 @@
+# bench/bench_llm_gateway.py
+
+"""
+process_emails on a backlog against a fake OpenAI server that enforces a
+request-rate limit (429 + Retry-After) and fails a few requests at random.
+
+"no gateway" turns off retries and pacing, which is how the agent called
+OpenAI before agent/llm.py. "gateway" uses the defaults, with LLM_RPM set
+just under the server's limit. Then checks that identical concurrent
+requests are coalesced into one upstream call, that a 429's Retry-After
+is waited out, and that the RPM and TPM buckets keep traffic under their
+limits.
+
+    python -m bench.bench_llm_gateway [n_emails] [concurrency]
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from bench.fake_gmail import FakeGmailServer, make_mailbox, point_agent_at
+from bench.fake_openai import FakeOpenAIServer
+
+SERVER_LIMIT = (10, 1.0)   # requests per second the fake server admits
+ERROR_RATE = 0.05
+LLM_LATENCY = 0.05
+
+
+def run_backlog(llm_agent, emails, concurrency):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = llm_agent.process_emails(emails, concurrency=concurrency, rate_per_min=0)
+    return results, time.perf_counter() - start
+
+
+def run_concurrently(llm, requests):
+    """llm.chat for each request, all at once; returns the responses in order"""
+    responses = [None] * len(requests)
+
+    def call(i):
+        responses[i] = llm.chat(**requests[i])
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(requests))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return responses
+
+
+def main(n=40, concurrency=8):
+    with FakeGmailServer(make_mailbox(n)) as gmail_server, \
+            FakeOpenAIServer(latency=LLM_LATENCY, rate_limit=SERVER_LIMIT, error_rate=ERROR_RATE) as llm_server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+        os.environ["OPENAI_BASE_URL"] = llm_server.base_url
+        point_agent_at(gmail_server.root_url, tmp)
+
+        from agent import gmail, llm, llm_agent, storage
+
+        llm_agent.AUTO_SEND = False
+        emails = gmail.fetch_emails(n)
+        print(f"{len(emails)} emails, concurrency {concurrency}; server admits "
+              f"{SERVER_LIMIT[0]} req/{SERVER_LIMIT[1]:.0f}s and fails {ERROR_RATE:.0%} at random")
+
+        server_rpm = SERVER_LIMIT[0] * 60 / SERVER_LIMIT[1]
+        modes = [
+            ("no gateway", dict(LLM_MAX_RETRIES=0), server_rpm * 100),
+            ("gateway", dict(LLM_MAX_RETRIES=5, LLM_BACKOFF_BASE=0.2), server_rpm * 0.9),
+        ]
+        for name, settings, rpm in modes:
+            for attr, value in settings.items():
+                setattr(llm, attr, value)
+            llm.configure(rpm=rpm)
+            # Fresh summaries and drafts each run: nothing served from cache
+            with storage.transaction() as conn:
+                conn.execute("DELETE FROM threads")
+                conn.execute("DELETE FROM llm_cache")
+            llm_server.reset_counters()
+            time.sleep(SERVER_LIMIT[1])
+            before = llm.stats()
+
+            results, elapsed = run_backlog(llm_agent, emails, concurrency)
+            after = llm.stats()
+            errors = sum(r["action"] == "error" for r in results)
+            print(f"{name:<10}: {errors:>2}/{len(results)} emails failed  {elapsed:6.2f} s  "
+                  f"{llm_server.rejected} rejected upstream  "
+                  f"{after['retries'] - before['retries']} retries")
+
+        # Coalescing: the same request from many threads at once
+        llm_server.rate_limit = None
+        llm_server.error_rate = 0.0
+        llm_server.latency = 0.3
+        llm_server.reset_counters()
+        before = llm.stats()
+        request = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "Summarize the same thing"}]}
+        run_concurrently(llm, [request] * 20)
+        coalesced = llm.stats()["coalesced"] - before["coalesced"]
+        assert llm_server.calls == 1 and coalesced == 19, (llm_server.calls, coalesced)
+        print(f"20 identical concurrent requests -> {llm_server.calls} upstream call(s)")
+
+        # Retry-After: with a negligible backoff of its own, the client must
+        # wait out the server's window, so the second request is refused once
+        llm_server.latency = 0.0
+        llm.LLM_BACKOFF_BASE = 0.01
+        llm.configure(rpm=100_000)
+        window = 1.5
+        llm_server.rate_limit = (1, window)
+        time.sleep(window)
+        llm_server.reset_counters()
+        start = time.monotonic()
+        llm.chat(model="gpt-4o-mini", messages=[{"role": "user", "content": "First in the window"}])
+        llm.chat(model="gpt-4o-mini", messages=[{"role": "user", "content": "Second in the window"}])
+        elapsed = time.monotonic() - start
+        assert llm_server.rejected == 1 and elapsed >= window, (llm_server.rejected, elapsed)
+        print(f"429 with Retry-After {window:.1f}s: 1 rejection, second request done after {elapsed:.2f} s")
+
+        # RPM: half the server's rate, so even a full burst never trips its window
+        rpm = server_rpm / 2
+        llm_server.rate_limit = SERVER_LIMIT
+        llm.configure(rpm=rpm)
+        time.sleep(SERVER_LIMIT[1])
+        llm_server.reset_counters()
+        n_paced = 25
+        start = time.monotonic()
+        run_concurrently(llm, [{"model": "gpt-4o-mini", "messages": [{"role": "user", "content": f"Paced {i}"}]}
+                          for i in range(n_paced)])
+        elapsed = time.monotonic() - start
+        burst = rpm * llm.LLM_BURST_SECONDS / 60
+        floor = (n_paced - burst) / (rpm / 60)
+        assert llm_server.rejected == 0 and elapsed >= floor * 0.95, (llm_server.rejected, elapsed, floor)
+        print(f"RPM {rpm:.0f}: {n_paced} requests in {elapsed:.2f} s (>= {floor:.2f} s), none rejected upstream")
+
+        # TPM: settled usage never runs ahead of the bucket
+        tpm = 30_000
+        llm_server.rate_limit = None
+        llm.configure(rpm=100_000, tpm=tpm)
+        before = llm.stats()
+        start = time.monotonic()
+        responses = run_concurrently(llm, [
+            {"model": "gpt-4o-mini", "max_tokens": 200, "messages": [{"role": "user", "content": f"Tokens {i} " * 40}]}
+            for i in range(20)
+        ])
+        elapsed = time.monotonic() - start
+        used = sum(r.usage.total_tokens for r in responses)
+        allowed = tpm * llm.LLM_BURST_SECONDS / 60 + tpm / 60 * elapsed
+        throttled = llm.stats()["throttled_s"] - before["throttled_s"]
+        assert used <= allowed and throttled > 0, (used, allowed, throttled)
+        print(f"TPM {tpm}: {used} tokens in {elapsed:.2f} s (bucket allows {allowed:.0f}), "
+              f"callers throttled {throttled:.2f} s")
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(*args)
@@ -0,0 +1,95 @@
+# bench/bench_metrics.py
+
+"""
+Runs a backlog through process_emails against fake Gmail and OpenAI
+servers with injected latency, then reads the answer to "where did the
+time go?" back out of agent/metrics.py: per-component totals from the
+histograms, one per-email trace, and a check that /metrics renders valid
+Prometheus text. Also measures what a span costs.
+
+    python -m bench.bench_metrics [n_emails]
+"""
+
+import contextlib
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+
+from bench.fake_gmail import FakeGmailServer, make_mailbox, point_agent_at
+from bench.fake_openai import FakeOpenAIServer
+
+LLM_LATENCY = 0.15
+GMAIL_LATENCY = 0.03
+SAMPLE_LINE_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? -?[0-9.e+Inf]+$')
+
+
+def histogram_sums(metrics, histogram):
+    with histogram.lock:
+        return {key: (entry[1], entry[2]) for key, entry in histogram.values.items()}
+
+
+def print_trace(span, depth=0):
+    db = f"  (db {span['db_ms']:.1f} ms)" if span.get("db_ms") else ""
+    print(f"  {'  ' * depth}{span['name']:<{32 - 2 * depth}} {span['duration_ms']:8.1f} ms{db}")
+    for child in span.get("children", []):
+        print_trace(child, depth + 1)
+
+
+def main(n=20):
+    with FakeGmailServer(make_mailbox(n, thread_depth=2), latency=GMAIL_LATENCY) as gmail_server, \
+            FakeOpenAIServer(latency=LLM_LATENCY) as llm_server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+        os.environ["OPENAI_BASE_URL"] = llm_server.base_url
+        point_agent_at(gmail_server.root_url, tmp)
+
+        from agent import gmail, llm_agent, metrics
+
+        llm_agent.AUTO_SEND = False
+        llm_agent.PRECLASSIFY = False
+        emails = gmail.fetch_emails(n)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            llm_agent.process_emails(emails, concurrency=1, rate_per_min=0)
+        wall = time.perf_counter() - start
+        print(f"{len(emails)} emails processed serially in {wall:.2f} s "
+              f"(LLM latency {LLM_LATENCY * 1000:.0f} ms, Gmail latency {GMAIL_LATENCY * 1000:.0f} ms)")
+
+        email_total = sum(s for s, _ in histogram_sums(metrics, metrics.email_seconds).values())
+        print(f"\n{'component':<26} {'calls':>6} {'seconds':>8} {'share':>6}")
+        for name, histogram in (("gmail", metrics.gmail_seconds), ("llm", metrics.llm_seconds),
+                                ("sqlite", metrics.db_seconds)):
+            for key, (total, count) in sorted(histogram_sums(metrics, histogram).items()):
+                label = f"{name} {'/'.join(k for k in key if k)}"
+                print(f"{label:<26} {count:>6} {total:8.3f} {total / email_total:6.1%}")
+        for key, (total, count) in sorted(histogram_sums(metrics, metrics.step_seconds).items()):
+            print(f"{'step ' + key[0]:<26} {count:>6} {total:8.3f} {total / email_total:6.1%}")
+
+        print("\nslowest trace:")
+        trace = max(metrics.recent_traces(n), key=lambda t: t["duration_ms"])
+        print_trace(trace)
+
+        text = metrics.render()
+        samples = [line for line in text.splitlines() if line and not line.startswith("#")]
+        bad = [line for line in samples if not SAMPLE_LINE_RE.match(line)]
+        tokens = {key: v for key, v in metrics.llm_tokens.values.items()}
+        print(f"\n/metrics: {len(samples)} samples, {len(bad)} malformed; tokens {tokens}")
+        for line in bad[:5]:
+            print("  malformed:", line)
+
+        runs = 100_000
+        start = time.perf_counter()
+        for _ in range(runs):
+            with metrics.span("bench", (metrics.step_seconds, {"step": "bench"})):
+                pass
+        per_span = (time.perf_counter() - start) / runs
+        print(f"span overhead: {per_span * 1e6:.1f} us; {per_span * 1e6 / (wall / len(emails) * 1e6) * 100:.4f}% "
+              f"of an email per span")
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,174 @@
+# bench/bench_outbox.py
+
+"""
+The outbox (agent/outbox.py) against the fake Gmail server with a slow
+messages.send: what a reply costs the caller inline versus queued, how
+fast the sender drains a backlog, and checks that duplicates are sent
+once, transient failures are retried, the per-minute and per-day quotas
+hold, replies carry threading headers, sends that may have gone through
+(claims left by a crash, answers lost to a dropped connection) are not
+sent twice, another process's live claims are left alone, and drain() delivers without the sender thread.
+
+    python -m bench.bench_outbox [n_replies]
+"""
+
+import base64
+import contextlib
+import io
+import sys
+import threading
+import time
+
+from bench.mailbox import generate_mailbox
+from bench.run import fake_environment
+
+SEND_LATENCY = 0.3
+
+
+def drain(outbox, timeout=60):
+    """Seconds until nothing is queued, retrying or sending"""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if not set(outbox.stats()) & {"queued", "retry", "sending"}:
+            return time.perf_counter() - start
+        time.sleep(0.02)
+    raise TimeoutError(outbox.stats())
+
+
+def restart(outbox, **kwargs):
+    """Swap in a sender with other limits; enqueue() wakes whichever is current"""
+    outbox.sender.stop(timeout=10)
+    outbox.sender = outbox.OutboxSender(poll_interval=1, **kwargs)
+    return outbox.sender.start()
+
+
+def main(n=20):
+    messages, attachments = generate_mailbox(n * 3, seed=9)
+    with fake_environment(messages, attachments) as (gmail_server, _):
+        with contextlib.redirect_stdout(io.StringIO()):
+            from agent import gmail, outbox, storage
+            storage.init_db()
+        emails = gmail.fetch_messages(list(gmail_server.order))
+        outbox.SEND_RETRY_BASE_DELAY = 0.1
+        gmail_server.latency = SEND_LATENCY
+        print(f"{n} replies, messages.send latency {SEND_LATENCY * 1000:.0f} ms")
+
+        batch = emails[:n]
+        start = time.perf_counter()
+        for e in batch:
+            gmail.send_email(e["from"], f"Re: {e['subject']}", f"Inline reply to {e['id']}.")
+        inline = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for e in batch:
+            outbox.enqueue_reply(e, f"Thanks, noted ({e['id']}).")
+        queued = time.perf_counter() - start
+        sent_before = len(gmail_server.sent)
+        restart(outbox, rate_per_min=6000, concurrency=4)
+        drained = drain(outbox)
+        print(f"caller waits   inline: {inline:6.2f} s ({inline / n * 1000:.0f} ms/reply)   "
+              f"outbox: {queued * 1000:6.1f} ms ({queued / n * 1000:.2f} ms/reply)")
+        print(f"backlog of {n} sent in {drained:.2f} s at concurrency 4; "
+              f"delivered {len(gmail_server.sent) - sent_before}")
+
+        sent_before = len(gmail_server.sent)
+        again = [outbox.enqueue_reply(e, f"Thanks, noted ({e['id']}).") for e in batch]
+        clicks = []
+        threads = [threading.Thread(target=lambda: clicks.append(outbox.enqueue(
+            "a@example.com", "Re: launch", "See you Thursday.", source_message_id=batch[0]["id"]))) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        drain(outbox)
+        print("duplicates sent once:", all(e["duplicate"] for e in again)
+              and sum(not c["duplicate"] for c in clicks) == 1 and len(gmail_server.sent) - sent_before == 1)
+
+        gmail_server.latency = 0
+        sent_before = len(gmail_server.sent)
+        gmail_server.send_failures = 3
+        retried = [outbox.enqueue("b@example.com", f"Retry {i}", "Body.") for i in range(5)]
+        drain(outbox)
+        attempts = sum(outbox.get(e["outbox_id"])["attempts"] for e in retried)
+        print(f"transient 503s retried: {len(gmail_server.sent) - sent_before == 5} "
+              f"(5 delivered in {attempts} attempts, {outbox.stats()})")
+
+        restart(outbox, rate_per_min=120, concurrency=2)
+        for i in range(10):
+            outbox.enqueue("c@example.com", f"Paced {i}", "Body.")
+        paced = drain(outbox)
+        print(f"10 sends at 120/min with a burst of 2: {paced:.1f} s (expected ~{8 / 2:.0f} s)")
+
+        click = next(b for b in gmail_server.sent if "See you Thursday." in base64.urlsafe_b64decode(b["raw"]).decode())
+        headers = base64.urlsafe_b64decode(click["raw"]).decode()
+        print("reply threaded:", f"In-Reply-To:{batch[0]['headers']['message-id']}" in headers
+              and click.get("threadId") == batch[0]["threadId"])
+
+        sent_today = storage.query_one("SELECT COUNT(*) FROM outbox WHERE state='sent'")[0]
+        outbox.SENDS_PER_DAY = sent_today + 2
+        restart(outbox, rate_per_min=6000, concurrency=2)
+        capped = [outbox.enqueue("d@example.com", f"Capped {i}", "Body.") for i in range(5)]
+        time.sleep(1.5)
+        states = [outbox.get(e["outbox_id"])["state"] for e in capped]
+        print(f"daily cap holds: {states.count('sent') == 2 and states.count('queued') == 3} ({states})")
+
+        outbox.SENDS_PER_DAY = 10_000
+        restart(outbox, rate_per_min=6000, concurrency=2)
+        drain(outbox)
+        outbox.sender.stop(timeout=10)
+        # A process claims these, then dies: after Gmail sent the first, before it sent the second
+        delivered = outbox.enqueue_reply(batch[1], "Crashed after sending.")
+        unsent = outbox.enqueue_reply(batch[2], "Crashed before sending.")
+        unthreaded = outbox.enqueue("e@example.com", "Stranded", "Body.")
+        outbox.claim()
+        with storage.transaction() as conn:  # ...long enough ago for the claims to count as abandoned
+            conn.execute("UPDATE outbox SET claimed_at = claimed_at - ? WHERE state='sending'",
+                         (outbox.SEND_CLAIM_TIMEOUT + 1,))
+        gmail.send_email(batch[1]["from"], delivered["subject"], delivered["body"], thread_id=delivered["thread_id"],
+                         in_reply_to=delivered["in_reply_to"], references=delivered["refs"])
+        sent_before = len(gmail_server.sent)
+        restart(outbox, rate_per_min=6000, concurrency=2)
+        drain(outbox)
+        states = [outbox.get(e["outbox_id"])["state"] for e in (delivered, unsent, unthreaded)]
+        assert states == ["sent", "sent", "review"] and len(gmail_server.sent) - sent_before == 1, states
+        print(f"claims left by a crash: found in thread, sent, parked for review ({states})")
+        assert outbox.requeue(unthreaded["outbox_id"]) is not None  # the running sender may claim it at once
+        drain(outbox)
+        assert outbox.get(unthreaded["outbox_id"])["state"] == "sent"
+        print("a reviewed entry is sent once requeued")
+
+        # Another process's live claim is left alone
+        outbox.sender.stop(timeout=10)
+        live = outbox.enqueue("g@example.com", "In flight elsewhere", "Body.")
+        outbox.claim()
+        restart(outbox, rate_per_min=6000, concurrency=2)
+        time.sleep(0.5)
+        assert outbox.get(live["outbox_id"])["state"] == "sending"
+        with storage.transaction() as conn:
+            conn.execute("UPDATE outbox SET state='queued', claim_token=NULL WHERE outbox_id=?", (live["outbox_id"],))
+        drain(outbox)
+        print("a live claim from another process is not taken over")
+
+        # Gmail sends it but the connection drops before the answer: checked, not sent twice
+        sent_before = len(gmail_server.sent)
+        gmail_server.send_drops = 1
+        dropped = outbox.enqueue_reply(batch[3], "Answer lost on the way back.")
+        drain(outbox)
+        entry = outbox.get(dropped["outbox_id"])
+        assert entry["state"] == "sent" and len(gmail_server.sent) - sent_before == 1, (entry, gmail_server.sent[-2:])
+        print(f"lost answer not resent: {entry['state']} after {entry['attempts']} attempt(s), "
+              f"delivered {len(gmail_server.sent) - sent_before}")
+        outbox.sender.stop(timeout=10)
+
+        # main.py: no sender thread, drain() delivers before exit, retries included
+        gmail_server.send_failures = 1
+        cli = outbox.OutboxSender(rate_per_min=6000)
+        queued = [outbox.enqueue("f@example.com", f"CLI {i}", "Body.") for i in range(3)]
+        cli.drain(timeout=30)
+        states = [outbox.get(e["outbox_id"])["state"] for e in queued]
+        assert states == ["sent"] * 3, states
+        print("drain() sends before exit:", states)
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
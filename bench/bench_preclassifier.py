@@ -0,0 +1,184 @@
+# bench/bench_preclassifier.py
+
+"""
+Precision/recall of the no-action pre-classifier on a labeled corpus, and
+the share of decide_action LLM calls it avoids.
+
+The corpus is synthetic by default: newsletters, notifications and receipts
+(no action), plus personal mail that needs a reply, a meeting or a todo.
+Hard cases are included on both sides: list mail and outreach-tool mail
+that ask the user something directly, and plain "thanks!" notes that need
+nothing. Training labels get a little noise, as real LLM decisions would.
+Pass a JSONL file of {"from", "subject", "body", "headers", "no_action"}
+objects to evaluate on real mail instead.
+
+    python -m bench.bench_preclassifier [corpus.jsonl]
+"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+N_EMAILS = 2000
+TRAIN_SHARE = 0.7
+LABEL_NOISE = 0.03   # training labels flipped at random: LLM decisions are not perfectly consistent
+
+TOPICS = ["python", "machine learning", "cloud costs", "design systems", "productivity", "security", "startups"]
+NAMES = ["Priya", "Tom", "Aisha", "Marco", "Lena", "Kenji", "Sofia", "Omar"]
+PROJECTS = ["Q3 report", "launch plan", "budget review", "hiring pipeline", "API migration", "board deck"]
+
+
+def _newsletter(rng):
+    topic = rng.choice(TOPICS)
+    headers = {"list-unsubscribe": "<https://news.example.com/unsub>", "list-id": f"<{topic.replace(' ', '-')}.news.example.com>"}
+    if rng.random() < 0.6:
+        headers["precedence"] = "bulk"
+    return {
+        "from": f"The {topic.title()} Weekly <{rng.choice(['newsletter', 'hello', 'digest'])}@news.example.com>",
+        "subject": rng.choice([f"This week in {topic}", f"{rng.randint(3, 12)} {topic} stories you missed",
+                               f"Your {topic} digest", f"Last chance: {rng.randint(10, 50)}% off {topic} courses"]),
+        "body": f"Top stories in {topic} this week. Read more on our site. "
+                f"Upgrade to premium for exclusive content. You are receiving this email because you subscribed. "
+                f"Unsubscribe or manage your preferences.",
+        "headers": headers,
+    }, True
+
+
+def _notification(rng):
+    n = rng.randint(100, 9999)
+    kind = rng.choice(["comment", "build", "login", "calendar"])
+    email = {
+        "comment": ("GitHub <notifications@github.example.com>", f"[acme/api] New comment on issue #{n}",
+                    f"@bot commented on issue #{n}. View it on GitHub. You are receiving this because you are subscribed to this thread."),
+        "build": ("CI <builds@ci.example.com>", f"Build #{n} passed on main",
+                  f"All checks passed for commit {n:x}. Duration 4m 12s. View build logs."),
+        "login": ("Security <no-reply@accounts.example.com>", "New sign-in to your account",
+                  "We noticed a new sign-in from Chrome on Mac. If this was you, no action is needed."),
+        "calendar": ("Calendar <calendar-notification@example.com>", f"Reminder: standup at {rng.randint(8, 11)}:00",
+                     "This is an automatic reminder for your upcoming event. Join with the meeting link."),
+    }[kind]
+    headers = {"auto-submitted": "auto-generated"} if rng.random() < 0.5 else {}
+    return {"from": email[0], "subject": email[1], "body": email[2], "headers": headers}, True
+
+
+def _receipt(rng):
+    n = rng.randint(10000, 99999)
+    shop = rng.choice(["Shop", "Bookstore", "Airline", "Grocer"])
+    return {
+        "from": f"{shop} <{rng.choice(['no-reply', 'orders', 'receipts'])}@{shop.lower()}.example.com>",
+        "subject": rng.choice([f"Your order #{n} has shipped", f"Receipt for order #{n}", f"Booking confirmation {n}"]),
+        "body": f"Thank you for your purchase. Order #{n}. Total ${rng.randint(5, 500)}.{rng.randint(10, 99)}. "
+                f"Track your package or view your receipt online.",
+        "headers": {"list-unsubscribe": "<mailto:unsub@example.com>"} if rng.random() < 0.3 else {},
+    }, True
+
+
+def _thanks(rng):
+    name = rng.choice(NAMES)
+    return {
+        "from": f"{name} <{name.lower()}@work.example.com>",
+        "subject": rng.choice(["Re: " + rng.choice(PROJECTS), "Thanks!", "Re: quick update"]),
+        "body": rng.choice(["Thanks, got it!", "Sounds good, thank you.", "Perfect, appreciate it.",
+                            "Great, thanks for the update."]) + f" Cheers, {name}",
+        "headers": {},
+    }, True
+
+
+def _request(rng):
+    name, project = rng.choice(NAMES), rng.choice(PROJECTS)
+    day = rng.choice(["Monday", "Tuesday", "Thursday", "Friday"])
+    body = rng.choice([
+        f"Hi Saral, could you send me the latest {project} by {day}? I need it for the review.",
+        f"Are you free on {day} at {rng.randint(1, 5)}pm to go through the {project}? Let me know what works.",
+        f"Can you take a look at the {project} and share your feedback? A few open questions inside.",
+        f"Quick question about the {project}: should we move the deadline to {day}? Please reply when you can.",
+        f"Please add the {project} follow-up to your list, due {day}.",
+    ])
+    email = {
+        "from": f"{name} <{name.lower()}@work.example.com>",
+        "subject": rng.choice([project, f"Question about the {project}", f"Meeting on {day}?", "Quick ask",
+                               "Re: " + project]),
+        "body": body + f" Thanks, {name}",
+        "headers": {},
+    }
+    if rng.random() < 0.15:
+        # Sent through a sales/outreach tool: looks bulk, still wants a reply
+        email["from"] = f"{name} <{name.lower()}@vendor.example.com>"
+        email["body"] += " Sent with Outreach. Unsubscribe from these emails."
+        email["headers"] = {"list-unsubscribe": "<https://outreach.example.com/u>"}
+    return email, False
+
+
+def _list_question(rng):
+    """Mailing-list mail that still needs the user: list headers, but a direct ask"""
+    name, project = rng.choice(NAMES), rng.choice(PROJECTS)
+    return {
+        "from": f"{name} via team-list <team@lists.example.com>",
+        "subject": f"[team] {project}: need your sign-off",
+        "body": f"@Saral can you confirm you are ok with the {project} by tomorrow? We are blocked until you reply. {name}",
+        "headers": {"list-id": "<team.lists.example.com>", "list-unsubscribe": "<mailto:leave@lists.example.com>"},
+    }, False
+
+
+GENERATORS = [
+    (_newsletter, 0.30), (_notification, 0.20), (_receipt, 0.10), (_thanks, 0.05),
+    (_request, 0.30), (_list_question, 0.05),
+]
+
+
+def make_labeled_corpus(n=N_EMAILS, seed=7):
+    rng = random.Random(seed)
+    makers, weights = zip(*GENERATORS)
+    return [rng.choices(makers, weights)[0](rng) for _ in range(n)]
+
+
+def load_corpus(path):
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [({k: row.get(k) for k in ("from", "subject", "body", "headers")}, bool(row["no_action"])) for row in rows]
+
+
+def evaluate(classifier, examples):
+    tp = fp = fn = 0
+    start = time.perf_counter()
+    for email, no_action in examples:
+        skip, _ = classifier.preclassify(email)
+        tp += skip and no_action
+        fp += skip and not no_action
+        fn += (not skip) and no_action
+    elapsed = time.perf_counter() - start
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    return precision, recall, (tp + fp) / len(examples), fp, elapsed / len(examples)
+
+
+def main(path=None):
+    corpus = load_corpus(path) if path else make_labeled_corpus()
+    random.Random(0).shuffle(corpus)
+    split = int(len(corpus) * TRAIN_SHARE)
+    train_set, test_set = corpus[:split], corpus[split:]
+    noise = random.Random(1)
+    train_set = [(email, no_action != (noise.random() < LABEL_NOISE)) for email, no_action in train_set]
+    share = sum(no_action for _, no_action in corpus) / len(corpus)
+    print(f"{len(corpus)} emails ({share:.0%} no-action): train {len(train_set)}, test {len(test_set)}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        from agent import classifier
+
+        rows = [("headers only", None), ("trained model", train_set)]
+        for name, training in rows:
+            if training:
+                start = time.perf_counter()
+                classifier.train(examples=training)
+                print(f"trained on {len(training)} decisions in {time.perf_counter() - start:.2f} s")
+            precision, recall, skipped, fp, per_email = evaluate(classifier, test_set)
+            print(f"{name:<14} precision {precision:.3f}  recall {recall:.3f}  "
+                  f"LLM calls avoided {skipped:.1%}  wrongly skipped {fp}  {per_email * 1e6:.0f} us/email")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,72 @@
+# bench/bench_process.py
+
+"""
+End-to-end process_emails throughput against fake Gmail and OpenAI servers
+with injected latency: serial versus the concurrent pipeline, and the
+default multi-call mode versus SINGLE_PASS. Each run starts from empty
+thread memory and LLM cache, and serial and concurrent runs must make the
+same number of upstream calls.
+
+    python -m bench.bench_process [n_emails] [concurrency]
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from bench.fake_gmail import FakeGmailServer, make_mailbox, point_agent_at
+from bench.fake_openai import FakeOpenAIServer
+
+LLM_LATENCY = 0.15
+GMAIL_LATENCY = 0.03
+
+
+def run(llm_agent, emails, concurrency):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = llm_agent.process_emails(emails, concurrency=concurrency, rate_per_min=0)
+    elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def main(n=40, concurrency=8):
+    with FakeGmailServer(make_mailbox(n, thread_depth=2), latency=GMAIL_LATENCY) as gmail_server, \
+            FakeOpenAIServer(latency=LLM_LATENCY) as llm_server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+        os.environ["OPENAI_BASE_URL"] = llm_server.base_url
+        point_agent_at(gmail_server.root_url, tmp)
+
+        from agent import gmail, llm_agent, storage
+
+        emails = gmail.fetch_emails(n)
+        print(f"{len(emails)} emails, {len({e['threadId'] for e in emails})} threads, "
+              f"LLM latency {LLM_LATENCY * 1000:.0f} ms, Gmail latency {GMAIL_LATENCY * 1000:.0f} ms")
+
+        for single_pass in (False, True):
+            llm_agent.SINGLE_PASS = single_pass
+            mode = "single-pass" if single_pass else "multi-call"
+            calls = {}
+            for workers in (1, concurrency):
+                # Every run starts cold: no thread memory, nothing served from the LLM cache
+                with storage.transaction() as conn:
+                    conn.execute("DELETE FROM threads")
+                    conn.execute("DELETE FROM llm_cache")
+                llm_server.reset_counters()
+                results, elapsed = run(llm_agent, emails, workers)
+                errors = sum(r["action"] == "error" for r in results)
+                calls[workers] = llm_server.calls
+                print(f"{mode:<11} concurrency {workers:>2}: {len(results) / elapsed:6.2f} emails/s  "
+                      f"{elapsed:6.2f} s  {llm_server.calls} LLM calls  "
+                      f"{llm_server.prompt_tokens} prompt tokens  "
+                      f"peak {llm_server.max_in_flight} in flight  {errors} errors")
+            assert calls[1] == calls[concurrency], f"{mode}: upstream calls differ by concurrency {calls}"
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    main(*args)
@@ -0,0 +1,151 @@
+# bench/bench_prompts.py
+
+"""
+Prompt tokens per call with and without agent/prompts.py, on a corpus of
+the emails that blow prompts up: deep "On ... wrote:" reply chains,
+Outlook history blocks, long signatures, bare forwards, pasted logs, and
+threads where every message quotes all the ones before it.
+
+Each email goes through the real prompt builders (decide_action,
+generate_reply, summarize_email, thread summary); no LLM is called. The
+"kept" column checks that the sentence carrying the actual request
+survived cleaning and truncation.
+
+    python -m bench.bench_prompts
+"""
+
+import os
+import random
+import tempfile
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+from agent import functions, llm_agent, prompts
+
+ASK = "Could you confirm the launch date for the Berlin region by Thursday?"
+NAMES = ["Priya", "Tom", "Aisha", "Marco", "Lena"]
+FILLER = ("thanks for the update on the rollout we looked at the numbers again and they still look "
+          "reasonable although the second region is a bit behind the plan").split()
+
+
+def _sentences(rng, n):
+    return " ".join(" ".join(rng.choice(FILLER) for _ in range(15)).capitalize() + "." for _ in range(n))
+
+
+def _signature(name):
+    return (f"\n\n--\n{name} Example\nSenior Program Manager, Platform\nExample Corp | 1 Market St, SF\n"
+            "+1 555 0100 | example.com\nCONFIDENTIALITY NOTICE: This email and any attachments are for the "
+            "exclusive and confidential use of the intended recipient. " * 3)
+
+
+def deep_reply_chain(rng, ask, depth=8):
+    body = _sentences(rng, 3)
+    for level in range(depth):
+        name = rng.choice(NAMES)
+        header = f"On Mon, Mar {level + 1}, 2026 at 10:0{level % 10} AM {name} <{name.lower()}@example.com> wrote:"
+        quoted = "\n".join("> " + line for line in body.splitlines())
+        body = f"{_sentences(rng, 3)}\n\n{header}\n{quoted}"
+    return f"{ask}\n\n{body}"
+
+
+def outlook_reply(rng, ask):
+    history = "\n\n".join(
+        f"From: {name} <{name.lower()}@example.com>\nSent: Monday, March 2, 2026 9:15 AM\n"
+        f"To: Saral <saral@example.com>\nSubject: RE: Rollout\n\n{_sentences(rng, 6)}"
+        for name in NAMES * 2
+    )
+    return f"{ask}\n\nBest,\nTom\n\n________________________________\n{history}"
+
+
+def signature_heavy(rng, ask):
+    return f"{ask} {_sentences(rng, 2)}" + _signature("Lena") + "\n\nSent from my iPhone"
+
+
+def bare_forward(rng, ask):
+    return (f"---------- Forwarded message ---------\nFrom: Vendor <sales@vendor.example.com>\n"
+            f"Date: Tue, Mar 3, 2026\nSubject: Proposal\n\n{ask} {_sentences(rng, 120)}")
+
+
+def pasted_log(rng, ask):
+    lines = "\n".join(f"2026-03-02T10:{i // 60:02d}:{i % 60:02d}Z worker-{i % 7} retry {i} upstream 503" for i in range(2500))
+    return f"{ask}\n\nFull log below:\n{lines}"
+
+
+def short_email(rng, ask):
+    return f"Hi Saral, {ask} Thanks!"
+
+
+EMAILS = [
+    ("short", short_email), ("reply chain x8", deep_reply_chain), ("outlook history", outlook_reply),
+    ("signature", signature_heavy), ("bare forward", bare_forward), ("pasted log", pasted_log),
+]
+
+
+def quoting_thread(rng, n_messages, ask):
+    """A thread where every message quotes everything before it"""
+    messages, previous = [], ""
+    for i in range(n_messages):
+        name = NAMES[i % len(NAMES)]
+        text = _sentences(rng, 4) if i < n_messages - 1 else ask
+        if previous:
+            quoted = "\n".join("> " + line for line in previous.splitlines())
+            text = f"{text}\n\nOn Mon, Mar 2, 2026 at 9:{i:02d} AM Someone <x@example.com> wrote:\n{quoted}"
+        messages.append({"from": f"{name} <{name.lower()}@example.com>", "body": text})
+        previous = text
+    return messages
+
+
+def tokens(messages):
+    return sum(prompts.count_tokens(m["content"]) for m in messages)
+
+
+def build_email_prompts(body):
+    email = {"from": "Priya <priya@example.com>", "threadId": "t1", "body": body}
+    summary = "Priya asked for the rollout numbers; Saral sent the draft. " * 3
+    return {
+        "decide_action": llm_agent._decide_messages(email, summary, "generate_reply"),
+        "generate_reply": functions._reply_messages(body, email["from"]),
+        "summarize_email": functions._summarize_messages(body),
+    }
+
+
+def compare(build, *args):
+    """{call: (raw tokens, budgeted tokens, ask kept)}"""
+    prompts.PROMPT_BUDGETING = False
+    raw = build(*args)
+    prompts.PROMPT_BUDGETING = True
+    budgeted = build(*args)
+    return {
+        call: (tokens(raw[call]), tokens(budgeted[call]),
+               all(ASK in m["content"] for m in budgeted[call] if m["role"] == "user"))
+        for call in raw
+    }
+
+
+def main():
+    rng = random.Random(5)
+    print(f"tokenizer: {prompts.stats()['tokenizer']}")
+    print(f"{'input':<16} {'call':<16} {'raw':>8} {'budgeted':>9} {'saved':>7}  kept")
+    rows = [(name, compare(build_email_prompts, make(rng, ASK))) for name, make in EMAILS]
+    for n in (5, 15, 30):
+        rows.append((f"{n}-msg thread", compare(
+            lambda thread: {"thread_summary": llm_agent._thread_summary_messages(thread, 4)},
+            quoting_thread(rng, n, ASK),
+        )))
+
+    totals = {}
+    for name, results in rows:
+        for call, (before, after, kept) in results.items():
+            total = totals.setdefault(call, [0, 0])
+            total[0] += before
+            total[1] += after
+            print(f"{name:<16} {call:<16} {before:>8} {after:>9} {1 - after / before:>6.0%}  {'yes' if kept else 'NO'}")
+    print()
+    for call, (before, after) in totals.items():
+        print(f"{call:<16} total {before:>8} -> {after:>7} tokens ({1 - after / before:.0%} fewer)")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        main()
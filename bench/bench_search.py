@@ -0,0 +1,159 @@
+# bench/bench_search.py
+
+"""
+Local search over a generated mailbox: FTS5 (agent/search.py) versus the
+LIKE scan over the messages table that is the only alternative without
+an index. Reports query latency, what the index triggers add to message
+ingest, and checks that the index follows inserts, summary updates and
+deletes, and that migrating an existing database indexes its rows.
+
+    python -m bench.bench_search [n_messages]
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from bench.mailbox import WORDS, generate_mailbox
+from bench.run import fake_environment
+
+SHAPES = {"plain": 40, "alternative": 40, "newsletter": 20}
+VOCABULARY = 20_000           # synthetic words, Zipf-distributed like real text
+WORDS_PER_BODY = 150
+QUERIES = [
+    ("rare word", "w14321"), ("mid-frequency word", "w00420"), ("common word", "w00003"),
+    ("two rare words", "w01234 w00777"), ("typing, 2 chars", "w1"), ("typing, 4 chars", "w012"),
+    ("phrase", "\"region launch\""), ("needle", "berlin"),
+]
+RUNS = 20
+
+
+def parsed_messages(n, seed=1):
+    from agent import gmail
+
+    raw, _ = generate_mailbox(n, thread_depth=(1, 5), shapes=SHAPES, seed=seed)
+    messages = [gmail._parse_message(m) for m in raw]
+    rng = random.Random(seed)
+    vocabulary = [f"w{i:05d}" for i in range(VOCABULARY)]
+    weights = [1 / (i + 1) for i in range(VOCABULARY)]
+    for m in messages:
+        m["body"] += "\n" + " ".join(rng.choices(vocabulary, weights, k=WORDS_PER_BODY))
+    for m in rng.sample(messages, max(1, n // 500)):
+        m["body"] += " The Berlin region launch moved to Thursday."
+    return messages
+
+
+def timed(fn, runs=RUNS):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return out, samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def like_scan(storage, text):
+    words = text.replace('"', "").split()
+    where = " AND ".join("(subject LIKE ? OR sender LIKE ? OR body LIKE ?)" for _ in words)
+    params = [f"%{w}%" for w in words for _ in range(3)]
+    return storage.query_all(f"SELECT message_id FROM messages WHERE {where} LIMIT 20", params)
+
+
+def check_incremental(storage, search, llm_agent, message_cache, messages):
+    llm_agent.update_thread_memory("t-check", "Vendor asked about zeppelin pricing.", "summarize_email")
+    found = any(h["id"] == "t-check" for h in search.search("zeppelin", kinds=("thread",)))
+    llm_agent.update_thread_memory("t-check", "Vendor asked about airship pricing.", "summarize_email")
+    stale = any(h["id"] == "t-check" for h in search.search("zeppelin", kinds=("thread",)))
+    victim = messages[0]
+    before = any(h["id"] == victim["id"] for h in search.search(victim["subject"], kinds=("message",), limit=100))
+    message_cache.delete([victim["id"]])
+    after = any(h["id"] == victim["id"] for h in search.search(victim["subject"], kinds=("message",), limit=100))
+    message_cache.put_many([victim])
+    with storage.transaction() as conn:
+        integrity = conn.execute("INSERT INTO messages_fts(messages_fts, rank) VALUES ('integrity-check', 1)")
+    return found and not stale and before and not after and integrity is not None
+
+
+def check_interleaved(search, functions):
+    """Each kind's best hit comes before any kind's second best, whatever the BM25 scales"""
+    functions.add_to_todo("Book the Berlin offsite", "Friday")
+    hits = search.search("berlin", limit=10)
+    kinds = [h["kind"] for h in hits]
+    return kinds[:2] == ["message", "todo"] and kinds[2:4] == ["message", "message"]
+
+
+def check_migration(tmp, messages):
+    """A database at schema version 6 with mail in it gets indexed on upgrade"""
+    from agent import search, storage
+
+    path = os.path.join(tmp, "old.db")
+    conn = sqlite3.connect(path)
+    for migration in storage.MIGRATIONS[:6]:
+        migration(conn)
+    conn.execute("PRAGMA user_version = 6")
+    conn.executemany("INSERT INTO messages (message_id, thread_id, sender, subject, body) VALUES (?, ?, ?, ?, ?)",
+                     [(m["id"], m["threadId"], m["from"], m["subject"], m["body"]) for m in messages])
+    conn.commit()
+    conn.close()
+    storage.DB_PATH, previous = path, storage.DB_PATH
+    try:
+        return len(search.search("berlin", kinds=("message",), limit=100)) > 0
+    finally:
+        storage.DB_PATH = previous
+
+
+def main(n=5000):
+    with fake_environment():
+        tmp = os.getcwd()
+        from agent import functions, llm_agent, search, storage
+        from agent.message_cache import message_cache
+
+        start = time.perf_counter()
+        messages = parsed_messages(n)
+        print(f"{len(messages)} messages generated in {time.perf_counter() - start:.1f} s")
+
+        storage.init_db()
+        start = time.perf_counter()
+        for i in range(0, len(messages), 100):
+            message_cache.put_many(messages[i:i + 100])
+        indexed = time.perf_counter() - start
+
+        storage.DB_PATH = "plain.db"
+        storage.init_db()
+        with storage.transaction() as conn:
+            for table in ("messages", "threads", "todo"):
+                for op in ("insert", "delete", "update"):
+                    conn.execute(f"DROP TRIGGER {table}_fts_{op}")
+        start = time.perf_counter()
+        for i in range(0, len(messages), 100):
+            message_cache.put_many(messages[i:i + 100])
+        plain = time.perf_counter() - start
+        storage.DB_PATH = "assistant.db"
+        print(f"ingest: {len(messages) / plain:7.0f} msg/s without the index, {len(messages) / indexed:7.0f} msg/s "
+              f"with it ({indexed / plain - 1:+.0%})")
+
+        threads = list(dict.fromkeys(m["threadId"] for m in messages))
+        with storage.batched_writes():
+            for t in threads:
+                llm_agent.update_thread_memory(t, " ".join(random.Random(t).choices(WORDS, k=25)), "summarize_email")
+        size = os.path.getsize("assistant.db") / 1e6
+        print(f"database {size:.1f} MB with the index, {os.path.getsize('plain.db') / 1e6:.1f} MB without")
+
+        print(f"\n{'query':<34} {'hits':>5} {'fts p50':>9} {'p99':>8}   {'LIKE p50':>9} {'p99':>8}")
+        for name, text in QUERIES:
+            hits, fts50, fts99 = timed(lambda: search.search(text))
+            _, like50, like99 = timed(lambda: like_scan(storage, text), runs=5)
+            print(f"{name + ' ' + text:<34} {len(hits):>5} {fts50 * 1000:7.2f}ms {fts99 * 1000:6.2f}ms   "
+                  f"{like50 * 1000:7.2f}ms {like99 * 1000:6.2f}ms")
+        print("top hit for 'berlin':", search.search("berlin")[0]["snippet"])
+
+        print("\nincremental updates correct:", check_incremental(storage, search, llm_agent, message_cache, messages))
+        print("kinds interleaved:", check_interleaved(search, functions))
+        print("migration indexes existing mail:", check_migration(tmp, messages))
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,110 @@
+# bench/bench_storage.py
+
+"""
+ops/sec for get_thread_memory / update_thread_memory / add_to_todo under N
+concurrent writer threads: the old connect-DDL-commit-close path versus the
+pooled WAL connections in agent/storage.py.
+
+    python -m bench.bench_storage [ops_per_writer] [writers ...]
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from agent import storage
+
+
+def legacy_ops(db_path):
+    """The pre-storage-module implementations, one connection per call"""
+
+    def init_db():
+        conn = sqlite3.connect(db_path)
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS threads (thread_id TEXT PRIMARY KEY, summary TEXT, last_action TEXT)")
+        cur.execute("CREATE TABLE IF NOT EXISTS todo (id INTEGER PRIMARY KEY AUTOINCREMENT, task TEXT, due_date TEXT)")
+        conn.commit()
+        conn.close()
+
+    def get_thread_memory(thread_id):
+        init_db()
+        conn = sqlite3.connect(db_path)
+        row = conn.execute("SELECT summary, last_action FROM threads WHERE thread_id=?", (thread_id,)).fetchone()
+        conn.close()
+        return row
+
+    def update_thread_memory(thread_id, summary, last_action):
+        init_db()
+        conn = sqlite3.connect(db_path)
+        conn.execute("""
+            INSERT INTO threads (thread_id, summary, last_action) VALUES (?, ?, ?)
+            ON CONFLICT(thread_id) DO UPDATE SET summary=?, last_action=?
+        """, (thread_id, summary, last_action, summary, last_action))
+        conn.commit()
+        conn.close()
+
+    def add_to_todo(task, due_date):
+        init_db()
+        conn = sqlite3.connect(db_path)
+        conn.execute("INSERT INTO todo (task, due_date) VALUES (?, ?)", (task, due_date))
+        conn.commit()
+        conn.close()
+
+    return get_thread_memory, update_thread_memory, add_to_todo
+
+
+def pooled_ops():
+    from agent.functions import add_to_todo
+    from agent.llm_agent import get_thread_memory, update_thread_memory
+
+    return get_thread_memory, update_thread_memory, add_to_todo
+
+
+def run(ops, writers, ops_per_writer):
+    get_memory, update_memory, add_todo = ops
+    errors = []
+
+    def writer(n):
+        try:
+            for i in range(ops_per_writer):
+                thread_id = f"t{n}-{i % 50}"
+                get_memory(thread_id)
+                update_memory(thread_id, f"summary {i}", "reply_sent")
+                add_todo(f"task {n}-{i}", "2026-01-01")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return writers * ops_per_writer * 3 / elapsed, errors
+
+
+def main(ops_per_writer=200, writer_counts=(1, 4, 16)):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ.setdefault("OPENAI_API_KEY", "unused")
+        pooled = pooled_ops()
+        for writers in writer_counts:
+            legacy_db = os.path.join(tmp, f"legacy-{writers}.db")
+            storage.DB_PATH = os.path.join(tmp, f"pooled-{writers}.db")
+            legacy_rate, legacy_errors = run(legacy_ops(legacy_db), writers, ops_per_writer)
+            pooled_rate, pooled_errors = run(pooled, writers, ops_per_writer)
+            print(f"{writers:>3} writers: legacy {legacy_rate:9.0f} ops/s ({len(legacy_errors)} errors)  "
+                  f"pooled {pooled_rate:9.0f} ops/s ({len(pooled_errors)} errors)  "
+                  f"{pooled_rate / legacy_rate:5.1f}x")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:]]
+    if len(args) > 1:
+        main(args[0], args[1:])
+    else:
+        main(*args)
@@ -0,0 +1,82 @@
+# bench/bench_sync.py
+
+"""
+Incremental sync (gmail.sync_history + worker.run_cycle) against the fake
+Gmail server when fetching new mail fails: the arrivals must still land
+in the work queue with the cursor, a cycle that raises must not leave its
+claim running, and everything is processed once Gmail recovers.
+
+    python -m bench.bench_sync
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+
+from bench.fake_gmail import FakeGmailServer, point_agent_at
+from bench.fake_openai import FakeOpenAIServer
+from bench.mailbox import generate_mailbox
+
+
+def main():
+    messages, attachments = generate_mailbox(6, seed=11)
+    first, later = messages[:3], messages[3:]
+    with FakeGmailServer(first, attachments=attachments) as gmail_server, FakeOpenAIServer() as llm_server, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+        os.environ["OPENAI_BASE_URL"] = llm_server.base_url
+        point_agent_at(gmail_server.root_url, tmp)
+        with contextlib.redirect_stdout(io.StringIO()):
+            from agent import gmail, llm_agent, storage, worker
+            storage.init_db()
+        llm_agent.AUTO_SEND = False
+        gmail.BATCH_RETRY_BACKOFF = 0.01
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            worker.run_cycle()  # full resync sets the cursor
+        cursor = gmail.get_history_id()
+
+        for m in later:
+            gmail_server.add_message(m)
+        get_message = gmail_server._get_message
+        gmail_server._get_message = lambda msg_id, query: (503, {"error": {"code": 503, "message": "Backend Error"}})
+        with contextlib.redirect_stdout(io.StringIO()):
+            processed, failed = worker.run_cycle()
+        rows = dict(storage.query_all("SELECT message_id, state FROM work_queue"))
+        assert processed == 0 and failed == len(later), (processed, failed)
+        assert all(rows.get(m["id"]) == "retry" for m in later), rows
+        assert gmail.get_history_id() != cursor
+        print(f"fetch failing: {len(later)} arrivals queued for retry, cursor advanced with them")
+
+        # An exception mid-cycle (not just failed items) must not strand the claim
+        with storage.transaction() as conn:
+            conn.execute("UPDATE work_queue SET next_attempt_at=0")
+        def fetch_raising(ids):
+            raise ConnectionResetError("connection reset")
+        worker.fetch_messages = fetch_raising
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                worker.run_cycle()
+            raise AssertionError("run_cycle swallowed the fetch error")
+        except ConnectionResetError:
+            pass
+        rows = dict(storage.query_all("SELECT message_id, state FROM work_queue"))
+        assert all(rows[m["id"]] == "retry" for m in later), rows
+        print(f"fetch raising: {len(later)} claimed arrivals released for retry, none left running")
+        worker.fetch_messages = gmail.fetch_messages
+
+        gmail_server._get_message = get_message
+        with storage.transaction() as conn:
+            conn.execute("UPDATE work_queue SET next_attempt_at=0")
+        with contextlib.redirect_stdout(io.StringIO()):
+            processed, failed = worker.run_cycle()
+        rows = dict(storage.query_all("SELECT message_id, state FROM work_queue"))
+        assert processed == len(later) and failed == 0, (processed, failed)
+        assert all(rows[m["id"]] == "done" for m in later), rows
+        print(f"after recovery: {processed} processed, none lost")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# bench/bench_thread_memory.py
+
+"""
+What one dashboard render costs the backend: the Inbox and Thread Memory
+tabs as they were (full /emails, metadata /emails, then /thread/{id} per
+email, each re-downloading the thread) versus one shared /emails and one
+/threads/memory call. Reports backend round trips, Gmail requests and wall
+time per render, and checks both return the same summaries.
+
+    python -m bench.bench_thread_memory [n_emails]
+"""
+
+import contextlib
+import io
+import sys
+import time
+
+import httpx
+
+from bench.bench_api_load import serve
+from bench.mailbox import generate_mailbox
+from bench.run import fake_environment
+
+GMAIL_LATENCY = 0.03
+PORT = 8631
+
+
+def render_before(http, base_url, n):
+    emails = http.get(f"{base_url}/emails", params={"n": n}).json()
+    listed = http.get(f"{base_url}/emails", params={"n": n, "metadata_only": True}).json()
+    memories = {e["threadId"]: http.get(f"{base_url}/thread/{e['threadId']}").json() for e in listed}
+    return emails, {t: (m["summary"], m["last_action"]) for t, m in memories.items()}, 2 + len(listed)
+
+
+def render_after(http, base_url, n):
+    emails = http.get(f"{base_url}/emails", params={"n": n}).json()
+    thread_ids = list(dict.fromkeys(e["threadId"] for e in emails))
+    threads = http.get(f"{base_url}/threads/memory", params={"ids": ",".join(thread_ids)}).json()["threads"]
+    return emails, {t["thread_id"]: (t["summary"], t["last_action"]) for t in threads}, 2
+
+
+def main(n=10):
+    messages, attachments = generate_mailbox(n * 3, thread_depth=(1, 3), seed=3)
+    with fake_environment(messages, attachments, gmail_latency=GMAIL_LATENCY) as (gmail_server, _):
+        with contextlib.redirect_stdout(io.StringIO()):
+            import run_app
+            from agent import llm_agent, storage
+            storage.init_db()
+        for i, thread_id in enumerate(dict.fromkeys(m["threadId"] for m in messages)):
+            llm_agent.update_thread_memory(thread_id, f"Summary of thread {i}.", "generate_reply")
+        run_app.prefetcher.submit = lambda emails: None  # drafting is not what this measures
+
+        server = serve(run_app.app, PORT)
+        base_url = f"http://127.0.0.1:{PORT}"
+        print(f"{n} emails per /emails page, Gmail latency {GMAIL_LATENCY * 1000:.0f} ms")
+        try:
+            with httpx.Client(timeout=60) as http:
+                results = {}
+                for name, render in (("before", render_before), ("after", render_after)):
+                    render(http, base_url, n)  # warm the message cache, as a second render would
+                    gmail_server.reset_counters()
+                    start = time.perf_counter()
+                    emails, memories, round_trips = render(http, base_url, n)
+                    elapsed = time.perf_counter() - start
+                    results[name] = memories
+                    print(f"{name:<7} {round_trips:>3} backend requests  {gmail_server.round_trips:>3} Gmail requests  "
+                          f"{elapsed * 1000:7.0f} ms per render  ({len(emails)} emails, {len(memories)} threads)")
+                print("same summaries:", results["before"] == results["after"])
+        finally:
+            server.should_exit = True
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
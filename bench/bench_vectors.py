@@ -0,0 +1,133 @@
+# bench/bench_vectors.py
+
+"""
+Query latency of the related-conversation index (agent/vectors.py) at
+10k, 100k and 1M vectors of EMBEDDING_DIM float32s in a memory-mapped file:
+
+- top_k() alone, one query at a time and in batches of 32
+- VectorIndex.nearest(), which adds the SQLite metadata lookup, and
+  nearest_many() for a batch of 32 as process_emails() uses it
+- a pure-Python cosine loop, at 10k only, for scale
+
+Also checks top_k() against an exact full sort across block boundaries,
+and reports the peak memory a 1M search allocates (the matrix itself is
+paged in by the OS, not copied).
+
+    python -m bench.bench_vectors [sizes ...]
+"""
+
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+SIZES = (10_000, 100_000, 1_000_000)
+QUERIES = 50
+BATCH = 32
+K = 10
+BUILD_CHUNK = 100_000
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2] * 1000, samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000
+
+
+def build(vectors, storage, n, dim, rng):
+    """An index with n random vectors and their metadata rows"""
+    index = vectors.get_index()
+    matrix = index._mapped(n)
+    for start in range(0, n, BUILD_CHUNK):
+        stop = min(n, start + BUILD_CHUNK)
+        matrix[start:stop] = vectors.normalize(rng.standard_normal((stop - start, dim), dtype=np.float32))
+    matrix.flush()
+    with storage.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO vectors (space, kind, ref_id, row, content_hash, thread_id, sender, snippet, created_at) "
+            "VALUES (?, 'message', ?, ?, ?, ?, 'bench@example.com', 'snippet', 0)",
+            ((index.space, f"m{row}", row, f"h{row}", f"t{row // 3}") for row in range(n)),
+        )
+    return index
+
+
+def python_top_k(rows, query, k):
+    scores = []
+    for i, row in enumerate(rows):
+        scores.append((sum(a * b for a, b in zip(row, query)), i))
+    return sorted(scores, reverse=True)[:k]
+
+
+def check_exact(vectors, matrix, n, queries):
+    rows, _ = vectors.top_k(matrix, n, queries, K, block=n // 7 + 1)
+    exact = np.argsort(-(queries @ matrix[:n].T), axis=1)[:, :K]
+    return bool((rows == exact).all())
+
+
+def main(*sizes):
+    sizes = sizes or SIZES
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ.setdefault("OPENAI_API_KEY", "bench")
+        from agent import storage, vectors
+
+        dim = vectors.EMBEDDING_DIM
+        rng = np.random.default_rng(0)
+        print(f"dim {dim}, k {K}, block {vectors.SEARCH_BLOCK} rows")
+        print(f"{'vectors':>9} {'file MB':>8} {'build s':>8}   {'1 query p50/p99 ms':>19}   "
+              f"{'per query in x' + str(BATCH):>18}   {'nearest() p50/p99 ms':>21}   {'nearest_many x' + str(BATCH):>16}")
+        for n in sizes:
+            storage.DB_PATH = f"bench_{n}.db"
+            start = time.perf_counter()
+            index = build(vectors, storage, n, dim, rng)
+            built = time.perf_counter() - start
+            matrix = index._mapped(n)
+            queries = vectors.normalize(rng.standard_normal((QUERIES, dim), dtype=np.float32))
+
+            vectors.top_k(matrix, n, queries[:1], K)  # page the file in
+            single = []
+            for q in queries:
+                start = time.perf_counter()
+                vectors.top_k(matrix, n, q, K)
+                single.append(time.perf_counter() - start)
+            batched = []
+            for i in range(0, QUERIES - BATCH + 1, BATCH) or [0]:
+                start = time.perf_counter()
+                vectors.top_k(matrix, n, queries[i:i + BATCH], K)
+                batched.append((time.perf_counter() - start) / BATCH)
+            nearest = []
+            for q in queries:
+                start = time.perf_counter()
+                index.nearest(q, k=3)
+                nearest.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            index.nearest_many(queries[:BATCH], k=3)
+            nearest_many = (time.perf_counter() - start) / BATCH
+
+            p50, p99 = percentiles(single)
+            n50, n99 = percentiles(nearest)
+            size = os.path.getsize(index.path) / 1e6
+            print(f"{n:>9} {size:8.0f} {built:8.1f}   {p50:9.2f} / {p99:7.2f}   {sum(batched) / len(batched) * 1000:15.2f} ms"
+                  f"   {n50:10.2f} / {n99:7.2f}   {nearest_many * 1000:10.2f} ms")
+
+            if n == sizes[0]:
+                rows = matrix[:n].tolist()
+                q = queries[0].tolist()
+                start = time.perf_counter()
+                python_top_k(rows, q, K)
+                print(f"{'':>9} pure-Python loop: {(time.perf_counter() - start) * 1000:.0f} ms per query")
+                print(f"{'':>9} matches an exact sort across blocks: {check_exact(vectors, matrix, n, queries[:8])}")
+            if n == max(sizes):
+                tracemalloc.start()
+                vectors.top_k(matrix, n, queries[:1], K)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f"{'':>9} peak allocation of one search: {peak / 1e6:.1f} MB "
+                      f"(matrix {n * dim * 4 / 1e6:.0f} MB, {math.ceil(n / vectors.SEARCH_BLOCK)} blocks)")
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
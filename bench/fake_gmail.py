@@ -0,0 +1,426 @@
+# bench/fake_gmail.py
+
+"""
+Local stand-ins for the Gmail API used by the benchmarks.
+
+FakeGmailServer speaks just enough of the Gmail REST surface (and the batch
+endpoint) for agent/gmail.py to run against it unchanged, and counts every
+HTTP round trip it serves.
+"""
+
+import base64
+import json
+import re
+import threading
+import time
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from googleapiclient import discovery_cache
+
+
+def discovery_document(root_url="http://127.0.0.1:8765/"):
+    """
+    The real Gmail v1 discovery document, re-pointed at a local root URL so
+    no request ever leaves the machine.
+    """
+    doc = json.loads(discovery_cache.get_static_doc("gmail", "v1"))
+    doc["rootUrl"] = root_url
+    doc["baseUrl"] = root_url
+    doc["mtlsRootUrl"] = root_url
+    return doc
+
+
+def sent_message(msg_id, body):
+    """Message resource for a messages.send body (raw RFC 822, optional threadId)"""
+    raw = base64.urlsafe_b64decode(body["raw"]).decode("utf-8")
+    head, _, text = raw.partition("\r\n\r\n")
+    headers = [
+        {"name": name, "value": value}
+        for name, _, value in (line.partition(":") for line in head.split("\r\n") if line)
+    ]
+    return {
+        "id": msg_id,
+        "threadId": body.get("threadId", msg_id),
+        "labelIds": ["SENT"],
+        "snippet": text[:100],
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": headers,
+            "body": {"data": base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")},
+        },
+    }
+
+
+def write_fake_token(path):
+    """Write a token.json that google-auth accepts as valid without refreshing"""
+    with open(path, "w") as f:
+        json.dump({
+            "token": "fake-access-token",
+            "refresh_token": "fake-refresh-token",
+            "client_id": "fake-client-id",
+            "client_secret": "fake-client-secret",
+            "token_uri": "http://127.0.0.1:1/token",
+            "expiry": "2099-01-01T00:00:00Z",
+        }, f)
+
+
+def make_message(msg_id, thread_id, sender, subject, body, labels=("INBOX", "UNREAD")):
+    """A Gmail message resource in format=full shape"""
+    data = base64.urlsafe_b64encode(body.encode("utf-8")).decode("ascii")
+    return {
+        "id": msg_id,
+        "threadId": thread_id,
+        "labelIds": list(labels),
+        "snippet": body[:100],
+        "payload": {
+            "mimeType": "multipart/alternative",
+            "headers": [
+                {"name": "From", "value": sender},
+                {"name": "Subject", "value": subject},
+            ],
+            "parts": [
+                {"mimeType": "text/plain", "body": {"data": data, "size": len(body)}},
+            ],
+        },
+    }
+
+
+def make_mailbox(n_messages, thread_depth=1):
+    """n_messages synthetic messages, grouped thread_depth to a thread"""
+    messages = []
+    for i in range(n_messages):
+        thread = i // thread_depth
+        messages.append(make_message(
+            f"m{i:06d}", f"t{thread:06d}",
+            f"Sender {thread} <sender{thread}@example.com>",
+            f"Subject {thread}",
+            f"Hello, this is message {i} in thread {thread}.",
+        ))
+    return messages
+
+
+class LocalHTTPServer(ThreadingHTTPServer):
+    """Threaded server with a listen backlog big enough for load tests"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeGmailServer:
+    """
+    In-memory Gmail mailbox served over HTTP on 127.0.0.1.
+
+    round_trips counts HTTP requests received; api_calls counts API operations,
+    including the ones unpacked from batch requests. fail_once holds message
+    ids whose next get returns 429, send_failures the number of upcoming
+    sends that return 503, and send_drops the number of upcoming sends that
+    are delivered but whose response is never written (the connection is
+    closed), to exercise retry paths. Sent messages appear in their thread
+    with the SENT label. Every change is recorded
+    as a history entry; expire_history() drops them all, the way Gmail does
+    after about a week. attachments maps attachment ids to the
+    base64url data served for parts whose payload only names them. latency
+    is seconds per HTTP request, or a callable returning one (see
+    bench/latency.py).
+    """
+
+    def __init__(self, messages=(), latency=0.0, port=0, attachments=None):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.order = []
+        self.fail_once = set()
+        self.round_trips = 0
+        self.api_calls = 0
+        self.sent = []
+        self.send_failures = 0
+        self.send_drops = 0
+        self.sent_messages = []
+        self.attachments = dict(attachments or {})
+        self.history_id = 1000
+        self.history_floor = 1000
+        self.history = []
+        for m in messages:
+            self.add_message(m)
+        self.httpd = LocalHTTPServer(("127.0.0.1", port), self._handler())
+        self.thread = None
+
+    @property
+    def root_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+
+    def discovery_document(self):
+        return discovery_document(self.root_url)
+
+    def add_message(self, message):
+        with self.lock:
+            if message["id"] not in self.messages:
+                self.order.insert(0, message["id"])  # newest first, like Gmail
+            self.messages[message["id"]] = message
+            self._record("messagesAdded", message)
+
+    def _record(self, kind, message, labels=None):
+        """Append a history entry; caller holds the lock"""
+        self.history_id += 1
+        item = {"message": self._format(message, "minimal")}
+        if labels is not None:
+            item["labelIds"] = labels
+        self.history.append({"id": str(self.history_id), kind: [item]})
+
+    def expire_history(self):
+        with self.lock:
+            self.history = []
+            self.history_floor = self.history_id + 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.round_trips = 0
+            self.api_calls = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # API operations
+
+    def _format(self, message, fmt, headers=None):
+        if fmt == "minimal":
+            return {k: message[k] for k in ("id", "threadId", "labelIds")}
+        if fmt == "metadata":
+            out = {k: message[k] for k in ("id", "threadId", "labelIds", "snippet")}
+            hdrs = message["payload"]["headers"]
+            if headers:
+                hdrs = [h for h in hdrs if h["name"] in headers]
+            out["payload"] = {"mimeType": message["payload"]["mimeType"], "headers": hdrs}
+            return out
+        return message
+
+    def _list_messages(self, query):
+        labels = query.get("labelIds", [])
+        limit = int(query.get("maxResults", ["100"])[0])
+        ids = [
+            mid for mid in self.order
+            if all(label in self.messages[mid]["labelIds"] for label in labels)
+        ][:limit]
+        return 200, {
+            "messages": [{"id": mid, "threadId": self.messages[mid]["threadId"]} for mid in ids],
+            "resultSizeEstimate": len(ids),
+        }
+
+    def _get_message(self, msg_id, query):
+        if msg_id in self.fail_once:
+            self.fail_once.discard(msg_id)
+            return 429, {"error": {"code": 429, "message": "Rate limit exceeded"}}
+        message = self.messages.get(msg_id)
+        if message is None:
+            return 404, {"error": {"code": 404, "message": "Not Found"}}
+        fmt = query.get("format", ["full"])[0]
+        return 200, self._format(message, fmt, query.get("metadataHeaders"))
+
+    def _get_attachment(self, attachment_id):
+        data = self.attachments.get(attachment_id)
+        if data is None:
+            return 404, {"error": {"code": 404, "message": "Not Found"}}
+        return 200, {"attachmentId": attachment_id, "data": data, "size": len(data) * 3 // 4}
+
+    def _get_thread(self, thread_id, query):
+        fmt = query.get("format", ["full"])[0]
+        members = [
+            self._format(self.messages[mid], fmt, query.get("metadataHeaders"))
+            for mid in reversed(self.order)
+            if self.messages[mid]["threadId"] == thread_id
+        ] + [
+            self._format(m, fmt, query.get("metadataHeaders"))
+            for m in self.sent_messages if m["threadId"] == thread_id
+        ]
+        if not members:
+            return 404, {"error": {"code": 404, "message": "Not Found"}}
+        return 200, {"id": thread_id, "messages": members}
+
+    def _modify(self, msg_id, body):
+        message = self.messages.get(msg_id)
+        if message is None:
+            return 404, {"error": {"code": 404, "message": "Not Found"}}
+        self._apply_labels(message, body)
+        return 200, self._format(message, "minimal")
+
+    def _batch_modify(self, body):
+        ids = body.get("ids", [])
+        if len(ids) > 1000:
+            return 400, {"error": {"code": 400, "message": "Too many ids"}}
+        # Like Gmail, one unknown id fails the whole call
+        if any(msg_id not in self.messages for msg_id in ids):
+            return 400, {"error": {"code": 400, "message": "Invalid id value"}}
+        for msg_id in ids:
+            self._apply_labels(self.messages[msg_id], body)
+        return 204, None
+
+    def _apply_labels(self, message, body):
+        with self.lock:
+            removed = [l for l in body.get("removeLabelIds", []) if l in message["labelIds"]]
+            added = [l for l in body.get("addLabelIds", []) if l not in message["labelIds"]]
+            message["labelIds"] = [l for l in message["labelIds"] if l not in removed] + added
+            if removed:
+                self._record("labelsRemoved", message, removed)
+            if added:
+                self._record("labelsAdded", message, added)
+
+    def _profile(self):
+        return 200, {
+            "emailAddress": "me@example.com",
+            "messagesTotal": len(self.messages),
+            "historyId": str(self.history_id),
+        }
+
+    def _list_history(self, query):
+        start = int(query["startHistoryId"][0])
+        if start < self.history_floor:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        with self.lock:
+            records = [r for r in self.history if int(r["id"]) > start]
+            return 200, {"history": records, "historyId": str(self.history_id)}
+
+    def _send(self, body):
+        with self.lock:
+            if self.send_failures:
+                self.send_failures -= 1
+                return 503, {"error": {"code": 503, "message": "Backend Error"}}
+            self.sent.append(body)
+            msg_id = f"sent{len(self.sent):06d}"
+            message = sent_message(msg_id, body)
+            self.sent_messages.append(message)
+            if self.send_drops:
+                self.send_drops -= 1
+                return None, None
+        return 200, self._format(message, "minimal")
+
+    def dispatch(self, method, path, query, body):
+        """Route one API call to (status, json_body)"""
+        with self.lock:
+            self.api_calls += 1
+        if path == "/gmail/v1/users/me/profile" and method == "GET":
+            return self._profile()
+        if path == "/gmail/v1/users/me/history" and method == "GET":
+            return self._list_history(query)
+        m = re.fullmatch(r"/gmail/v1/users/me/messages", path)
+        if m and method == "GET":
+            return self._list_messages(query)
+        m = re.fullmatch(r"/gmail/v1/users/me/messages/send", path)
+        if m and method == "POST":
+            return self._send(body)
+        m = re.fullmatch(r"/gmail/v1/users/me/messages/batchModify", path)
+        if m and method == "POST":
+            return self._batch_modify(body)
+        m = re.fullmatch(r"/gmail/v1/users/me/messages/([^/]+)", path)
+        if m and method == "GET":
+            return self._get_message(m.group(1), query)
+        m = re.fullmatch(r"/gmail/v1/users/me/messages/([^/]+)/attachments/([^/]+)", path)
+        if m and method == "GET":
+            return self._get_attachment(m.group(2))
+        m = re.fullmatch(r"/gmail/v1/users/me/messages/([^/]+)/modify", path)
+        if m and method == "POST":
+            return self._modify(m.group(1), body)
+        m = re.fullmatch(r"/gmail/v1/users/me/threads/([^/]+)", path)
+        if m and method == "GET":
+            return self._get_thread(m.group(1), query)
+        return 404, {"error": {"code": 404, "message": f"No fake route for {method} {path}"}}
+
+    def _dispatch_batch(self, content_type, raw):
+        """Unpack a multipart/mixed batch, run each part, and pack the responses"""
+        envelope = Parser().parsestr(f"Content-Type: {content_type}\r\n\r\n" + raw)
+        boundary = "fake_batch_boundary"
+        out = []
+        for part in envelope.get_payload():
+            inner = part.get_payload()
+            request_line, _, rest = inner.partition("\n")
+            method, target, _ = request_line.strip().split(" ", 2)
+            _, _, inner_body = rest.replace("\r\n", "\n").partition("\n\n")
+            url = urlparse(target)
+            body = json.loads(inner_body) if inner_body.strip() else {}
+            status, payload = self.dispatch(method, url.path, parse_qs(url.query), body)
+            content_id = part["Content-ID"]
+            out.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id[1:]}\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+        out.append(f"--{boundary}--\r\n")
+        return f"multipart/mixed; boundary={boundary}", "".join(out).encode("utf-8")
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status, content_type, content):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def _handle(self, method):
+                with server.lock:
+                    server.round_trips += 1
+                delay = server.latency() if callable(server.latency) else server.latency
+                if delay:
+                    time.sleep(delay)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length).decode("utf-8") if length else ""
+                url = urlparse(self.path)
+                if url.path == "/batch":
+                    content_type, content = server._dispatch_batch(self.headers["Content-Type"], raw)
+                    return self._respond(200, content_type, content)
+                body = json.loads(raw) if raw else {}
+                status, payload = server.dispatch(method, url.path, parse_qs(url.query), body)
+                if status is None:
+                    # Hang up without answering, like a timeout after Gmail acted
+                    self.close_connection = True
+                    return
+                content = b"" if payload is None else json.dumps(payload).encode("utf-8")
+                self._respond(status, "application/json", content)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+        return Handler
+
+
+def point_agent_at(root_url, workdir):
+    """
+    Configure agent.gmail to talk to a fake server at root_url, using a fake
+    token and discovery document written into workdir.
+    """
+    import os
+    from agent import gmail
+
+    doc_path = os.path.join(workdir, "gmail_discovery.json")
+    with open(doc_path, "w") as f:
+        json.dump(discovery_document(root_url), f)
+    gmail.TOKEN_PATH = os.path.join(workdir, "token.json")
+    write_fake_token(gmail.TOKEN_PATH)
+    os.environ["GMAIL_DISCOVERY_DOC"] = doc_path
+    gmail.reset_gmail_service()
+    return doc_path
@@ -0,0 +1,294 @@
+# bench/fake_openai.py
+
+"""
+A local chat-completions server standing in for OpenAI in the benchmarks.
+
+Requests carrying tools get a canned tool call (or none), picked
+deterministically from the last user message, so runs are reproducible.
+json_schema requests get the same pick as a structured single-pass
+decision. Everything else gets a short canned text answer, streamed word
+by word as chat.completion.chunk events when the request sets stream.
+/v1/embeddings returns hashed bag-of-words vectors, so texts sharing words
+come out similar.
+"""
+
+import array
+import base64
+import collections
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+from bench.fake_gmail import LocalHTTPServer
+
+DEFAULT_TOOL_MIX = [
+    ("generate_reply", {}),
+    ("add_to_todo", {"task": "Follow up", "due_date": "2026-01-01"}),
+    ("summarize_email", {}),
+    (None, None),  # no tool call -> no_action
+]
+
+DEFAULT_REPLY = "Thanks for the note. This is a canned response from the fake model."
+
+
+class FakeOpenAIServer:
+    """
+    latency is seconds per completion, or a callable returning one (for
+    latency distributions); when streaming it is the time to first token.
+    token_delay adds seconds per generated word, between streamed chunks or
+    up front for a whole completion. tool_mix is a list of
+    (tool_name, arguments); a None name means "answer without calling a tool".
+    reply_text replaces the canned plain-text answer.
+
+    Rate limiting, to exercise client retries: rate_limit=(n, seconds) admits
+    at most n requests per sliding window and answers the rest with 429 and
+    a Retry-After for when a slot frees up; error_rate additionally fails
+    that fraction of requests at random (half 429, half 500).
+
+    embedding_latency is seconds per embeddings request (not counted in calls).
+    """
+
+    def __init__(self, latency=0.0, tool_mix=None, port=0, token_delay=0.0, reply_text=None,
+                 rate_limit=None, error_rate=0.0, seed=0, embedding_latency=0.0):
+        self.latency = latency
+        self.embedding_latency = embedding_latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.admitted = collections.deque()
+        self.rejected = 0
+        self.reply_text = reply_text or DEFAULT_REPLY
+        self.token_delay = token_delay
+        self.tool_mix = tool_mix or DEFAULT_TOOL_MIX
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.tool_calls = 0
+        self.prompt_tokens = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cancelled_streams = 0
+        self.embedding_calls = 0
+        self.embedded_inputs = 0
+        self.httpd = LocalHTTPServer(("127.0.0.1", port), self._handler())
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = self.tool_calls = self.prompt_tokens = 0
+            self.max_in_flight = 0
+            self.cancelled_streams = 0
+            self.rejected = 0
+            self.embedding_calls = self.embedded_inputs = 0
+
+    def _reject(self):
+        """(status, retry_after) if this request should fail, else None"""
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.rejected += 1
+                return (429, 0.2) if self.random.random() < 0.5 else (500, None)
+            if not self.rate_limit:
+                return None
+            limit, window = self.rate_limit
+            now = time.monotonic()
+            while self.admitted and self.admitted[0] <= now - window:
+                self.admitted.popleft()
+            if len(self.admitted) >= limit:
+                self.rejected += 1
+                return 429, round(self.admitted[0] + window - now, 3)
+            self.admitted.append(now)
+            return None
+
+    def _delay(self):
+        return self.latency() if callable(self.latency) else self.latency
+
+    def pick_tool(self, text):
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        return self.tool_mix[digest[0] % len(self.tool_mix)]
+
+    @staticmethod
+    def embedding(text, dimensions):
+        vector = [0.0] * dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % dimensions] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed(self, request):
+        """The embeddings response for one request body"""
+        inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        dimensions = request.get("dimensions") or 1536
+        data = []
+        for i, text in enumerate(inputs):
+            vector = self.embedding(text, dimensions)
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(array.array("f", vector).tobytes()).decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        tokens = sum(max(1, len(text) // 4) for text in inputs)
+        with self.lock:
+            self.embedding_calls += 1
+            self.embedded_inputs += len(inputs)
+        return {"object": "list", "data": data, "model": request.get("model", "fake"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    def complete(self, request):
+        """Build the chat.completion response for one request body"""
+        messages = request.get("messages", [])
+        prompt = " ".join(str(m.get("content") or "") for m in messages)
+        prompt_tokens = max(1, len(prompt) // 4)
+        message = {"role": "assistant", "content": None}
+        finish = "stop"
+
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+            name, arguments = self.pick_tool(str(last_user))
+            arguments = arguments or {}
+            message["content"] = json.dumps({
+                "action": name or "no_action",
+                "reply": "Thanks for reaching out, I'll get back to you shortly." if name == "generate_reply" else "",
+                "email_summary": "A canned summary." if name == "summarize_email" else "",
+                "meeting_datetime": "", "meeting_topic": "", "meeting_attendees": "",
+                "task": arguments.get("task", ""),
+                "due_date": arguments.get("due_date", ""),
+                "thread_summary": "The sender wrote in; the assistant handled it.",
+            })
+        elif request.get("tools"):
+            last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+            name, arguments = self.pick_tool(str(last_user))
+            if name:
+                message["tool_calls"] = [{
+                    "id": "call_fake",
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps(arguments)},
+                }]
+                finish = "tool_calls"
+                with self.lock:
+                    self.tool_calls += 1
+            else:
+                message["content"] = "No action needed."
+        else:
+            message["content"] = self.reply_text
+
+        completion_tokens = len((message["content"] or "").split()) or 8
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _stream(self, completion):
+                """Send the completion as SSE chunks, one word at a time"""
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                words = (completion["choices"][0]["message"]["content"] or "").split(" ")
+                base = {"id": completion["id"], "object": "chat.completion.chunk",
+                        "created": completion["created"], "model": completion["model"]}
+                try:
+                    for i, word in enumerate(words):
+                        if i:
+                            time.sleep(server.token_delay)
+                        delta = {"role": "assistant", "content": word} if not i else {"content": " " + word}
+                        chunk = dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": None}])
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                    final = dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                    usage = dict(base, choices=[], usage=completion["usage"])
+                    for chunk in (final, usage):
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    with server.lock:
+                        server.cancelled_streams += 1
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                rejection = server._reject()
+                if rejection:
+                    status, retry_after = rejection
+                    content = json.dumps({"error": {
+                        "message": "Rate limit reached" if status == 429 else "Server error",
+                        "type": "rate_limit_exceeded" if status == 429 else "server_error",
+                    }}).encode("utf-8")
+                    self.send_response(status)
+                    if retry_after is not None:
+                        self.send_header("Retry-After", str(retry_after))
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                    return
+                if self.path.endswith("/embeddings"):
+                    time.sleep(server.embedding_latency() if callable(server.embedding_latency)
+                               else server.embedding_latency)
+                    return self._json(server.embed(request))
+                with server.lock:
+                    server.calls += 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    time.sleep(server._delay())
+                    completion = server.complete(request)
+                    if request.get("stream"):
+                        return self._stream(completion)
+                    words = len((completion["choices"][0]["message"]["content"] or "").split())
+                    time.sleep(server.token_delay * words)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+                self._json(completion)
+
+            def _json(self, payload):
+                content = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
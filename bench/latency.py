@@ -0,0 +1,63 @@
+# bench/latency.py
+
+"""
+Latency distributions for the fake servers: callables returning seconds,
+seeded so that a run is reproducible.
+
+    FakeOpenAIServer(latency=lognormal(p50=0.4, p99=2.0))
+    FakeGmailServer(messages, latency=parse("uniform:0.02:0.08"))
+"""
+
+import math
+import random
+import threading
+
+Z_99 = 2.3263  # standard normal quantile at 0.99
+
+
+class _Seeded:
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()  # the servers call from many handler threads
+
+
+def fixed(seconds):
+    return lambda: seconds
+
+
+def uniform(low, high, seed=0):
+    state = _Seeded(seed)
+
+    def sample():
+        with state.lock:
+            return state.rng.uniform(low, high)
+    return sample
+
+
+def lognormal(p50, p99, seed=0):
+    """Long-tailed latency with the given median and 99th percentile"""
+    mu = math.log(p50)
+    sigma = max(0.0, math.log(p99 / p50) / Z_99)
+    state = _Seeded(seed)
+
+    def sample():
+        with state.lock:
+            return state.rng.lognormvariate(mu, sigma)
+    return sample
+
+
+def parse(spec, seed=0):
+    """
+    "0.05" (fixed), "uniform:0.02:0.08" or "lognormal:0.05:0.25" (p50:p99)
+    """
+    kind, _, args = spec.partition(":")
+    if not args:
+        return fixed(float(kind))
+    values = [float(v) for v in args.split(":")]
+    if kind == "fixed":
+        return fixed(*values)
+    if kind == "uniform":
+        return uniform(*values, seed=seed)
+    if kind == "lognormal":
+        return lognormal(*values, seed=seed)
+    raise ValueError(f"unknown latency distribution: {spec}")
@@ -0,0 +1,149 @@
+# bench/mailbox.py
+
+"""
+Synthetic mailboxes for the benchmarks: Gmail message resources (format=full)
+with realistic MIME shapes, sizes and thread depths, built from real .eml
+bytes the way Gmail would serve them.
+
+    messages, attachments = generate_mailbox(500, thread_depth=(1, 6))
+    FakeGmailServer(messages, attachments=attachments)
+"""
+
+import base64
+import random
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+
+GMAIL_INLINE_LIMIT = 1_000_000   # parts bigger than this are served by attachmentId
+HUGE_BODY_BYTES = 5_000_000
+
+# MIME shape -> relative weight
+DEFAULT_SHAPES = {
+    "plain": 25, "alternative": 30, "html_only": 20, "latin1": 8,
+    "mixed_attachment": 10, "related": 5, "huge": 2,
+}
+# Mostly conversation, some bulk mail, nothing huge: what the agent sees day to day
+INBOX_SHAPES = {"plain": 40, "alternative": 30, "html_only": 5, "newsletter": 20, "mixed_attachment": 5}
+
+WORDS = ("the quarterly numbers look fine but we should revisit the launch plan before friday "
+         "please send over the draft and let me know if the meeting still works for you").split()
+NAMES = ["Priya", "Tom", "Aisha", "Marco", "Lena", "Kenji", "Sofia", "Omar"]
+
+
+def _text(rng, n_words):
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+
+def _html(rng, n_paragraphs):
+    paragraphs = "".join(f"<p style='margin:0'>{_text(rng, 40)} &amp; more</p>" for _ in range(n_paragraphs))
+    return ("<html><head><style>p {color: #333}</style><title>Digest</title></head><body>"
+            f"<table><tr><td><h1>This week</h1>{paragraphs}</td></tr></table>"
+            "<script>track()</script><a href='https://example.com/unsub'>Unsubscribe</a></body></html>")
+
+
+def make_eml(rng, n, shapes=None, sender="Priya <priya@example.com>", subject=None):
+    """RFC 822 bytes of one message, its MIME shape drawn from shapes"""
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["To"] = "me@example.com"
+    msg["Subject"] = subject or f"Message {n}"
+    msg["Message-ID"] = f"<m{n}@example.com>"
+    shapes = shapes or DEFAULT_SHAPES
+    kind = rng.choices(list(shapes), list(shapes.values()))[0]
+    if kind == "plain":
+        msg.set_content(_text(rng, 120))
+    elif kind == "alternative":
+        msg.set_content(_text(rng, 200))
+        msg.add_alternative(_html(rng, 5), subtype="html")
+    elif kind == "html_only":
+        msg.set_content(_html(rng, 12), subtype="html")
+    elif kind == "newsletter":
+        msg.replace_header("From", "The Weekly <newsletter@news.example.com>")
+        msg["List-Unsubscribe"] = "<https://news.example.com/unsub>"
+        msg["Precedence"] = "bulk"
+        msg.set_content(_text(rng, 80))
+        msg.add_alternative(_html(rng, 8), subtype="html")
+    elif kind == "latin1":
+        msg.set_content("Café déjà vu, señor. " + _text(rng, 100), charset="iso-8859-1", cte="quoted-printable")
+    elif kind == "mixed_attachment":
+        msg.set_content(_text(rng, 150))
+        msg.add_alternative(_html(rng, 4), subtype="html")
+        msg.add_attachment(rng.randbytes(300_000), maintype="application", subtype="pdf", filename="report.pdf")
+    elif kind == "related":
+        msg.set_content(_html(rng, 6), subtype="html")
+        msg.add_related(rng.randbytes(20_000), maintype="image", subtype="png", cid="<logo>")
+        msg.add_attachment(_text(rng, 50), filename="notes.txt")
+    else:
+        msg.set_content(_text(rng, HUGE_BODY_BYTES // 6))
+    return msg.as_bytes()
+
+
+def to_gmail_payload(message, attachments):
+    """The format=full payload Gmail serves for a parsed MIME message"""
+    out = {
+        "mimeType": message.get_content_type(),
+        "filename": message.get_filename() or "",
+        "headers": [{"name": k, "value": str(v)} for k, v in message.items()],
+    }
+    if message.is_multipart():
+        out["body"] = {"size": 0}
+        out["parts"] = [to_gmail_payload(part, attachments) for part in message.iter_parts()]
+        return out
+    raw = message.get_payload(decode=True) or b""
+    data = base64.urlsafe_b64encode(raw).decode("ascii")
+    if out["filename"] or len(raw) > GMAIL_INLINE_LIMIT:
+        attachment_id = f"att{len(attachments)}"
+        attachments[attachment_id] = data
+        out["body"] = {"size": len(raw), "attachmentId": attachment_id}
+    else:
+        out["body"] = {"size": len(raw), "data": data}
+    return out
+
+
+def message_resource(msg_id, thread_id, eml_bytes, attachments, labels=("INBOX", "UNREAD")):
+    """A Gmail message resource (format=full) for RFC 822 bytes"""
+    payload = to_gmail_payload(message_from_bytes(eml_bytes, policy=policy.default), attachments)
+    text = next((p for p in _leaves(payload) if p["mimeType"] == "text/plain" and "data" in p["body"]), None)
+    snippet = base64.urlsafe_b64decode(text["body"]["data"])[:100].decode("utf-8", "replace") if text else ""
+    return {
+        "id": msg_id,
+        "threadId": thread_id,
+        "labelIds": list(labels),
+        "snippet": snippet,
+        "sizeEstimate": len(eml_bytes),
+        "payload": payload,
+    }
+
+
+def _leaves(payload):
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get("parts"):
+            stack.extend(part["parts"])
+        else:
+            yield part
+
+
+def generate_mailbox(n_messages, thread_depth=(1, 4), shapes=None, seed=0):
+    """
+    (messages, attachments): n_messages resources, oldest first, in threads
+    of a random depth within thread_depth (an int for a fixed depth), and
+    the attachment data for parts Gmail would serve by attachmentId.
+    """
+    rng = random.Random(seed)
+    low, high = (thread_depth, thread_depth) if isinstance(thread_depth, int) else thread_depth
+    shapes = shapes or INBOX_SHAPES
+    messages, attachments = [], {}
+    thread, left_in_thread = -1, 0
+    for i in range(n_messages):
+        if left_in_thread == 0:
+            thread += 1
+            left_in_thread = rng.randint(low, high)
+            name = rng.choice(NAMES)
+            topic = " ".join(rng.sample(WORDS, 3))
+        left_in_thread -= 1
+        eml = make_eml(rng, i, shapes, sender=f"{name} <{name.lower()}{thread}@example.com>",
+                       subject=f"{topic} ({thread})")
+        messages.append(message_resource(f"m{i:06d}", f"t{thread:06d}", eml, attachments))
+    return messages, attachments
@@ -0,0 +1,233 @@
+# bench/run.py
+
+"""
+Scripted benchmark scenarios against the fake Gmail and OpenAI servers,
+with seeded latency distributions and a generated mailbox, written out as
+JSON so that runs can be diffed across commits. Needs no Gmail account or
+OpenAI key.
+
+Scenarios:
+    fetch_emails    full-format fetches of the whole mailbox, in pages
+    process_emails  process_emails over a backlog, per-email latency from traces
+    api             concurrent clients on /emails and /generate_draft
+
+Each scenario runs in its own interpreter, so peak RSS and module state
+(caches, metrics) belong to that scenario alone.
+
+    python -m bench.run [scenario ...] [--quick] [--json results.json]
+"""
+
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import latency
+from bench.fake_gmail import FakeGmailServer, point_agent_at
+from bench.fake_openai import FakeOpenAIServer
+from bench.mailbox import generate_mailbox
+
+SEED = 7
+GMAIL_LATENCY = "lognormal:0.03:0.15"   # per HTTP request (a batch counts once)
+LLM_LATENCY = "lognormal:0.4:2.0"       # per completion
+RESULT_PREFIX = "BENCH_RESULT "
+
+# scenario -> parameters (quick runs use the second set)
+SCENARIOS = {
+    "fetch_emails": ({"messages": 2000, "page": 50, "thread_depth": (1, 6)},
+                     {"messages": 300, "page": 50, "thread_depth": (1, 6)}),
+    "process_emails": ({"messages": 200, "thread_depth": (1, 4), "concurrency": 8},
+                       {"messages": 40, "thread_depth": (1, 4), "concurrency": 8}),
+    "api": ({"messages": 200, "thread_depth": (1, 4), "clients": 100, "requests_per_client": 4, "port": 8621},
+            {"messages": 50, "thread_depth": (1, 4), "clients": 20, "requests_per_client": 2, "port": 8621}),
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def latency_summary(seconds):
+    return {
+        "p50_ms": round(percentile(seconds, 0.50) * 1000, 1) if seconds else None,
+        "p99_ms": round(percentile(seconds, 0.99) * 1000, 1) if seconds else None,
+        "max_ms": round(max(seconds) * 1000, 1) if seconds else None,
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+@contextlib.contextmanager
+def fake_environment(messages=(), attachments=None, gmail_latency=0.0, llm_latency=0.0, seed=0):
+    """
+    Fake Gmail and OpenAI servers for `messages`, with the agent pointed at
+    them and running in a temporary directory (the cwd until the block
+    exits). Yields (gmail_server, llm_server).
+    """
+    with FakeGmailServer(messages, latency=gmail_latency, attachments=attachments) as gmail, \
+            FakeOpenAIServer(latency=llm_latency, seed=seed) as llm, \
+            tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ["OPENAI_API_KEY"] = "fake-key"
+        os.environ["OPENAI_BASE_URL"] = llm.base_url
+        point_agent_at(gmail.root_url, tmp)
+        yield gmail, llm
+
+
+@contextlib.contextmanager
+def environment(params):
+    """Fake servers for a scenario's generated mailbox, with seeded latencies"""
+    messages, attachments = generate_mailbox(params["messages"], params["thread_depth"], seed=SEED)
+    with fake_environment(messages, attachments, gmail_latency=latency.parse(GMAIL_LATENCY, SEED),
+                          llm_latency=latency.parse(LLM_LATENCY, SEED), seed=SEED) as servers:
+        yield servers
+
+
+def scenario_fetch_emails(params):
+    with environment(params) as (gmail_server, _):
+        from agent import gmail
+
+        ids = list(reversed(gmail_server.order))
+        pages = [ids[i:i + params["page"]] for i in range(0, len(ids), params["page"])]
+        seconds, fetched = [], 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for page in pages:
+                page_start = time.perf_counter()
+                fetched += len(gmail.fetch_messages(page))
+                seconds.append(time.perf_counter() - page_start)
+        elapsed = time.perf_counter() - start
+        return {
+            "emails": fetched,
+            "seconds": round(elapsed, 3),
+            "emails_per_sec": round(fetched / elapsed, 1),
+            "latency": {"unit": f"page of {params['page']}", **latency_summary(seconds)},
+            "gmail_round_trips": gmail_server.round_trips,
+            "gmail_api_calls": gmail_server.api_calls,
+        }
+
+
+def scenario_process_emails(params):
+    with environment(params) as (gmail_server, llm_server):
+        from agent import gmail, llm_agent, metrics
+
+        llm_agent.AUTO_SEND = False
+        emails = gmail.fetch_messages(list(gmail_server.order))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = llm_agent.process_emails(emails, concurrency=params["concurrency"], rate_per_min=0)
+        elapsed = time.perf_counter() - start
+        traces = metrics.recent_traces(len(emails))
+        actions = {}
+        for r in results:
+            actions[r["action"]] = actions.get(r["action"], 0) + 1
+        return {
+            "emails": len(results),
+            "threads": len({e["threadId"] for e in emails}),
+            "seconds": round(elapsed, 3),
+            "emails_per_sec": round(len(results) / elapsed, 2),
+            "latency": {"unit": "email", **latency_summary([t["duration_ms"] / 1000 for t in traces])},
+            "actions": actions,
+            "llm_calls": llm_server.calls,
+            "llm_prompt_tokens": llm_server.prompt_tokens,
+            "llm_max_in_flight": llm_server.max_in_flight,
+        }
+
+
+def scenario_api(params):
+    from bench.bench_api_load import load, serve
+
+    with environment(params):
+        with contextlib.redirect_stdout(io.StringIO()):
+            import run_app
+            from agent import storage
+            storage.init_db()
+        server = serve(run_app.app, params["port"])
+        try:
+            latencies, errors, elapsed = asyncio.run(
+                load(f"http://127.0.0.1:{params['port']}", params["clients"], params["requests_per_client"]))
+        finally:
+            server.should_exit = True
+        done = sum(len(values) for values in latencies.values())
+        return {
+            "requests": done,
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "requests_per_sec": round(done / elapsed, 1),
+            "latency": {route: latency_summary(values) for route, values in latencies.items()},
+        }
+
+
+def run_child(name, quick):
+    params = SCENARIOS[name][1 if quick else 0]
+    result = globals()[f"scenario_{name}"](params)
+    result["params"] = params
+    result["peak_rss_mb"] = peak_rss_mb()
+    print(RESULT_PREFIX + json.dumps(result))
+
+
+def run_scenario(name, quick):
+    cmd = [sys.executable, "-m", "bench.run", "--child", name] + (["--quick"] if quick else [])
+    proc = subprocess.run(cmd, capture_output=True, text=True, cwd=os.getcwd())
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return {"error": f"exit status {proc.returncode}", "stderr": proc.stderr[-2000:]}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv):
+    quick = "--quick" in argv
+    if "--child" in argv:
+        return run_child(argv[argv.index("--child") + 1], quick)
+    json_path = argv[argv.index("--json") + 1] if "--json" in argv else None
+    skip = {json_path, "--quick", "--json"}
+    names = [a for a in argv if a not in skip] or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        sys.exit(f"unknown scenario(s): {', '.join(unknown)}; choose from {', '.join(SCENARIOS)}")
+
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": quick,
+        "seed": SEED,
+        "gmail_latency": GMAIL_LATENCY,
+        "llm_latency": LLM_LATENCY,
+        "scenarios": {},
+    }
+    for name in names:
+        print(f"running {name}...", file=sys.stderr)
+        report["scenarios"][name] = run_scenario(name, quick)
+    out = json.dumps(report, indent=2)
+    if json_path:
+        with open(json_path, "w") as f:
+            f.write(out + "\n")
+    print(out)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,5 @@
 import axios from "axios";
-import React, { useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import { Email } from "./types";
 
 type Props = {
@@ -9,27 +9,85 @@ type Props = {
 export default function ReadingPane({ email }: Props) {
   const [draft, setDraft] = useState('');
   const [suggested, setSuggested] = useState('');
+  const [streaming, setStreaming] = useState(false);
+  const abortRef = useRef<AbortController | null>(null);
+
+  // Stop an in-flight draft when the user opens another email or leaves
+  useEffect(() => {
+    setDraft(email?.draft ?? '');
+    setSuggested(email?.draft ?? '');
+    return () => abortRef.current?.abort();
+  }, [email?.id]);
 
   if (!email) {
     return <div>Select an email to view details.</div>
   }
 
   async function generateDraft() {
-    const res = await axios.post('http://localhost:8000/generate_draft', {
-      email_text: email.body,
-      sender: email.from
-    });
-    setSuggested(res.data.draft);
-    setDraft(res.data.draft);
+    abortRef.current?.abort();
+    const controller = new AbortController();
+    abortRef.current = controller;
+    setStreaming(true);
+    setSuggested('');
+
+    let text = '';
+    try {
+      const res = await fetch('http://localhost:8000/generate_draft/stream', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ email_text: email.body, sender: email.from }),
+        signal: controller.signal,
+      });
+      const reader = res.body!.pipeThrough(new TextDecoderStream()).getReader();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += value;
+        // SSE events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop() ?? '';
+        for (const raw of events) {
+          const event = raw.match(/^event: (.*)$/m)?.[1];
+          const data = raw.match(/^data: (.*)$/m)?.[1];
+          if (!data) continue;
+          const payload = JSON.parse(data);
+          if (event === 'done') {
+            text = payload.draft;
+          } else if (event === 'error') {
+            throw new Error(payload.error);
+          } else {
+            text += payload.delta;
+            setSuggested(text);
+          }
+        }
+      }
+      setSuggested(text);
+      setDraft(text);
+    } catch (err) {
+      if ((err as Error).name !== 'AbortError') {
+        alert(`Draft failed: ${(err as Error).message}`);
+      }
+    } finally {
+      if (abortRef.current === controller) {
+        setStreaming(false);
+      }
+    }
   }
 
   async function send() {
-    await axios.post('http://localhost:8000/send_reply', {
+    // The reply is queued in the outbox; the sender delivers it in the background
+    const { data } = await axios.post('http://localhost:8000/send_reply', {
       to: email.from,
       subject: `Re: ${email.subject}`,
-      body: draft
+      body: draft,
+      message_id: email.id
     });
-    alert("Sent!");
+    if (data.duplicate) {
+      alert(`Already queued (${data.status})`);
+    } else {
+      alert(data.status === 'sent' ? "Sent" : `Queued (${data.status})`);
+    }
   }
 
   async function del() {
@@ -45,11 +103,12 @@ export default function ReadingPane({ email }: Props) {
       <h4>{email.from}</h4>
       <pre style={{ whiteSpace: 'pre-wrap' }}>{email.body}</pre>
 
-      <button onClick={generateDraft}>Generate GPT Draft</button>
+      <button onClick={generateDraft} disabled={streaming}>Generate GPT Draft</button>
+      {streaming && <button onClick={() => abortRef.current?.abort()}>Stop</button>}
       {suggested && (
         <>
           <h4>Suggestion:</h4>
-          <pre>{suggested}</pre>
+          <pre style={{ whiteSpace: 'pre-wrap' }}>{suggested}{streaming && ' ▌'}</pre>
           <textarea value={draft} onChange={e => setDraft(e.target.value)} rows={8} style={{ width: '100%' }} />
           <button onClick={send}>Send</button>
           <button onClick={del}>Delete</button>
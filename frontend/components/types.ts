@@ -4,5 +4,7 @@ export type Email = {
   from: string;
   subject: string;
   body: string;
+  status?: 'NEW' | 'DRAFT READY' | 'SENT';
+  draft?: string | null;  // prefetched reply, when status is 'DRAFT READY'
 };
 
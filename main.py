@@ -2,8 +2,10 @@
 
 from agent.gmail import fetch_emails
 from agent.llm_agent import process_emails
+from agent import outbox, storage
 
 if __name__ == "__main__":
+    storage.init_db()
     emails = fetch_emails(n=1)
     # for e in emails:
     #     print("-" * 50)
@@ -12,4 +14,5 @@ if __name__ == "__main__":
     #     print("Body:", e["body"])
     
     process_emails(emails)
-
+    # Deliver the replies AUTO_SEND queued before the process exits
+    print("Outbox:", outbox.sender.drain())
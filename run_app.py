@@ -3,27 +3,56 @@ Unified entry: launches FastAPI backend (localhost:8000) and Streamlit dashboard
 """
 
 import os
+import html
+import json
+import time
+import asyncio
 import threading
+from contextlib import asynccontextmanager
 import uvicorn
-from fastapi import FastAPI, Body
+from fastapi import FastAPI, Body, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
+from typing import List, Optional
 
 import streamlit as st
 
-from agent.gmail import fetch_emails
-from agent.llm_agent import process_emails  # uses AUTO_SEND flag
-from agent.gmail import send_email
-from agent.llm_agent import get_thread_memory
-from agent.gmail import fetch_thread
-from agent.functions import generate_reply
-from agent.gmail import get_gmail_service
+from agent.llm_agent import draft_candidates, get_thread_memory, get_thread_memories
+from agent.functions import generate_reply_async, stream_reply_async, llm_cache_stats
+from agent import classifier, gmail, gmail_async, llm, metrics, outbox, prompts, search, vectors
+from agent.message_cache import message_cache
+from agent import storage
+from agent.worker import Worker, get_job, queue_stats
+from agent.drafts import DraftPrefetcher, draft_status
 
 import requests
 from fastapi.middleware.cors import CORSMiddleware
 
 
 # FASTAPI BACKEND 
-app = FastAPI()
+# Runs /process jobs in the background (uses AUTO_SEND flag). It only polls on
+# demand; `python -m agent.worker` is the continuously polling daemon.
+worker = Worker(poll_interval=None)
+# Drafts replies for unread mail ahead of time (see agent/drafts.py)
+prefetcher = DraftPrefetcher()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    storage.init_db()  # schema migrations run once, before the first request
+    worker.start()
+    prefetcher.start()
+    outbox.sender.start()
+    yield
+    prefetcher.stop(timeout=30)
+    worker.stop(timeout=60)
+    outbox.sender.stop(timeout=30)
+    storage.write_buffer.flush()
+    await asyncio.to_thread(gmail.label_buffer.flush)  # queued archive / mark-read changes
+    await gmail_async.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.add_middleware(
@@ -38,55 +67,235 @@ class SendBody(BaseModel):
     to: str
     subject: str
     body: str
+    message_id: Optional[str] = None  # the email being answered, for its SENT badge
 
 class DraftRequest(BaseModel):
     email_text: str
     sender: str
+    bypass_cache: bool = False
 
 class DeleteBody(BaseModel):
     message_id: str
 
+class BulkArchiveBody(BaseModel):
+    message_ids: List[str]
+
+# Routes that wait on Gmail or OpenAI are async so a slow upstream call does
+# not tie up a worker thread; quick SQLite-only routes stay plain functions.
 @app.post("/generate_draft")
-def api_generate_draft(req: DraftRequest):
-    draft = generate_reply(email_text=req.email_text, sender=req.sender)
+async def api_generate_draft(req: DraftRequest):
+    draft = await generate_reply_async(email_text=req.email_text, sender=req.sender, bypass_cache=req.bypass_cache)
     return {"draft": draft}
 
+def _sse(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+@app.post("/generate_draft/stream")
+async def api_generate_draft_stream(req: DraftRequest, request: Request):
+    """
+    Server-Sent Events: one `data: {"delta": ...}` per chunk, then
+    `event: done` with the full draft (or `event: error`). Disconnecting
+    stops generation upstream.
+    """
+    async def events():
+        chunks = stream_reply_async(email_text=req.email_text, sender=req.sender, bypass_cache=req.bypass_cache)
+        parts = []
+        try:
+            async for delta in chunks:
+                if await request.is_disconnected():
+                    break
+                parts.append(delta)
+                yield _sse({"delta": delta})
+            else:
+                yield _sse({"draft": "".join(parts).strip()}, event="done")
+        except Exception as e:
+            print("Draft stream failed:", e)
+            yield _sse({"error": str(e)}, event="error")
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+MAX_ARCHIVE_IDS = 10_000  # message ids accepted by one /bulk_archive call
+
+# Archiving goes through the label buffer, so it shares batchModify calls
+# with queued changes; Gmail is called off the event loop.
 @app.post("/delete_email")
-def delete_email(req: DeleteBody):
-    service = get_gmail_service()
-    service.users().messages().modify(
-        userId="me", id=req.message_id,
-        body={"removeLabelIds": ["INBOX"]}
-    ).execute()
+async def delete_email(req: DeleteBody):
+    if await asyncio.to_thread(gmail.archive, [req.message_id]):
+        raise HTTPException(status_code=502, detail="Gmail did not archive the message")
     return {"status": "archived"}
+
+@app.post("/bulk_archive")
+async def bulk_archive(req: BulkArchiveBody):
+    """Archive many messages in a few batchModify calls; reports the ids that failed"""
+    message_ids = list(dict.fromkeys(req.message_ids))
+    if len(message_ids) > MAX_ARCHIVE_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_ARCHIVE_IDS} message ids per request")
+    failed = await asyncio.to_thread(gmail.archive, message_ids)
+    return {"status": "archived", "archived": len(message_ids) - len(failed),
+            "failed": failed}
     
 @app.get("/emails")
-def get_emails():
-    emails = fetch_emails(n=10)
+async def get_emails(n: int = 10, metadata_only: bool = False):
+    emails = await gmail_async.fetch_emails(n=n, metadata_only=metadata_only)
+    await asyncio.to_thread(lambda: prefetcher.submit(draft_candidates(emails)))
+    statuses = await asyncio.to_thread(draft_status, [e["id"] for e in emails])
+    for e in emails:
+        e["status"], e["draft"] = statuses[e["id"]]
     return emails
 
 @app.post("/process")
 def run_agent():
-    emails = fetch_emails(n=5)
-    process_emails(emails)
-    return {"status": "done"}
+    job_id = worker.submit()
+    return {"status": "queued", "job_id": job_id}
+
+@app.get("/jobs/{job_id}")
+def api_job(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    job["queue"] = queue_stats()
+    return job
 
 @app.post("/send_reply")
 def api_send_reply(payload: SendBody):
-    out = send_email(to=payload.to, subject=payload.subject, body=payload.body)
-    return {"status": "sent", "out": out}
+    """
+    Queue the reply in the outbox and return at once; poll /outbox/{id}.
+    The same reply to the same email is queued once (duplicate=true).
+    """
+    entry = outbox.enqueue(payload.to, payload.subject, payload.body, source_message_id=payload.message_id)
+    return {"status": entry["state"], "outbox_id": entry["outbox_id"], "duplicate": entry["duplicate"]}
+
+@app.get("/outbox/{outbox_id}")
+def api_outbox(outbox_id: str):
+    entry = outbox.get(outbox_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Unknown outbox id")
+    return entry
+
+@app.post("/outbox/{outbox_id}/retry")
+def api_outbox_retry(outbox_id: str):
+    """Queue a 'review' or 'dead' entry again, after checking Gmail's Sent folder"""
+    entry = outbox.requeue(outbox_id)
+    if entry is None:
+        if outbox.get(outbox_id) is None:
+            raise HTTPException(status_code=404, detail="Unknown outbox id")
+        raise HTTPException(status_code=409, detail="Only review or dead entries can be retried")
+    return entry
 
 @app.get("/thread/{thread_id}")
-def api_thread(thread_id: str):
-    messages = fetch_thread(thread_id)
-    summary, last_action = get_thread_memory(thread_id)
+async def api_thread(thread_id: str):
+    messages = await gmail_async.fetch_thread(thread_id)
+    summary, last_action = await asyncio.to_thread(get_thread_memory, thread_id)
     return {"messages": messages, "summary": summary, "last_action": last_action}
 
+MAX_MEMORY_THREADS = 500  # thread ids accepted by one /threads/memory call
+MEMORY_THREAD_CONCURRENCY = 16  # threads fetched from Gmail at once for include_messages
+
+@app.get("/threads/memory")
+async def api_thread_memories(ids: List[str] = Query(...), include_messages: bool = False):
+    """
+    Stored summary and last action for many threads (ids=a,b,c or repeated
+    ids=), in request order. Messages are only fetched from Gmail when
+    include_messages is set; a thread that can't be fetched gets an error.
+    """
+    thread_ids = list(dict.fromkeys(t for value in ids for t in value.split(",") if t))
+    if len(thread_ids) > MAX_MEMORY_THREADS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_MEMORY_THREADS} thread ids per request")
+    memories = await asyncio.to_thread(get_thread_memories, thread_ids)
+    threads = [{"thread_id": t, "summary": memories[t][0], "last_action": memories[t][1]} for t in thread_ids]
+    if include_messages:
+        semaphore = asyncio.Semaphore(MEMORY_THREAD_CONCURRENCY)
+
+        async def fetch(thread_id):
+            async with semaphore:
+                return await gmail_async.fetch_thread(thread_id)
+
+        fetched = await asyncio.gather(*(fetch(t) for t in thread_ids), return_exceptions=True)
+        for thread, messages in zip(threads, fetched):
+            # One missing or failing thread should not fail the whole page
+            if isinstance(messages, Exception):
+                thread["messages"], thread["error"] = None, str(messages)
+            else:
+                thread["messages"] = messages
+    return {"threads": threads}
+
+@app.get("/search")
+def api_search(q: str, kind: Optional[List[str]] = Query(None), limit: int = search.DEFAULT_LIMIT):
+    """
+    Full-text search over cached mail, thread summaries and todos.
+    kind=message|thread|todo (repeatable) narrows it down. Each kind is
+    ranked best match first, and the kinds are interleaved: the best
+    message, thread and todo, then the second best of each, and so on.
+    Scores are only comparable between hits of the same kind.
+    """
+    kinds = kind or search.KINDS
+    unknown = [k for k in kinds if k not in search.KINDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown kind(s): {', '.join(unknown)}")
+    return {"query": q, "results": search.search(q, kinds=kinds, limit=limit)}
+
+@app.get("/cache_stats")
+def api_cache_stats():
+    return {"messages": message_cache.stats(), "llm": llm_cache_stats(), "llm_gateway": llm.stats(),
+            "preclassifier": classifier.stats(), "prompts": prompts.stats(), "vectors": vectors.stats(),
+            "labels": gmail.label_buffer.stats(), "outbox": outbox.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def api_metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/traces")
+def api_traces(limit: int = 50):
+    """The most recent per-email traces, newest first"""
+    return {"traces": metrics.recent_traces(limit)}
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.http_seconds.observe(time.perf_counter() - start, route=getattr(route, "path", "unmatched"),
+                                 method=request.method, status=response.status_code)
+    return response
+
 
 def start_api():
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
 # STREAMLIT FRONTEND 
+def stream_draft(email):
+    """
+    Render /generate_draft/stream into a placeholder as tokens arrive and
+    return the final draft. A rerun closes the connection, which cancels it.
+    """
+    placeholder = st.empty()
+    text, event = "", None
+    payload = {"email_text": email["body"], "sender": email["from"]}
+    with requests.post("http://localhost:8000/generate_draft/stream", json=payload, stream=True) as r:
+        for line in r.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+                if event == "done":
+                    text = data["draft"]
+                elif event == "error":
+                    st.error(f"Draft failed: {data['error']}")
+                else:
+                    text += data["delta"]
+                    placeholder.markdown(text + " ▌")
+            elif not line:
+                event = None
+    placeholder.empty()
+    return text
+
+
 def start_streamlit():
     st.set_page_config(page_title="AI Email Agent", layout="wide")
     # --- Custom CSS for styling ---
@@ -139,33 +348,35 @@ def start_streamlit():
 
     tabs = st.tabs(["Inbox", "Thread Memory", "Settings"])
 
+    # One /emails fetch per render, shared by the Inbox and Memory tabs
+    emails = requests.get("http://localhost:8000/emails").json()
+
     # TAB 1: INBOX
     with tabs[0]:
         st.header("Inbox (Unprocessed)")
         if st.button("Refresh inbox"):
             st.experimental_rerun()
-
-        import requests
-        r = requests.get("http://localhost:8000/emails")
-        emails = r.json()
+        if emails and st.button(f"Archive all {len(emails)} shown"):
+            out = requests.post("http://localhost:8000/bulk_archive",
+                                json={"message_ids": [e["id"] for e in emails]}).json()
+            st.success(f"Archived {out['archived']}." + (f" {len(out['failed'])} failed." if out["failed"] else ""))
 
         for e in emails:
             with st.container():
                 st.markdown(f"<div class='email-card'>", unsafe_allow_html=True)
 
                 # Header row: Subject + From + (status)
-                st.markdown(f"**{e['subject']}**  \n<small>{e['from']}</small>", unsafe_allow_html=True)
+                st.markdown(f"**{e['subject']}** <span class='status-badge'>{e['status']}</span>  \n"
+                            f"<small>{e['from']}</small>", unsafe_allow_html=True)
 
                 # Body preview
                 st.write(e["body"])
 
                 # Draft controls
                 if st.button("Generate GPT Draft", key=f"gptbtn_{e['id']}"):
-                    from agent.functions import generate_reply
-                    suggested = generate_reply(email_text=e['body'], sender=e['from'])
-                    st.session_state[f"suggested_{e['id']}"] = suggested
+                    st.session_state[f"suggested_{e['id']}"] = stream_draft(e)
 
-                suggested = st.session_state.get(f"suggested_{e['id']}", "")
+                suggested = st.session_state.get(f"suggested_{e['id']}", e.get("draft") or "")
                 if suggested:
                     st.markdown("**GPT Suggestion:**")
                     st.write(suggested)
@@ -178,9 +389,10 @@ def start_streamlit():
                 if st.button("Send from dashboard", key=f"send_{e['id']}"):
                     payload = {"to": e["from"],
                             "subject": f"Re: {e['subject']}",
-                            "body": draft}
-                    _ = requests.post("http://localhost:8000/send_reply", json=payload)
-                    st.success("Sent!")
+                            "body": draft,
+                            "message_id": e["id"]}
+                    out = requests.post("http://localhost:8000/send_reply", json=payload).json()
+                    st.success("Already queued." if out["duplicate"] else "Queued for sending.")
 
                 st.markdown("</div>", unsafe_allow_html=True)
 
@@ -201,12 +413,22 @@ def start_streamlit():
     # TAB 2: MEMORY
     with tabs[1]:
         st.header("Thread Memory")
-        import requests
-        r = requests.get("http://localhost:8000/emails")
-        emails = r.json()
-        for e in emails:
-            memory = requests.get(f"http://localhost:8000/thread/{e['threadId']}").json()
-            st.write(f"**Thread {e['threadId']}**")
+        query = st.text_input("Search mail, summaries and todos")
+        if query:
+            results = requests.get("http://localhost:8000/search", params={"q": query}).json()["results"]
+            for hit in results:
+                # Escape the text, keep the match highlighting
+                snippet = html.escape(hit["snippet"] or "").replace("&lt;mark&gt;", "<mark>").replace("&lt;/mark&gt;", "</mark>")
+                st.markdown(f"**{html.escape(hit['title'] or '')}** <small>{hit['kind']} {hit['thread_id'] or ''}</small>  \n"
+                            f"{snippet}", unsafe_allow_html=True)
+            if not results:
+                st.write("No matches.")
+            st.divider()
+        thread_ids = list(dict.fromkeys(e["threadId"] for e in emails))
+        threads = requests.get("http://localhost:8000/threads/memory",
+                               params={"ids": ",".join(thread_ids)}).json()["threads"] if thread_ids else []
+        for memory in threads:
+            st.write(f"**Thread {memory['thread_id']}**")
             st.write("Summary:", memory['summary'])
             st.write("Last Action:", memory['last_action'])
             st.divider()
@@ -215,8 +437,12 @@ def start_streamlit():
     with tabs[2]:
         st.header("Agent Settings")
         if st.button("Run Agent Now"):
-            requests.post("http://localhost:8000/process")
-            st.success("Agent completed.")
+            job = requests.post("http://localhost:8000/process").json()
+            st.session_state["last_job"] = job["job_id"]
+            st.success(f"Agent run queued (job {job['job_id']}).")
+        if st.session_state.get("last_job"):
+            status = requests.get(f"http://localhost:8000/jobs/{st.session_state['last_job']}").json()
+            st.write("Last run:", status["state"], f"- processed {status['processed']}, failed {status['failed']}")
 
 def main():
     threading.Thread(target=start_api).start()